@@ -0,0 +1,52 @@
+"""
+Compare the per-object flux extraction previously used in create_model_json
+against the vectorized path in d3flux.core.flux_arrays, using the bundled
+example models.
+
+    python benchmarks/bench_create_model_json.py
+"""
+
+import os
+import timeit
+
+import numpy as np
+from cobra.io import load_json_model
+
+import d3flux
+from d3flux.core.flux_arrays import (
+    get_flux_vector, stoichiometric_matrix, metabolite_throughput)
+
+examples = os.path.join(os.path.dirname(d3flux.__file__), 'examples')
+models = ['putida/vdl_2.json', 'asuc/asuc_v1.json']
+
+
+def per_object(cobra_model):
+    fluxes = [reaction.flux for reaction in cobra_model.reactions]
+    met_fluxes = [sum([abs(r.flux * r.metabolites[met]) for r in
+                       met.reactions]) / 2
+                  for met in cobra_model.metabolites]
+    return fluxes, met_fluxes
+
+
+def vectorized(cobra_model):
+    fluxes = get_flux_vector(cobra_model)
+    met_fluxes = metabolite_throughput(
+        stoichiometric_matrix(cobra_model), fluxes)
+    return fluxes, met_fluxes
+
+
+if __name__ == '__main__':
+    for filename in models:
+        model = load_json_model(os.path.join(examples, filename))
+        model.optimize()
+
+        old, new = per_object(model), vectorized(model)
+        assert np.allclose(old[0], new[0]) and np.allclose(old[1], new[1])
+
+        n = 20
+        t_old = timeit.timeit(lambda: per_object(model), number=n) / n
+        t_new = timeit.timeit(lambda: vectorized(model), number=n) / n
+        print('{:<20s} {:>4d} rxns  per-object {:8.2f} ms  '
+              'vectorized {:8.2f} ms  speed-up {:5.1f}x'.format(
+                  filename, len(model.reactions), 1E3 * t_old, 1E3 * t_new,
+                  t_old / t_new))
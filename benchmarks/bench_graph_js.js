@@ -0,0 +1,106 @@
+// Time the graph construction in d3flux.js (build_graph) on synthetic models
+// of increasing size, with the 17 common cofactors displayed, and compare it
+// against the per-cofactor linear scan of the metabolites it replaced.
+//
+//     node benchmarks/bench_graph_js.js
+//
+// The library is evaluated with stub `require`/`define` functions, so no
+// browser or network access is needed.
+
+var fs = require('fs');
+var path = require('path');
+var vm = require('vm');
+
+var library = fs.readFileSync(
+  path.join(__dirname, '..', 'd3flux', 'templates', 'd3flux.js'), 'utf8');
+
+var d3flux;
+var sandbox = {
+  require: {config: function () {}},
+  define: function (name, deps, factory) { d3flux = factory(); }
+};
+vm.runInNewContext(library, sandbox);
+
+var cofactor_ids = ['coa', 'nadh', 'nad', 'nadph', 'nadp', 'atp', 'adp',
+  'amp', 'q8', 'q8h2', 'pi', 'co2', 'h2o', 'h', 'o2', 'h2', 'nh4'];
+
+function synthetic_model(n_reactions) {
+  // Linear chains of metabolites, where every reaction also converts one
+  // pair of cofactors which are drawn as separate cofactor nodes
+  var n_metabolites = Math.round(0.8 * n_reactions),
+  metabolites = [],
+  reactions = [];
+
+  cofactor_ids.forEach(function (id) {
+    metabolites.push({id: id + '_c', name: id,
+      notes: {map_info: {display_name: id.toUpperCase(), flux: 1}}});
+  });
+  for (var i = 0; i < n_metabolites; i++) {
+    metabolites.push({id: 'm' + i + '_c', name: 'm' + i,
+      notes: {map_info: {display_name: 'M' + i, flux: 1}}});
+  }
+
+  for (var j = 0; j < n_reactions; j++) {
+    var a = 'm' + (j % n_metabolites) + '_c',
+    b = 'm' + ((j * 7 + 1) % n_metabolites) + '_c',
+    c1 = cofactor_ids[j % cofactor_ids.length] + '_c',
+    c2 = cofactor_ids[(j + 1) % cofactor_ids.length] + '_c',
+    stoich = {},
+    cofactors = {};
+
+    stoich[a] = -1;
+    stoich[b] = 1;
+    stoich[c1] = -1;
+    stoich[c2] = 1;
+    cofactors[c1] = {};
+    cofactors[c2] = {};
+
+    reactions.push({id: 'r' + j, name: 'r' + j, metabolites: stoich,
+      notes: {map_info: {flux: (j % 3) - 1, reversibility: false,
+        cofactors: cofactors}}});
+  }
+
+  return {id: 'synthetic', metabolites: metabolites, reactions: reactions};
+}
+
+function scan_cofactors(model) {
+  // The lookup previously done for each cofactor: a linear scan of the
+  // metabolites, O(reactions x cofactors x metabolites) in total
+  var found = 0;
+  model.reactions.forEach(function (reaction) {
+    for (var cofactor in reaction.notes.map_info.cofactors) {
+      found += model.metabolites.filter(function (e) {
+        return e.id == cofactor;
+      }).length;
+    }
+  });
+  return found;
+}
+
+function time(fn, repeats) {
+  fn();  // warm up
+  var start = process.hrtime.bigint();
+  for (var i = 0; i < repeats; i++) {
+    fn();
+  }
+  return Number(process.hrtime.bigint() - start) / 1E6 / repeats;
+}
+
+var config = {hide_unused: false, hide_unused_cofactors: false};
+
+console.log('reactions   nodes   build_graph (ms)   per 1k rxns   ' +
+            'cofactor scan (ms)');
+[625, 1250, 2500, 5000].forEach(function (n) {
+  var model = synthetic_model(n),
+  graph = d3flux.build_graph(model, config),
+  build = time(function () { d3flux.build_graph(model, config); }, 5),
+  scan = time(function () { scan_cofactors(model); }, 1);
+
+  console.log([
+    String(n).padStart(9),
+    String(graph.nodes.length).padStart(7),
+    build.toFixed(1).padStart(18),
+    (1000 * build / n).toFixed(2).padStart(13),
+    scan.toFixed(1).padStart(20)
+  ].join(' '));
+});
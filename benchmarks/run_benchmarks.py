@@ -0,0 +1,234 @@
+"""
+Benchmark flux_map, create_model_json, render_model, color_redox_rxns and
+update_cofactors on synthetic models of increasing size (see synthetic.py)
+and the bundled putida and asuc models. Each case records the time of the
+first call, the best mean time of the following repeats, the peak memory allocated
+by python during one call, and the size of its output.
+
+    python benchmarks/run_benchmarks.py                  # compare to baseline
+    python benchmarks/run_benchmarks.py --save           # store a new baseline
+    python benchmarks/run_benchmarks.py --sizes 100 1000 --models asuc
+
+Results are compared against benchmarks/baseline.json, and the script exits
+with status 1 if a best time or peak memory grew by more than --tolerance,
+or an output size changed by more than --size-tolerance.
+Timings depend on the machine, so save a baseline on the machine used for
+comparisons before relying on the time checks.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cobra
+from cobra.io import load_json_model
+
+import d3flux
+from d3flux import color_redox_rxns, common_cofactors, update_cofactors
+from d3flux.core.flux_layouts import create_model_json, flux_map, render_model
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic import random_fluxes, random_model  # noqa: E402
+
+examples = os.path.join(os.path.dirname(d3flux.__file__), 'examples')
+bundled = {'putida': 'putida/vdl_2.json', 'asuc': 'asuc/asuc_v1.json'}
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'baseline.json')
+
+
+def _redox(model, fluxes):
+    color_redox_rxns(model, fluxes=fluxes)
+
+
+def _cofactors(model, fluxes):
+    update_cofactors(model, common_cofactors)
+
+
+# Each case takes (model, fluxes) and returns its output, or None
+cases = {
+    'create_model_json': lambda model, fluxes: create_model_json(
+        model, fluxes),
+    'flux_map': lambda model, fluxes: flux_map(
+        model, flux_dict=fluxes, excluded_metabolites=common_cofactors,
+        figure_id='d3flux_bench').data,
+    'render_model': lambda model, fluxes: render_model(
+        model, flux_dict=fluxes, figure_id='d3flux_bench').data,
+    'color_redox_rxns': _redox,
+    'update_cofactors': _cofactors,
+}
+
+# Differences in time (s) and memory (bytes) below these are noise
+min_time_change = 1E-3
+min_memory_change = 64 * 1024
+
+# Minimum duration (s) of each timed repeat
+min_batch = 0.1
+
+
+def load_models(sizes, models):
+    """Yield (name, model, fluxes) for each synthetic size and bundled
+    model"""
+    for size in sizes:
+        model = random_model(size)
+        yield 'synthetic_{}'.format(size), model, random_fluxes(model)
+
+    for name in models:
+        model = load_json_model(os.path.join(examples, bundled[name]))
+        yield name, model, model.optimize().fluxes
+
+
+def measure(case, model, fluxes, repeat):
+    """Time, peak memory and output size of one case"""
+    timer = time.process_time
+
+    start = timer()
+    output = case(model, fluxes)
+    first = timer() - start
+
+    # Like timeit, run enough calls per repeat to take at least min_batch
+    # (calibrated on a second call, as the first one fills caches)
+    start = timer()
+    case(model, fluxes)
+    loops = max(1, int(min_batch / max(timer() - start, 1E-6)))
+    times = []
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = timer()
+            for _ in range(loops):
+                case(model, fluxes)
+            times.append((timer() - start) / loops)
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        case(model, fluxes)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'first': first,
+        'time': min(times) if times else first,
+        'peak_memory': peak,
+        'size': len(output) if output is not None else 0,
+    }
+
+
+def run(sizes, models, names, repeat):
+    results = {}
+    for model_name, model, fluxes in load_models(sizes, models):
+        for name in names:
+            key = '{}/{}'.format(model_name, name)
+            results[key] = measure(cases[name], model, fluxes, repeat)
+            print('{:<36s} first {:9.2f} ms  best {:9.2f} ms  '
+                  'peak {:9.1f} kB  size {:10d} B'.format(
+                      key, 1E3 * results[key]['first'],
+                      1E3 * results[key]['time'],
+                      results[key]['peak_memory'] / 1024.,
+                      results[key]['size']))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, tolerance, size_tolerance=0.01):
+    """Return a list of (key, metric, baseline, current) regressions.
+
+    Best times and peak memory regress when they grow by more than `tolerance`
+    (a fraction) and by more than the noise thresholds; output sizes when
+    they change by more than `size_tolerance` (a fraction, 0 for an exact
+    comparison) either way.
+
+    """
+    regressions = []
+    for key, current in sorted(results.items()):
+        if key not in baseline:
+            continue
+        previous = baseline[key]
+
+        # The single first call is too noisy to compare
+        for metric, noise in [('time', min_time_change),
+                              ('peak_memory', min_memory_change)]:
+            if (current[metric] > previous[metric] * (1 + tolerance) and
+                    current[metric] - previous[metric] > noise):
+                regressions.append(
+                    (key, metric, previous[metric], current[metric]))
+
+        if abs(current['size'] - previous['size']) > (
+                size_tolerance * previous['size']):
+            regressions.append(
+                (key, 'size', previous['size'], current['size']))
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', nargs='*', type=int,
+                        default=[100, 1000, 10000],
+                        help='synthetic model sizes, in reactions')
+    parser.add_argument('--models', nargs='*', choices=sorted(bundled),
+                        default=sorted(bundled), help='bundled models')
+    parser.add_argument('--cases', nargs='*', choices=sorted(cases),
+                        default=sorted(cases))
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timed repeats after the first call (default: 5)')
+    parser.add_argument('--baseline', default=default_baseline)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed fractional increase of times and '
+                        'memory (default: 0.5)')
+    parser.add_argument('--size-tolerance', type=float, default=0.01,
+                        help='allowed fractional change of output sizes, 0 '
+                        'for exact (default: 0.01)')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.models, args.cases, args.repeat)
+
+    if args.save:
+        # Keep the entries of cases that were not run this time
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)['results']
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'cobra': cobra.__version__,
+                       'machine': platform.machine(),
+                       'results': baseline}, f, indent=1, sort_keys=True)
+            f.write('\n')
+        print('Saved {} results to {}'.format(len(baseline), args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}; run with --save to create one'.format(
+            args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+
+    regressions = compare(results, baseline, args.tolerance,
+                          args.size_tolerance)
+    for key, metric, previous, current in regressions:
+        print('REGRESSION {:<36s} {:<12s} {:>14.6g} -> {:<14.6g} '
+              '({:+.0%})'.format(key, metric, previous, current,
+                                 current / float(previous) - 1
+                                 if previous else float('inf')))
+    print('{} results, {} compared to the baseline, {} regressions'.format(
+        len(results), len(set(results) & set(baseline)), len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Random genome-scale-like models for benchmarking. Reactions connect 1-3
+substrates to 1-3 products, mostly in the cytosol; a fraction are transport
+reactions between compartments, and about a third carry a cofactor pair
+(atp/adp, nad/nadh, ...) with protons and water, as in curated models.
+
+    from synthetic import random_model, random_fluxes
+    model = random_model(1000)
+    fluxes = random_fluxes(model)
+"""
+
+import numpy as np
+import pandas as pd
+from cobra.io import model_from_dict
+
+compartments = ['c', 'p', 'e']
+
+# Cofactor pairs (consumed, produced) and the small molecules that
+# accompany them
+cofactor_pairs = [('atp', 'adp'), ('nad', 'nadh'), ('nadp', 'nadph'),
+                  ('q8', 'q8h2'), ('coa', 'accoa'), ('adp', 'amp')]
+small_molecules = ['h', 'h2o', 'pi', 'co2', 'nh4', 'o2']
+
+
+def random_model(n_reactions, n_compartments=3, cofactor_density=0.35,
+                 transport_fraction=0.1, seed=0):
+    """Return a cobra.Model with `n_reactions` random reactions.
+
+    n_compartments: int
+        Number of compartments used, from 'c', 'p' and 'e'.
+
+    cofactor_density: float
+        Fraction of the non-transport reactions carrying a cofactor pair.
+
+    transport_fraction: float
+        Fraction of reactions moving a metabolite between compartments.
+
+    """
+    rng = np.random.RandomState(seed)
+    used = compartments[:n_compartments]
+    n_metabolites = max(int(0.8 * n_reactions), 4)
+
+    metabolites = {}
+
+    def metabolite(base, compartment):
+        met_id = '{}_{}'.format(base, compartment)
+        if met_id not in metabolites:
+            metabolites[met_id] = {
+                'id': met_id, 'name': base.upper(),
+                'compartment': compartment}
+        return met_id
+
+    def compartment():
+        # Most metabolites are cytosolic
+        if rng.rand() < 0.8 or len(used) == 1:
+            return used[0]
+        return used[rng.randint(1, len(used))]
+
+    reactions = []
+    for i in range(n_reactions):
+        stoichiometry = {}
+        if len(used) > 1 and rng.rand() < transport_fraction:
+            base = 'M{}'.format(rng.randint(n_metabolites))
+            source, target = rng.choice(len(used), 2, replace=False)
+            stoichiometry[metabolite(base, used[source])] = -1
+            stoichiometry[metabolite(base, used[target])] = 1
+            if rng.rand() < 0.5:
+                stoichiometry[metabolite('h', used[source])] = -1
+                stoichiometry[metabolite('h', used[target])] = 1
+        else:
+            comp = compartment()
+            n_in, n_out = rng.randint(1, 4, size=2)
+            bases = rng.choice(n_metabolites, n_in + n_out, replace=False)
+            for j, base in enumerate(bases):
+                stoichiometry[metabolite('M{}'.format(base), comp)] = (
+                    -1 if j < n_in else 1)
+            if rng.rand() < cofactor_density:
+                consumed, produced = cofactor_pairs[
+                    rng.randint(len(cofactor_pairs))]
+                stoichiometry[metabolite(consumed, comp)] = -1
+                stoichiometry[metabolite(produced, comp)] = 1
+                for base in rng.choice(small_molecules, 2, replace=False):
+                    met_id = metabolite(base, comp)
+                    stoichiometry.setdefault(met_id, int(
+                        rng.choice([-1, 1])))
+
+        reversible = rng.rand() < 0.3
+        knocked_out = rng.rand() < 0.01
+        reactions.append({
+            'id': 'R{}'.format(i), 'name': 'Reaction {}'.format(i),
+            'metabolites': stoichiometry,
+            'lower_bound': 0 if knocked_out else (
+                -1000 if reversible else 0),
+            'upper_bound': 0 if knocked_out else 1000,
+            'gene_reaction_rule': '',
+        })
+
+    return model_from_dict({
+        'id': 'synthetic_{}'.format(n_reactions),
+        'metabolites': list(metabolites.values()),
+        'reactions': reactions,
+        'genes': [],
+        'compartments': {c: c for c in used},
+    })
+
+
+def random_fluxes(cobra_model, zero_fraction=0.4, seed=0):
+    """A flux pandas.Series for the model's reactions, with `zero_fraction`
+    of the reactions inactive and the rest lognormal with random sign for
+    reversible reactions"""
+    rng = np.random.RandomState(seed)
+    n = len(cobra_model.reactions)
+    fluxes = rng.lognormal(0, 1.5, size=n)
+    reversible = np.array([r.lower_bound < 0 for r in cobra_model.reactions])
+    fluxes[reversible & (rng.rand(n) < 0.5)] *= -1
+    fluxes[rng.rand(n) < zero_fraction] = 0
+    fluxes[np.array([r.bounds == (0, 0) for r in cobra_model.reactions])] = 0
+    return pd.Series(fluxes, index=[r.id for r in cobra_model.reactions])
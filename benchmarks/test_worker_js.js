@@ -0,0 +1,265 @@
+// Check the messages passed between the page and the layout Web Worker in
+// d3flux.js (worker_layout and layout_worker), and time the 'init' message
+// on synthetic graphs of increasing size.
+//
+//     node benchmarks/test_worker_js.js
+//
+// Both sides are run in vm contexts with stub Worker, cola and browser
+// globals, so no browser or network access is needed. Exits non-zero on the
+// first failed check.
+
+var assert = require('assert');
+var fs = require('fs');
+var path = require('path');
+var vm = require('vm');
+
+var library = fs.readFileSync(
+  path.join(__dirname, '..', 'd3flux', 'templates', 'd3flux.js'), 'utf8');
+
+// Messages posted to the stub worker by the page
+var posted = [];
+
+function StubWorker(url) {
+  // The last worker created receives the page's messages
+  this.url = url;
+  StubWorker.last = this;
+}
+StubWorker.prototype.postMessage = function (msg, transfer) {
+  posted.push({msg: msg, transfer: transfer || []});
+};
+StubWorker.prototype.terminate = function () {};
+
+var d3flux;
+var sandbox = {
+  require: {config: function () {},
+            toUrl: function (name) { return 'lib/' + name; }},
+  define: function (name, deps, factory) {
+    d3flux = factory(null, null, null, null, null);
+  },
+  Worker: StubWorker,
+  Blob: function (parts) { this.parts = parts; },
+  URL: function (url, base) { this.href = base + url; },
+  document: {baseURI: 'http://localhost/'}
+};
+sandbox.URL.createObjectURL = function () { return 'blob:layout'; };
+vm.runInNewContext(library, sandbox);
+
+function same(actual, expected) {
+  // Deep equality across vm contexts, whose objects have other prototypes
+  assert.deepStrictEqual(JSON.parse(JSON.stringify(actual)),
+                         JSON.parse(JSON.stringify(expected)));
+}
+
+function synthetic_graph(n_nodes) {
+  // A chain of nodes, each also linked to the node n / 2 further on
+  var nodes = [], links = [];
+  for (var i = 0; i < n_nodes; i++) {
+    nodes.push({id: 'n' + i, x: i, y: 2 * i});
+  }
+  for (var j = 0; j + 1 < n_nodes; j++) {
+    links.push({source: nodes[j], target: nodes[j + 1]});
+    links.push({source: nodes[j],
+                target: nodes[(j + Math.floor(n_nodes / 2)) % n_nodes]});
+  }
+  return {nodes: nodes, links: links};
+}
+
+function start_page(graph) {
+  posted = [];
+  var events = [],
+  layout = d3flux.worker_layout()
+    .linkDistance(40)
+    .size([800, 600])
+    .flowLayout('y', 25)
+    .nodes(graph.nodes)
+    .links(graph.links)
+    .on('tick', function () { events.push('tick'); })
+    .on('end', function () { events.push('end'); })
+    .start(10, 0, 20, 0, true);
+  return {layout: layout, events: events};
+}
+
+function check_page() {
+  // The page numbers the nodes and sends links as node indices
+  var graph = synthetic_graph(6);
+  graph.nodes[2].fixed = 1;
+  var page = start_page(graph),
+  init = posted[0].msg;
+
+  assert.strictEqual(posted.length, 1);
+  assert.strictEqual(init.type, 'init');
+  assert.strictEqual(init.cola_url, 'http://localhost/lib/cola.js');
+  same(init.size, [800, 600]);
+  assert.strictEqual(init.link_distance, 40);
+  same(init.flow, {axis: 'y', gap: 25});
+  same(init.iterations, [10, 0, 20, 0]);
+  assert.strictEqual(init.keep_running, true);
+  graph.links.forEach(function (l, i) {
+    assert.strictEqual(init.links[i].source, graph.nodes.indexOf(l.source));
+    assert.strictEqual(init.links[i].target, graph.nodes.indexOf(l.target));
+  });
+  same(init.nodes.map(function (v) { return v.fixed; }),
+                         [0, 0, 1, 0, 0, 0]);
+
+  // Index links are passed through unchanged
+  posted = [];
+  d3flux.worker_layout().nodes(graph.nodes)
+    .links([{source: 0, target: 5}]).start();
+  same(posted[0].msg.links, [{source: 0, target: 5}]);
+
+  // Position snapshots are copied into the nodes, except into nodes being
+  // dragged, and fire the listeners
+  var positions = new Float64Array(12);
+  for (var i = 0; i < 12; i++) { positions[i] = 100 + i; }
+  graph.nodes[3].fixed = 2;
+  graph.nodes[3].x = -1;
+  page.layout.stop();
+  page = start_page(graph);
+  var worker = StubWorker.last;
+  worker.onmessage({data: {type: 'tick', positions: positions}});
+  same(page.events, ['tick']);
+  assert.strictEqual(graph.nodes[0].x, 100);
+  assert.strictEqual(graph.nodes[5].y, 111);
+  assert.strictEqual(graph.nodes[3].x, -1);
+  worker.onmessage({data: {type: 'end', positions: positions}});
+  same(page.events, ['tick', 'end']);
+
+  // Dragging sends the node's index and fixed flags
+  posted = [];
+  var d = graph.nodes[4];
+  page.layout.drag_node(d, 'start');
+  page.layout.drag_node(d, 'drag', 5, 6);
+  same(posted[0].msg,
+                         {type: 'fix', index: 4, fixed: 2, x: 5, y: 6});
+  page.layout.drag_node(d, 'end');
+  same(posted[1].msg,
+                         {type: 'fix', index: 4, fixed: 0, x: 5, y: 6});
+
+  // Resuming sends whether each node is fixed, and its position, as
+  // transferables
+  posted = [];
+  page.layout.resume();
+  var resume = posted[0];
+  assert.strictEqual(resume.msg.type, 'resume');
+  same(Array.from(resume.msg.fixed), [0, 0, 1, 1, 0, 0]);
+  assert.strictEqual(resume.msg.positions[8], 5);
+  assert.strictEqual(resume.transfer.length, 2);
+}
+
+function check_worker() {
+  // The worker builds a cola.Layout from the 'init' message and posts
+  // positions back as interleaved x, y Float64Arrays
+  var replies = [], calls = [], timers = [];
+
+  function StubLayout() {
+    this.converge_after = 3;
+  }
+  ['linkDistance', 'size', 'links'].forEach(function (name) {
+    StubLayout.prototype[name] = function (x) {
+      calls.push([name, x]);
+      return this;
+    };
+  });
+  StubLayout.prototype.nodes = function (x) {
+    calls.push(['nodes', x]);
+    this.nodes_ = x;
+    return this;
+  };
+  StubLayout.prototype.flowLayout = function (axis, gap) {
+    calls.push(['flowLayout', axis, gap]);
+    return this;
+  };
+  StubLayout.prototype.start = function (a, b, c, d, keep_running) {
+    calls.push(['start', a, b, c, d, keep_running]);
+    if (keep_running) { this.kick(); }
+    return this;
+  };
+  StubLayout.prototype.resume = function () { this.kick(); };
+  StubLayout.prototype.tick = function () {
+    this.nodes_.forEach(function (v) { v.x += 1; });
+    return --this.converge_after <= 0;
+  };
+
+  var scope = {
+    Date: Date,
+    Float64Array: Float64Array,
+    setTimeout: function (fn) { timers.push(fn); },
+    importScripts: function (url) {
+      calls.push(['importScripts', url]);
+      scope.cola = {Layout: StubLayout};
+    }
+  };
+  scope.self = {
+    postMessage: function (msg, transfer) {
+      replies.push({msg: msg, transfer: transfer});
+    }
+  };
+  vm.runInNewContext('(' + d3flux.layout_worker.toString() + ')()', scope);
+
+  var nodes = [{x: 0, y: 10, fixed: 0}, {x: 1, y: 11, fixed: 1}];
+  scope.self.onmessage({data: {
+    type: 'init', cola_url: 'cola.js', nodes: nodes,
+    links: [{source: 0, target: 1}], size: [10, 20], link_distance: 30,
+    flow: {axis: 'x', gap: 5}, iterations: [1, 2, 3, 4], keep_running: true
+  }});
+
+  same(calls[0], ['importScripts', 'cola.js']);
+  same(calls.slice(1), [
+    ['linkDistance', 30], ['size', [10, 20]], ['nodes', nodes],
+    ['links', [{source: 0, target: 1}]], ['flowLayout', 'x', 5],
+    ['start', 1, 2, 3, 4, true]]);
+
+  // Runs until the layout converges, yielding between slices
+  while (timers.length) { timers.shift()(); }
+  var types = replies.map(function (r) { return r.msg.type; });
+  assert.strictEqual(types[types.length - 1], 'end');
+  var last = replies[replies.length - 1];
+  assert.ok(last.msg.positions instanceof Float64Array);
+  same(Array.from(last.msg.positions),
+                         [nodes[0].x, 10, nodes[1].x, 11]);
+  assert.strictEqual(last.transfer[0], last.msg.positions.buffer);
+
+  // 'fix' pins a node at the given position and resumes
+  replies.length = 0;
+  StubLayout.prototype.converge_after = 1;
+  scope.self.onmessage({data: {type: 'fix', index: 0, fixed: 2, x: 7,
+                               y: 8}});
+  while (timers.length) { timers.shift()(); }
+  assert.strictEqual(nodes[0].fixed, 2);
+  assert.strictEqual(nodes[0].y, 8);
+  assert.strictEqual(nodes[0].py, 8);
+
+  // 'resume' applies every node's fixed flag and position
+  scope.self.onmessage({data: {type: 'resume', fixed: [1, 0],
+                               positions: [3, 4, 5, 6]}});
+  while (timers.length) { timers.shift()(); }
+  assert.strictEqual(nodes[0].fixed, 1);
+  assert.strictEqual(nodes[0].y, 4);
+  assert.strictEqual(nodes[1].fixed, 0);
+}
+
+function time(fn, repeats) {
+  fn();  // warm up
+  var start = process.hrtime.bigint();
+  for (var i = 0; i < repeats; i++) {
+    fn();
+  }
+  return Number(process.hrtime.bigint() - start) / 1E6 / repeats;
+}
+
+check_page();
+check_worker();
+console.log('worker protocol: ok');
+
+console.log('nodes     links   init message (ms)   per 1k links');
+[2500, 5000, 10000, 20000].forEach(function (n) {
+  var graph = synthetic_graph(n),
+  init = time(function () { start_page(graph); }, 5);
+
+  console.log([
+    String(n).padStart(5),
+    String(graph.links.length).padStart(9),
+    init.toFixed(1).padStart(19),
+    (1000 * init / graph.links.length).toFixed(3).padStart(14)
+  ].join(' '));
+});
@@ -1,2 +1,3 @@
-from d3flux.core.flux_layouts import flux_map
+from d3flux.core.flux_layouts import (
+    flux_map, flux_map_grid, flux_svg, init_notebook_mode)
 from d3flux.core.display_tools import *
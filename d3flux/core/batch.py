@@ -0,0 +1,355 @@
+"""
+Batch rendering of many models and flux solutions in parallel, and the
+`d3flux` command line entry point.
+
+    d3flux model1.json model2.json --fluxes 'fluxes/{model}_*.csv' \\
+        --format html svg --output maps/ --processes 8
+
+Each flux table is a CSV of reactions (rows) by solutions (columns). One
+figure is written per model and solution to OUTPUT/<model>/<table>_<column>,
+and the time taken for each file is reported when all are done. Models with
+the same file name in different directories are written to directories
+prefixed with their parent directories, e.g. OUTPUT/a_model and
+OUTPUT/b_model.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+from cobra.io import load_json_model
+
+from d3flux.core.cache import LRUCache
+from d3flux.core.flux_layouts import flux_map, flux_svg
+from d3flux.core.layout_cache import LayoutCache
+from d3flux.core.payload import load_map_info
+from d3flux.core.template_cache import get_template
+
+# Models, flux tables and layout caches loaded by this worker process,
+# reused across the solutions it renders. Jobs never span more than one
+# model, so only the most recent models and tables need to be kept.
+_models = LRUCache(maxsize=4)
+_tables = LRUCache(maxsize=16)
+_layout_caches = {}
+
+# Layout sources other than a JSON map or a layout cache directory
+LAYOUTS = ('model', 'python', 'incremental')
+
+
+def figure_id(*keys):
+    """Figure id derived from the job's model, table and column, so ids are
+    unique across worker processes without a shared counter"""
+    digest = hashlib.sha1('\0'.join(keys).encode('utf-8')).hexdigest()
+    return 'd3flux' + digest[:12]
+
+
+def _safe_name(name):
+    return re.sub(r'[^\w.-]+', '_', str(name)).strip('_') or 'solution'
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def output_names(model_paths):
+    """The output directory name of each model path, as a dict: the file
+    name without extension, prefixed with as many parent directories as
+    needed to tell apart different files with the same name"""
+    groups = {}
+    for model_path in model_paths:
+        groups.setdefault(_stem(model_path), set()).add(
+            os.path.normpath(os.path.abspath(model_path)))
+
+    full_names = {}
+    for stem, paths in groups.items():
+        parents = {path: os.path.dirname(path).split(os.sep)
+                   for path in paths}
+        depth = 0
+        while True:
+            names = {path: _safe_name('_'.join(
+                parents[path][len(parents[path]) - depth:] + [stem]))
+                for path in paths}
+            if len(set(names.values())) == len(paths) or depth > max(
+                    len(parts) for parts in parents.values()):
+                break
+            depth += 1
+        full_names.update(names)
+
+    names = {model_path: full_names[os.path.normpath(
+        os.path.abspath(model_path))] for model_path in model_paths}
+    if len(set(names.values())) < len(set(full_names)):
+        raise ValueError('Models would be written to the same directory: '
+                         '{}'.format(', '.join(sorted(model_paths))))
+    return names
+
+
+def _load_model(model_path, layout):
+    key = (model_path, layout)
+    cobra_model = _models.get(key)
+    if cobra_model is None:
+        cobra_model = load_json_model(model_path)
+        if layout is not None and layout.endswith('.json'):
+            load_map_info(cobra_model, layout)
+        _models[key] = cobra_model
+    return cobra_model
+
+
+def _load_table(table_path):
+    table = _tables.get(table_path)
+    if table is None:
+        table = pd.read_csv(table_path, index_col=0)
+        _tables[table_path] = table
+    return table
+
+
+def check_layout(layout):
+    """Return the layout source if it is one of LAYOUTS, an existing JSON
+    map or an existing layout cache directory, else raise ValueError"""
+    if layout in LAYOUTS or (layout.endswith('.json') and
+                             os.path.isfile(layout)) or os.path.isdir(layout):
+        return layout
+    raise ValueError(
+        "Unknown layout {!r}: expected one of {}, a saved JSON map or a "
+        "layout cache directory".format(layout, ', '.join(LAYOUTS)))
+
+
+def _layout_kwargs(layout):
+    """flux_map arguments for a layout source: 'model' or None (stored
+    positions only), 'python', 'incremental', a map_info JSON file (applied
+    on load), or a layout cache directory"""
+    if layout is None or layout == 'model':
+        return {}
+    check_layout(layout)
+    if layout in ('python', 'incremental'):
+        return {'layout': layout}
+    if os.path.isdir(layout):
+        if layout not in _layout_caches:
+            _layout_caches[layout] = LayoutCache(layout)
+        return {'layout': 'python', 'layout_cache': _layout_caches[layout]}
+    return {}
+
+
+def render_solutions(model_path, solutions, output, formats=('html',),
+                     layout=None, options=None, name=None):
+    """Render one model under several flux solutions, loading the model
+    once.
+
+    model_path: str
+        Path of the JSON model
+
+    solutions: list of (table_path, column)
+        Flux tables and the column of each to render. A table_path of None
+        renders the fluxes stored in the model, if any.
+
+    output: str
+        Output directory. Files are written to output/<name>/.
+
+    formats: 'html' and/or 'svg'
+
+    layout: str
+        The layout source, see `_layout_kwargs`.
+
+    options: dict
+        Additional keyword arguments for `flux_map` and `flux_svg`.
+
+    name: str
+        Name of the model's output directory. Defaults to the model's file
+        name without extension (see `output_names`).
+
+    Returns a list of (filename, seconds, bytes) for the files written.
+
+    """
+    kwargs = dict(options or {})
+    kwargs.update(_layout_kwargs(layout))
+
+    start = time.time()
+    cobra_model = _load_model(model_path, layout)
+    load_time = time.time() - start
+
+    directory = os.path.join(output, name or _stem(model_path))
+    try:
+        os.makedirs(directory)
+    except OSError:
+        # Created by another worker
+        if not os.path.isdir(directory):
+            raise
+
+    results = []
+    for table_path, column in solutions:
+        if table_path is None:
+            flux_dict, name = None, 'model'
+        else:
+            flux_dict = _load_table(table_path)[column]
+            name = '{}_{}'.format(_stem(table_path), column)
+        basename = os.path.join(directory, _safe_name(name))
+        fig_id = figure_id(model_path, str(table_path), str(column))
+
+        for fmt in formats:
+            start = time.time()
+            if fmt == 'svg':
+                content = flux_svg(cobra_model, flux_dict=flux_dict,
+                                   figure_id=fig_id, **kwargs)
+            else:
+                figure = flux_map(cobra_model, flux_dict=flux_dict,
+                                  figure_id=fig_id, include_library=True,
+                                  **kwargs)
+                content = get_template('page_template.html').render(
+                    title=name, figure=figure.data)
+
+            filename = basename + '.' + fmt
+            with open(filename, 'w') as f:
+                f.write(content)
+
+            # The model load is charged to the first file written
+            elapsed = time.time() - start + load_time
+            load_time = 0.
+            results.append((filename, elapsed, len(content)))
+
+    return results
+
+
+def _run_job(job):
+    return render_solutions(*job)
+
+
+def plan_jobs(model_paths, flux_patterns=None, chunks=1):
+    """Split the models x solutions into jobs of (model_path, solutions).
+
+    flux_patterns: list of str
+        Flux table paths or glob patterns. '{model}' is replaced by each
+        model's file name without extension, so every model can have its
+        own tables. Without any tables, each model is rendered once.
+
+    chunks: int
+        The total number of jobs to aim for. Jobs never span more than one
+        model, so each model is loaded at most once per job.
+
+    Raises ValueError if two different tables of a model have the same file
+    name, as their figures would be written to the same files.
+
+    """
+    per_model = []
+    for model_path in model_paths:
+        solutions = []
+        tables = {}
+        for pattern in flux_patterns or []:
+            for table_path in sorted(glob.glob(
+                    pattern.replace('{model}', _stem(model_path)))):
+                other = tables.setdefault(_stem(table_path), table_path)
+                if os.path.abspath(other) != os.path.abspath(table_path):
+                    raise ValueError(
+                        'Flux tables {} and {} of {} have the same file '
+                        'name'.format(other, table_path, model_path))
+                if other is not table_path:
+                    continue
+                columns = pd.read_csv(table_path, index_col=0,
+                                      nrows=0).columns
+                solutions += [(table_path, column) for column in columns]
+        if not flux_patterns:
+            solutions = [(None, None)]
+        per_model.append((model_path, solutions))
+
+    total = sum(len(solutions) for _, solutions in per_model)
+    size = max(1, int(math.ceil(total / float(max(chunks, 1)))))
+    return [(model_path, solutions[i:i + size])
+            for model_path, solutions in per_model
+            for i in range(0, len(solutions), size)]
+
+
+def render_batch(model_paths, flux_patterns=None, output='.',
+                 formats=('html',), layout=None, options=None,
+                 processes=None):
+    """Render every model under each of its flux solutions with a process
+    pool (see `plan_jobs` and `render_solutions`). Returns the list of
+    (filename, seconds, bytes) for all files written."""
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if layout is not None:
+        check_layout(layout)
+    names = output_names(model_paths)
+    jobs = [job + (output, tuple(formats), layout, options, names[job[0]])
+            for job in plan_jobs(model_paths, flux_patterns, 4 * processes)]
+
+    if processes == 1:
+        return [result for job in jobs for result in _run_job(job)]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        return [result for results in pool.imap_unordered(_run_job, jobs)
+                for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _parse_option(text):
+    key, _, value = text.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return key.strip(), value
+
+
+def _layout_argument(text):
+    try:
+        return check_layout(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='d3flux', description='Render flux maps for many models and '
+        'flux solutions in parallel.')
+    parser.add_argument('models', nargs='+', help='JSON model files')
+    parser.add_argument(
+        '--fluxes', nargs='+', metavar='CSV',
+        help='flux tables (reactions x solutions) or glob patterns. '
+        '{model} is replaced by the model file name.')
+    parser.add_argument('--output', '-o', default='.',
+                        help='output directory (default: .)')
+    parser.add_argument('--format', '-f', nargs='+', dest='formats',
+                        choices=['html', 'svg'], default=['html'])
+    parser.add_argument(
+        '--layout', default='model', type=_layout_argument,
+        help="'model' (stored positions, default), 'python', "
+        "'incremental' (place only new nodes), a saved JSON "
+        "map to take positions from, or a layout cache directory")
+    parser.add_argument('--processes', '-p', type=int, default=None,
+                        help='worker processes (default: CPU count)')
+    parser.add_argument(
+        '--option', action='append', default=[], metavar='KEY=VALUE',
+        help='keyword argument for flux_map, with a JSON value, e.g. '
+        'hide_unused=true')
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    results = render_batch(
+        args.models, args.fluxes, args.output, args.formats,
+        layout=None if args.layout == 'model' else args.layout,
+        options=dict(_parse_option(text) for text in args.option),
+        processes=args.processes)
+    wall = time.time() - start
+
+    for filename, seconds, size in sorted(results):
+        print('{:8.3f} s  {:>10d} B  {}'.format(seconds, size, filename))
+
+    print('{} files in {:.2f} s ({:.1f} files/s, {:.3f} s of rendering per '
+          'file)'.format(len(results), wall, len(results) / max(wall, 1E-9),
+                         sum(r[1] for r in results) / max(len(results), 1)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Small caching utilities shared by the rendering pipeline
+"""
+
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+
+class LRUCache(object):
+    """A size-bounded mapping that discards the least recently used entries
+    once more than `maxsize` items have been stored.
+
+    maxsize: int
+        Maximum number of entries to keep. If None, the cache is unbounded.
+
+    Every lookup, insertion and eviction holds the cache's lock, so the cache
+    may be shared between threads. Computing a missing value is left to the
+    caller, so two threads missing the same key may both compute it; the
+    last one stored is kept.
+
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def _lookup(self, key):
+        """Move key to the most recently used end and return its value, or
+        _missing. Must be called with the lock held."""
+        value = self._data.pop(key, _missing)
+        if value is not _missing:
+            self._data[key] = value
+        return value
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._lookup(key)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def get(self, key, default=None):
+        """Return the cached value for key, updating the hit and miss
+        counters"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is _missing:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
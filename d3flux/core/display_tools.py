@@ -1,27 +1,27 @@
 import pandas as pd
-from functools import reduce
+
+from d3flux.core.model_index import incidence_index
+from d3flux.core.redox import (
+    common_ox_cofactors, redox_balance, redox_groups)
 # TODO: write docstrings
 
 def metabolite_summary(met):
-    return pd.Series({r.id : (r.x * r.metabolites[met]) 
+    return pd.Series({r.id : (r.flux * r.metabolites[met]) 
                       for r in met.reactions}, name='flux')
 
-common_ox_cofactors = ['nad_c', 'nadp_c', 'q8_c']
-
 def redox_summary(cobra_model, tol=1E-8, ox_cofactors=None):
 
     if ox_cofactors == None: ox_cofactors = common_ox_cofactors
     elif not ox_cofactors: return pd.Series(), pd.Series()
 
-    redox_series = reduce(lambda x, y: x.add(y, fill_value=0), (
-            metabolite_summary(cobra_model.metabolites.get_by_id(cofactor))
-            for cofactor in ox_cofactors))
+    redox_series = redox_balance(cobra_model, ox_cofactors=ox_cofactors)[
+        'flux']
     oxidizing = redox_series[redox_series > tol]
     reducing = redox_series[redox_series < -tol]
     return oxidizing, reducing
 
 def color_redox_rxns(cobra_model, reset_groups=True, color_knockouts=True,
-                     starting_group=1, **kwargs):
+                     starting_group=1, column=None, **kwargs):
     """Add group info to the cobra_model according to the results of
     `redox_summary`. 
 
@@ -39,7 +39,17 @@ def color_redox_rxns(cobra_model, reset_groups=True, color_knockouts=True,
         To use different colors, start from a group other than 1. (Highest
         color is 8)
 
-    Additional kwargs are passed directly to the `redox_summary` function call:
+    column: str
+        The solution to color by, when `fluxes` is a DataFrame of several
+        solutions. Defaults to its only column, or to 'fluxes' (as in
+        `cobra.Solution.to_frame()`); a ValueError is raised if neither
+        exists.
+
+    Additional kwargs are passed directly to the `redox_groups` function call:
+
+    fluxes: pandas.DataFrame, dict-like, cobra.Solution or None
+        Flux solutions, see `flux_table`. Defaults to the model's current
+        solution.
 
     tol: int, default 1E-8
         flux tolerance above which to include the reaction
@@ -49,54 +59,55 @@ def color_redox_rxns(cobra_model, reset_groups=True, color_knockouts=True,
         the basis for coloring the flux model.
 
     """
-    # Pop existing group info
-    if reset_groups:
-        for rxn in cobra_model.reactions:
-            try: del rxn.notes['map_info']['group']
-            except KeyError: pass
-
-    # Assign group for knocked out reactions
-    if color_knockouts:
-        for rxn in cobra_model.reactions.query(
-                lambda r: r.bounds == (0, 0), None):
-            rxn.notes['map_info']['group'] = 'ko'
-
-    # Assign new group info based on redox balance
-    oxidizing, reducing = redox_summary(cobra_model, **kwargs)
-    for rxn, flux in oxidizing.items():
-        cobra_model.reactions.get_by_id(
-            rxn).notes['map_info']['group'] = starting_group
-    for rxn, flux in reducing.items():
-        cobra_model.reactions.get_by_id(
-            rxn).notes['map_info']['group'] = starting_group + 1
+    groups = redox_groups(cobra_model, starting_group=starting_group,
+                          color_knockouts=color_knockouts, **kwargs)
+    if column is None:
+        if len(groups.columns) == 1:
+            column = groups.columns[0]
+        elif 'fluxes' in groups.columns:
+            column = 'fluxes'
+        else:
+            raise ValueError(
+                'fluxes has {} columns, pass the one to color by as column=: '
+                '{}'.format(len(groups.columns),
+                            ', '.join(map(str, groups.columns))))
+    elif column not in groups.columns:
+        raise ValueError('{!r} is not a column of fluxes'.format(column))
+    groups = groups[column]
+
+    # Assign the groups in a single pass over the reactions
+    for rxn, group in zip(cobra_model.reactions, groups.values):
+        map_info = rxn.notes.setdefault('map_info', {})
+        if group is not None:
+            map_info['group'] = group
+        elif reset_groups:
+            map_info.pop('group', None)
 
     return cobra_model
 
                                             
-def update_cofactors(cobra_model, cofactor_list):
+def update_cofactors(cobra_model, cofactor_list, settings=None):
     """ Given a model and list of cofactors to display, update the map_info
     field of each reaction containing the given cofactors. Updates the model
     inplace.
     
     cobra_model : a cobra.Model object
-    cofactor_list : a list of strings indicating the desired cofactor IDs to show.
+    cofactor_list : a list of strings indicating the desired cofactor IDs to
+        show. Base IDs (e.g. 'atp') select every compartment variant, and IDs
+        not in the model are ignored, so common_cofactors can be passed as is.
+    settings : display settings (a dict) stored for each new cofactor entry.
+        Cofactors already shown on a reaction are left unchanged.
 
     """
 
-    def rxn_cofactor_update(rxn, cofactor):
-    
-        if 'map_info' not in rxn.notes:
-            rxn.notes['map_info'] = {}
-
-        try:
-            if cofactor in rxn.notes['map_info']['cofactors']: return
-            rxn.notes['map_info']['cofactors'].update({cofactor: {}})
-        except KeyError:
-            rxn.notes['map_info']['cofactors'] = {cofactor: {}}
-
-    for met_id in cofactor_list:
-        this_met = cobra_model.metabolites.get_by_id(met_id)
-        for rxn in this_met.reactions: rxn_cofactor_update(rxn, met_id)
+    index = incidence_index(cobra_model)
+    for rxn_id, met_ids in index.cofactor_reactions(cofactor_list).items():
+        rxn = cobra_model.reactions[index.reaction_index[rxn_id]]
+        cofactors = rxn.notes.setdefault('map_info', {}).setdefault(
+            'cofactors', {})
+        for met_id in met_ids:
+            if met_id not in cofactors:
+                cofactors[met_id] = dict(settings or {})
 
 common_cofactors = ['coa', 'nadh', 'nad', 'nadph', 'nadp', 'atp', 'adp', 'amp',
                     'q8', 'q8h2', 'pi', 'co2', 'h2o', 'h', 'o2', 'h2', 'nh4']
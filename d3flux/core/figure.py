@@ -0,0 +1,136 @@
+"""
+Handle to a rendered flux map, which pushes new flux values to the figure
+already drawn in the notebook instead of re-rendering it.
+"""
+
+import json
+
+import numpy as np
+from IPython.display import HTML, Javascript, display
+
+from d3flux.core.flux_arrays import drawn_fluxes, stoichiometric_matrix
+
+
+class FluxMap(HTML):
+    """The HTML display of a flux map, as returned by `flux_map` and
+    `render_model`.
+
+    Displays like IPython.display.HTML. Calling `update` sends only the
+    changed reaction and metabolite fluxes to the drawn figure, which restyles
+    its links, arrowheads and nodes in place without restarting the layout.
+
+    figure_id: str
+        The id of the rendered figure
+
+    cobra_model: cobra.Model
+        The model the figure was rendered from
+
+    reaction_fluxes, metabolite_fluxes: dict
+        The fluxes currently drawn, by id. None where undefined.
+
+    stats: d3flux.core.profiling.RenderStats
+        Per-stage timings of the python render, if it was profiled (see
+        `flux_map`), else None. Browser timings are in the figure div's
+        data-d3flux-stats attribute.
+
+    layout_diff: dict
+        The nodes placed or moved by a python layout (see
+        d3flux.core.layout.layout_diff), or None if none was run.
+
+    cache_key: str
+        The render cache fingerprint of the figure, if it was rendered with
+        a cache (see `flux_map`), else None.
+
+    send: function
+        Delivers update messages to the browser. Defaults to executing a
+        small javascript output in the notebook; may be replaced, e.g., with
+        a websocket or comm send method.
+
+    """
+
+    def __init__(self, html, figure_id, cobra_model, reaction_fluxes,
+                 metabolite_fluxes):
+        super(FluxMap, self).__init__(html)
+        self.figure_id = figure_id
+        self.cobra_model = cobra_model
+        self.reaction_fluxes = reaction_fluxes
+        self.metabolite_fluxes = metabolite_fluxes
+        self.stats = None
+        self.layout_diff = None
+        self.cache_key = None
+        self.send = self._display_message
+        self._stoichiometry = None
+        self._display_handle = None
+
+    @classmethod
+    def from_model_data(cls, html, figure_id, cobra_model, model_data):
+        """Create the handle from the model dictionary that was rendered"""
+
+        def fluxes(objs):
+            return {obj['id']: obj.get('notes', {}).get('map_info', {}).get(
+                'flux') for obj in objs}
+
+        return cls(html, figure_id, cobra_model,
+                   fluxes(model_data['reactions']),
+                   fluxes(model_data['metabolites']))
+
+    def update(self, flux_dict=None, metabolite_dict=None):
+        """Send new fluxes to the drawn figure.
+
+        flux_dict, metabolite_dict:
+            As in `create_model_dict`. If flux_dict is None, the fluxes are
+            read from the model's most recent solution.
+
+        Returns the message sent to the figure.
+
+        """
+        reaction_ids = [r.id for r in self.cobra_model.reactions]
+        if set(reaction_ids) != set(self.reaction_fluxes):
+            raise ValueError('The model reactions have changed since the '
+                             'figure was rendered; call flux_map again')
+
+        if self._stoichiometry is None:
+            self._stoichiometry = stoichiometric_matrix(self.cobra_model)
+
+        fluxes, met_fluxes = drawn_fluxes(
+            self.cobra_model, flux_dict, metabolite_dict,
+            stoichiometry=self._stoichiometry)
+
+        message = {
+            'figure_id': self.figure_id,
+            'reactions': self._changes(self.reaction_fluxes, reaction_ids,
+                                       fluxes),
+            'metabolites': self._changes(
+                self.metabolite_fluxes,
+                [m.id for m in self.cobra_model.metabolites], met_fluxes),
+        }
+
+        if message['reactions'] or message['metabolites']:
+            self.send(message)
+
+        return message
+
+    @staticmethod
+    def _changes(current, ids, values):
+        """Update the current {id: flux} dictionary, returning only the
+        entries that changed"""
+        changes = {}
+        for obj_id, value in zip(ids, values):
+            value = None if np.isnan(value) else float(value)
+            if current.get(obj_id) != value:
+                changes[obj_id] = current[obj_id] = value
+        return changes
+
+    def _display_message(self, message):
+        """Deliver the message by executing javascript in a single, reused
+        notebook output."""
+
+        js = ("var figures = window.d3flux_figures || {{}};\n"
+              "if ('{0}' in figures) {{ figures['{0}']({1}); }}").format(
+                  self.figure_id, json.dumps(message, allow_nan=False))
+
+        if self._display_handle is None:
+            self._display_handle = display(
+                Javascript(js), display_id=self.figure_id + '_update')
+        else:
+            self._display_handle.update(Javascript(js))
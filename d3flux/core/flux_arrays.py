@@ -0,0 +1,162 @@
+"""
+Vectorized flux and stoichiometry helpers. These pull the flux solution and
+the model's stoichiometry once per render, rather than querying the solver
+for every reaction and metabolite in the model.
+"""
+
+from operator import attrgetter
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from cobra.core.solution import get_solution
+from cobra.exceptions import OptimizationError
+
+
+def _ids(objs):
+    """Ids of cobra objects, read from their attribute rather than the id
+    property"""
+    return list(map(attrgetter('_id'), objs))
+
+
+def _to_array(ids, values):
+    """Align a dict-like object of values to the list of ids, returning a
+    float array. Missing or non-numeric entries are returned as NaN."""
+
+    if isinstance(values, pd.Series):
+        values = values[~values.index.duplicated()].reindex(ids)
+
+    else:
+        def lookup(key):
+            try:
+                return values[key]
+            except (KeyError, IndexError):
+                return None
+
+        values = pd.Series([lookup(key) for key in ids], index=ids,
+                           dtype=object)
+
+    return pd.to_numeric(values, errors='coerce').values.astype(float)
+
+
+def get_flux_vector(cobra_model, flux_dict=None):
+    """Return the flux through each reaction in the model as a float array,
+    ordered as `cobra_model.reactions`. Reactions without a defined flux are
+    returned as NaN.
+
+    cobra_model: a cobra.Model object
+
+    flux_dict: dict-like, pandas.Series, or cobra.Solution
+        An external flux solution. If None, the fluxes are read from the
+        model's current solver state in a single pass. If the model hasn't
+        been solved, all fluxes are NaN.
+
+    """
+    reaction_ids = _ids(cobra_model.reactions)
+
+    if flux_dict is None:
+        try:
+            flux_dict = get_solution(cobra_model, raise_error=True)
+        except (OptimizationError, RuntimeError):
+            # The model hasn't been solved
+            return np.full(len(reaction_ids), np.nan)
+
+    # Accept cobra.Solution objects directly
+    if hasattr(flux_dict, 'fluxes'):
+        flux_dict = flux_dict.fluxes
+
+    return _to_array(reaction_ids, flux_dict)
+
+
+def get_metabolite_vector(cobra_model, metabolite_dict):
+    """Return the values of `metabolite_dict` as a float array, ordered as
+    `cobra_model.metabolites`. Missing metabolites are returned as NaN."""
+
+    return _to_array(_ids(cobra_model.metabolites), metabolite_dict)
+
+
+def stoichiometric_matrix(cobra_model):
+    """Build the (metabolites x reactions) stoichiometric matrix of the model
+    as a scipy.sparse.csr_matrix. Rows and columns follow the order of
+    `cobra_model.metabolites` and `cobra_model.reactions`."""
+
+    rows, cols, coeffs = [], [], []
+    for j, reaction in enumerate(cobra_model.reactions):
+        for metabolite, coeff in reaction.metabolites.items():
+            rows.append(cobra_model.metabolites.index(metabolite.id))
+            cols.append(j)
+            coeffs.append(coeff)
+
+    return sparse.csr_matrix(
+        (np.array(coeffs, dtype=float), (rows, cols)),
+        shape=(len(cobra_model.metabolites), len(cobra_model.reactions)))
+
+
+def metabolite_throughput(stoichiometry, fluxes):
+    """Calculate the flux carried by each metabolite as |S|.|v| / 2, i.e.,
+    half the total flux through each metabolite's reactions.
+
+    stoichiometry: scipy.sparse matrix
+        (metabolites x reactions) matrix from `stoichiometric_matrix`
+
+    fluxes: array
+        Reaction fluxes from `get_flux_vector`. Metabolites that participate
+        in any reaction with a NaN flux are returned as NaN.
+
+    """
+    return abs(stoichiometry).dot(np.abs(fluxes)) / 2
+
+
+def reaction_bounds(cobra_model):
+    """Return the (lower, upper) bounds of each reaction as a (reactions x
+    2) float array, read from the reactions' attributes rather than the
+    bounds properties"""
+    reactions = cobra_model.reactions
+    bounds = np.empty((len(reactions), 2))
+    bounds[:, 0] = np.fromiter(map(attrgetter('_lower_bound'), reactions),
+                               dtype=float, count=len(reactions))
+    bounds[:, 1] = np.fromiter(map(attrgetter('_upper_bound'), reactions),
+                               dtype=float, count=len(reactions))
+    return bounds
+
+
+def knocked_out(bounds):
+    """Reactions with bounds of (0, 0), from `reaction_bounds`"""
+    return (bounds[:, 0] == 0) & (bounds[:, 1] == 0)
+
+
+def drawn_fluxes(cobra_model, flux_dict=None, metabolite_dict=None,
+                 stoichiometry=None):
+    """Return the reaction and metabolite fluxes as they are stored in
+    map_info for rendering: NaN where undefined (including knocked-out
+    reactions), and zero below the 1E-8 threshold.
+
+    stoichiometry: scipy.sparse matrix
+        Optional precomputed result of `stoichiometric_matrix`, reused when
+        drawing several flux solutions on the same model.
+
+    """
+    fluxes = get_flux_vector(cobra_model, flux_dict)
+
+    if metabolite_dict is not None:
+        met_fluxes = get_metabolite_vector(cobra_model, metabolite_dict)
+    else:
+        if stoichiometry is None:
+            stoichiometry = stoichiometric_matrix(cobra_model)
+        met_fluxes = metabolite_throughput(stoichiometry, fluxes)
+
+    knockouts = knocked_out(reaction_bounds(cobra_model))
+
+    with np.errstate(invalid='ignore'):
+        rxn_fluxes = np.where(np.abs(fluxes) < 1E-8, 0., fluxes)
+        met_fluxes = np.where(met_fluxes > 1E-8, met_fluxes,
+                              np.where(np.isnan(met_fluxes), np.nan, 0.))
+
+    rxn_fluxes[knockouts] = np.nan
+    return rxn_fluxes, met_fluxes
+
+
+def to_json_list(values):
+    """Convert a float array to a list with None in place of NaN"""
+    return [None if np.isnan(value) else float(value) for value in values]
@@ -3,26 +3,47 @@ A D3-based network layout engine for plotting model solutions in the jupyter
 window
 """
 
-import os
 import json
-import itertools
-import re
+import os
+import threading
 
-from jinja2 import Environment, FileSystemLoader
+import numpy as np
 from IPython.display import HTML
-from csscompressor import compress
 
 from cobra.io.json import model_to_dict
-from cobra.exceptions import OptimizationError
 
-import d3flux
+from d3flux.core.template_cache import (
+    get_template, render_css, load_background_svg, load_library,
+    template_dir)
+from d3flux.core.flux_arrays import (
+    drawn_fluxes, knocked_out, reaction_bounds, to_json_list)
+from d3flux.core.layout import layout_model
+from d3flux.core.svg_export import model_svg
+from d3flux.core.model_index import incidence_index
+from d3flux.core.figure import FluxMap
+from d3flux.core.profiling import profiled, record_size, stage
+from d3flux.core.render_cache import (
+    default_cache, fingerprint, overlay_digest, FIGURE_ID_PLACEHOLDER)
+from d3flux.core.payload import (
+    renderer_dict, compact_payload, encode_payload, OVERLAY_FORMAT)
+from d3flux.core.subsystems import (
+    collapse_model, collapsed_payload, reaction_groups)
+from d3flux.core.samples import (
+    add_sample_channels, is_summary, summarize_samples, summary_digest)
 
 def flux_map(cobra_model,
              excluded_metabolites=None, excluded_reactions=None,
              excluded_compartments=None, display_name_format=True,
-             overwrite_reversibility=True, **kwargs):
+             overwrite_reversibility=True, collapse_hidden=False,
+             groups=None, profile=False, **kwargs):
     """Create a flux map representation of the cobra.Model, including or
-    excluding the given metabolites, reactions, and/or compartments.
+    excluding the given metabolites, reactions, and/or compartments. Returns
+    a FluxMap, whose `update(flux_dict, metabolite_dict)` method pushes new
+    fluxes to the already-drawn figure.
+
+    The model is not modified: hidden flags, display names and fluxes are
+    computed in a separate overlay (see `map_info_overlay`), so flux_map may
+    be called inside `with model:` blocks without copying the model.
 
     excluded_metabolites:
         A list of metabolites to not include. Probably better to simply set
@@ -37,6 +58,22 @@ def flux_map(cobra_model,
     diplay_name_format: Bool or function
         How to format the metabolite names in map.display_name.
 
+    collapse_hidden:
+        Also hide the dead-end metabolites left by the exclusions (those no
+        longer both produced and consumed), repeating until nothing changes
+        so that dead-end chains are removed. Defaults to False.
+
+    groups: dict-like
+        Reaction groups to draw, by reaction id, e.g. a column of
+        `d3flux.core.redox.redox_groups`. Groups set the reaction colors and
+        replace any group stored in the reaction's map_info; None or NaN
+        removes it. Reactions that aren't listed keep their stored group.
+
+    profile:
+        If True, time each stage of the render and attach the resulting
+        d3flux.core.profiling.RenderStats to the figure as `figure.stats`.
+        Defaults to False. See also d3flux.core.profiling.profile.
+
     Additional kwargs are passed directly to `render_model`:
 
     background_template:
@@ -85,89 +122,403 @@ def flux_map(cobra_model,
         whether or not to use the webcola's flow layout to force a heirarchical
         diagram
 
+    layout:
+        If 'python', compute node positions with the stress-majorization
+        layout engine in d3flux.core.layout before rendering. Stored map_info
+        positions are kept fixed. Defaults to None, which leaves unplaced
+        nodes to the cola layout in the browser. Computed positions are only
+        embedded in the figure; use d3flux.core.payload.load_map_info on the
+        saved JSON to store them in the model.
+
+        If 'incremental', only the unplaced nodes are positioned in python,
+        next to their placed neighbors, relaxing just their neighborhood
+        (see d3flux.core.layout.incremental_layout). Use this after adding
+        reactions to a model with a stored layout. The nodes placed or moved
+        are listed in `figure.layout_diff`.
+
+    layout_cache:
+        A d3flux.core.layout_cache.LayoutCache (or a directory name) holding
+        converged layouts keyed on the visible graph. Unplaced nodes are
+        looked up in the cache before layout, and layouts computed in python
+        are stored in it.
+
+    payload:
+        'full' (default) embeds the complete model_to_dict JSON. 'compact'
+        embeds only the ids, names, stoichiometry and map_info used by the
+        renderer, in a columnar format; 'gzip' additionally compresses it.
+        With a compact payload, "Save JSON" saves only these fields; use
+        d3flux.core.payload.load_map_info to copy the saved map_info back
+        into the full model.
+
+    include_library:
+        Whether to inline the d3flux.js library in the output. Defaults to
+        True, unless `init_notebook_mode()` has been called, in which case
+        the library is loaded once and shared by all figures.
+
+    settle_iterations:
+        If nonzero, run this many cola layout iterations off-screen and draw
+        the settled figure once, instead of animating the layout. Defaults
+        to 0. Frame times and the total settle time of each figure are
+        available in the browser as window.d3flux_figures[figure_id].stats.
+
+    layout_worker:
+        Whether to run the cola layout in a Web Worker, which keeps the
+        notebook responsive while large maps converge. Defaults to None,
+        which uses a worker for models with 500 or more metabolites and
+        reactions. Falls back to the main thread if the worker can't start.
+
+    renderer:
+        'svg' (default) draws every node, link and label as an SVG element.
+        'canvas' draws the map on an HTML canvas, which stays responsive for
+        genome-scale models: the view pans and zooms, and labels and
+        cofactor nodes are only drawn once zoomed in past `lod_zoom`.
+        "Download SVG" still exports the full map as vector graphics. Custom
+        CSS is not applied to the canvas.
+
+    lod_zoom:
+        Zoom scale at which the canvas renderer starts drawing labels and
+        cofactors. Defaults to None, which is 2 for maps with 500 or more
+        nodes and 0 (always drawn) otherwise.
+
+    cache:
+        A d3flux.core.render_cache.RenderCache, or True to use its
+        default_cache. Figures are looked up by a fingerprint of the model
+        topology, map_info, drawn fluxes and render settings, and a cached
+        figure is returned (with the requested figure id) instead of
+        rendering the model again. The fingerprint is stored as
+        `figure.cache_key`. Defaults to None, which doesn't cache.
+
+    collapse:
+        Draw one node per group of reactions instead of every reaction (see
+        d3flux.core.subsystems). True groups reactions by
+        `reaction.subsystem`; a dict-like of group names by reaction id, or a
+        function of the reaction, sets other groups. Groups are linked by the
+        metabolites they share, and clicking a group draws its reactions in
+        its place, from a compressed chunk embedded in the figure. Collapsed
+        figures always embed a compact payload, and a python layout
+        positions the group nodes. `FluxMap.update` only restyles the
+        reactions of groups already expanded. Defaults to None.
+
+    samples:
+        Flux samples to draw as distributions instead of `flux_dict`: a .npy
+        filename (read memory-mapped), an array or DataFrame with one sample
+        per row, an iterable of such blocks, or a summary already computed
+        by d3flux.core.samples.summarize_samples. Samples are reduced in one
+        streaming pass. Links and nodes are sized by the median flux, the
+        interquartile range is drawn as a translucent band around each link
+        and node, and the fraction of samples carrying flux sets their
+        opacity. Array columns must follow the order of the model's
+        reactions.
+
     """
 
-    # Initialize empty map_info field in object notes
-    for obj in itertools.chain([cobra_model], cobra_model.metabolites,
-                               cobra_model.reactions):
-        if 'map_info' not in obj.notes:
-            obj.notes['map_info'] = {}
-
-    # build cofactor metabolites from strings
-    cobra_metabolites = []
-    if excluded_metabolites:
-        compartments = set((m.compartment for m in cobra_model.metabolites))
-        metabolite_list = [
-            cf + '_' + co for cf, co in itertools.product(
-                excluded_metabolites, compartments)] + excluded_metabolites
-        for cofactor in metabolite_list:
-            try:
-                cobra_metabolites += [
-                    cobra_model.metabolites.get_by_id(cofactor)]
-            except KeyError:
-                pass
-            # what if its already a cobra metabolite?
-
-    cobra_rxns = []
-    if excluded_reactions:
-        for rxnid in excluded_reactions:
-            try:
-                cobra_rxns += [
-                    cobra_model.reactions.get_by_id(rxnid)]
-            except KeyError:
-                pass
-
-    # Exclude metabolites and reactions in the given comparment
-    excluded_metabolites = set(cobra_metabolites)
-    excluded_reactions = set(cobra_rxns)
-
-    if excluded_compartments:
-        met_compartments = set((m for m in cobra_model.metabolites.query(
-            lambda x: set(x.compartment).intersection(
-                set(excluded_compartments)), None)))
-        excluded_metabolites |= met_compartments
-
-        # Do I want to redo this not to include excluded metabolites?
-        # rxn_compartments = set((r for r in cobra_model.reactions.query(
-        #     lambda x: set(x.compartments).intersection(
-        #         set(excluded_compartments)), None)))
-        # excluded_reactions |= rxn_compartments
-
-    # for reaction in excluded_reactions:
-    #     reaction.notes['map_info'] = {'hidden': True}
-
-    for metabolite in excluded_metabolites:
-        metabolite.notes['map_info'] = {'hidden': True}
-
-    def is_hidden(obj):
-        try:
-            return bool(obj.notes['map_info']['hidden'])
-        except KeyError:
-            return False
-
-    for reaction in cobra_model.reactions:
-
-        if overwrite_reversibility:
-            reaction.notes['map_info']['reversibility'] = \
-                bool(reaction.reversibility)
-
-        # Unless 'hidden' specifically set to False, hide the reaction if all
-        # the reactants or products are hidden (excluding cofactors)
-        if ('hidden' not in reaction.notes['map_info']) & ~is_hidden(reaction):
-
-            # Hide reactions if all of their products or reactants are hidden.
-            # Don't include cofactor metabolites in this calculation.
-            if 'cofactors' in reaction.notes['map_info']:
-                cofactors = reaction.notes['map_info']['cofactors'].keys()
-            else:
-                cofactors = {}
+    with profiled(profile) as stats:
+        with stage('overlay'):
+            overlay = map_info_overlay(
+                cobra_model, excluded_metabolites, excluded_reactions,
+                excluded_compartments, display_name_format,
+                overwrite_reversibility, collapse_hidden, groups,
+                digest=kwargs.get('cache') not in (None, False))
+
+        # Append model's map_info kwargs
+        render_kwargs = dict(overlay['model'])
+        render_kwargs.update(kwargs)
+
+        figure = render_model(cobra_model, overlay=overlay, **render_kwargs)
+
+    figure.stats = stats
+    return figure
+
+
+def flux_svg(cobra_model, filename=None,
+             excluded_metabolites=None, excluded_reactions=None,
+             excluded_compartments=None, display_name_format=True,
+             overwrite_reversibility=True, collapse_hidden=False,
+             groups=None, samples=None, **kwargs):
+    """Draw the flux map as a static SVG document in python, without a
+    browser. The styling matches the figure drawn by `flux_map`; nodes are
+    placed at their map_info positions, and any unplaced nodes are
+    positioned with the python layout engine (or taken from `layout_cache`),
+    only around their placed neighbors if layout='incremental'.
+
+    filename:
+        If given, the SVG is also written to this file.
+
+    samples:
+        Flux samples, or their summary, drawn as in `flux_map`: by their
+        median, with the interquartile range as a translucent band around
+        each link and a ring around each metabolite, and the fraction of
+        samples carrying flux as opacity.
+
+    All other arguments and kwargs are as in `flux_map`. Options that only
+    affect the browser are ignored. Returns the SVG markup as a string.
+
+    """
+    if samples is not None and not is_summary(samples):
+        with stage('samples'):
+            samples = summarize_samples(cobra_model, samples)
 
-            if (all([is_hidden(met) for met in reaction.reactants
-                     if met.id not in cofactors]) or
-                all([is_hidden(met) for met in reaction.products
-                     if met.id not in cofactors])):
+    with stage('overlay'):
+        overlay = map_info_overlay(
+            cobra_model, excluded_metabolites, excluded_reactions,
+            excluded_compartments, display_name_format,
+            overwrite_reversibility, collapse_hidden, groups)
 
-                reaction.notes['map_info']['hidden'] = True
+    render_kwargs = dict(overlay['model'])
+    render_kwargs.update(kwargs)
+    flux_dict = render_kwargs.pop('flux_dict', None)
+    metabolite_dict = render_kwargs.pop('metabolite_dict', None)
+    if samples is not None:
+        flux_dict = samples['reactions']['median']
+        metabolite_dict = samples['metabolites']['median']
+
+    with stage('model_dict'):
+        model_data = create_model_dict(cobra_model, flux_dict,
+                                       metabolite_dict, full=False,
+                                       overlay=overlay, samples=samples)
+    with stage('layout'):
+        graph = layout_model(
+            model_data, hide_unused=render_kwargs.get('hide_unused'),
+            hide_unused_cofactors=render_kwargs.get('hide_unused_cofactors'),
+            layout_cache=render_kwargs.pop('layout_cache', None),
+            incremental=(render_kwargs.pop('layout', None) == 'incremental'),
+            figsize=render_kwargs.get('figsize') or (1028, 768),
+            flowLayout=render_kwargs.get('flowLayout', False))
+
+    with stage('svg'):
+        svg = model_svg(model_data, graph=graph, **render_kwargs)
+    record_size('svg', len(svg))
+
+    if filename is not None:
+        with open(filename, 'w') as f:
+            f.write(svg)
+
+    return svg
+
+
+def flux_map_grid(cobra_model, solutions, ncols=2,
+                  excluded_metabolites=None, excluded_reactions=None,
+                  excluded_compartments=None, display_name_format=True,
+                  overwrite_reversibility=True, collapse_hidden=False,
+                  groups=None, **kwargs):
+    """Render the same model under several flux solutions as a grid of small
+    multiples. The model topology and layout are embedded once, and each
+    panel only adds per-reaction and per-metabolite flux arrays.
+
+    solutions:
+        A dictionary of {label: flux_dict}, a list of (label, flux_dict)
+        pairs, or a pandas.DataFrame of fluxes (reactions x conditions). Each
+        flux_dict may be anything accepted by `create_model_dict`.
+
+    ncols: int
+        Number of panels per row.
+
+    layout:
+        As in `flux_map`, but defaults to 'python' so that all panels share
+        one layout. If None, unplaced nodes are positioned independently in
+        each panel by the browser.
+
+    flux_dict, metabolite_dict:
+        Fluxes of the shared model, embedded once with the topology. They set
+        the nodes hidden by hide_unused in the shared python layout; each
+        panel draws the fluxes of its own solution.
+
+    profile:
+        If True, time each stage of the render and attach the resulting
+        RenderStats to the returned HTML as `stats` (see `flux_map`).
+
+    All other arguments and kwargs are as in `flux_map`, except `cache`,
+    `collapse` and `samples`, which only apply to single figures and raise
+    a ValueError. figsize is the size of each panel, and defaults to
+    512x384.
+
+    """
+    unsupported = [name for name in _single_figure_options
+                   if kwargs.get(name) is not None]
+    if unsupported:
+        raise ValueError('flux_map_grid does not support {}; draw single '
+                         'figures with flux_map instead'.format(
+                             ', '.join(unsupported)))
+
+    profile = kwargs.pop('profile', False)
+    with profiled(profile) as stats:
+        with stage('overlay'):
+            overlay = map_info_overlay(
+                cobra_model, excluded_metabolites, excluded_reactions,
+                excluded_compartments, display_name_format,
+                overwrite_reversibility, collapse_hidden, groups)
+
+        # Options of the shared model and layout are split from the options
+        # of each panel, as in render_model
+        render_kwargs = dict(overlay['model'])
+        render_kwargs.update(kwargs)
+        for name in _single_figure_options + ('figure_id', 'label'):
+            render_kwargs.pop(name, None)
+        render_kwargs.setdefault('figsize', (512, 384))
+        flux_dict = render_kwargs.pop('flux_dict', None)
+        metabolite_dict = render_kwargs.pop('metabolite_dict', None)
+        layout = render_kwargs.pop('layout', 'python')
+        layout_cache = render_kwargs.pop('layout_cache', None)
+        payload = render_kwargs.pop('payload', 'full')
+        include_library = render_kwargs.pop('include_library', None)
+        if include_library is None:
+            include_library = not render_model._library_loaded
+
+        if payload not in ('full', 'compact', 'gzip'):
+            raise ValueError(
+                "payload must be one of 'full', 'compact', 'gzip'")
+
+        if hasattr(solutions, 'items'):
+            solutions = list(solutions.items())
+
+        # Shared topology and map_info
+        with stage('model_dict'):
+            model_data = create_model_dict(
+                cobra_model, flux_dict if flux_dict is not None else {},
+                metabolite_dict, full=(payload == 'full'), overlay=overlay)
+
+        with stage('layout'):
+            _layout_figure(
+                model_data, layout, layout_cache,
+                hide_unused=render_kwargs.get('hide_unused'),
+                hide_unused_cofactors=render_kwargs.get(
+                    'hide_unused_cofactors'),
+                figsize=render_kwargs['figsize'],
+                flowLayout=render_kwargs.get('flowLayout', False))
+
+        grid_id = _new_figure_id('d3fluxgrid')
+        stoichiometry = incidence_index(cobra_model).stoichiometry
+
+        panels = []
+        with stage('panels'):
+            for label, solution in solutions:
+                fluxes, met_fluxes = drawn_fluxes(
+                    cobra_model, solution, stoichiometry=stoichiometry)
+                modeljson = (
+                    '{{"format": "{}", "base": {}model, '
+                    '"reaction_flux": {}, "metabolite_flux": {}}}').format(
+                        OVERLAY_FORMAT, grid_id,
+                        json.dumps(to_json_list(fluxes)),
+                        json.dumps(to_json_list(met_fluxes)))
+                panels.append((label, _render_figure(
+                    modeljson, _new_figure_id(), include_library=False,
+                    **render_kwargs)))
+
+        # The library is inlined at most once, ahead of all the panels
+        with stage('template'):
+            html = get_template('grid_template.html').render(
+                grid_id=grid_id,
+                modeljson=_encode_model(model_data, payload),
+                library=load_library() if include_library else None,
+                panels=panels, width=100. / ncols)
+        record_size('html', len(html))
+
+    grid = HTML(html)
+    grid.stats = stats
+    return grid
+
+
+# render_model options that flux_map_grid can't apply to its panels
+_single_figure_options = ('cache', 'collapse', 'samples')
+
+
+def _copy_map_info(obj):
+    """Return a copy of an object's stored map_info, with the nested
+    cofactor entries copied as well, so it can be modified freely."""
+    map_info = dict(obj.notes.get('map_info', {}))
+    if 'cofactors' in map_info:
+        map_info['cofactors'] = {cf: dict(cf_info) for cf, cf_info in
+                                 map_info['cofactors'].items()}
+    return map_info
+
+
+def stored_map_info(cobra_model):
+    """Return the map_info overlay (see `map_info_overlay`) holding copies of
+    the map_info stored in the model notes, without any derived entries."""
+    return {
+        'model': _copy_map_info(cobra_model),
+        'metabolites': [_copy_map_info(met) for met in
+                        cobra_model.metabolites],
+        'reactions': [_copy_map_info(rxn) for rxn in cobra_model.reactions],
+    }
+
+
+def map_info_overlay(cobra_model, excluded_metabolites=None,
+                     excluded_reactions=None, excluded_compartments=None,
+                     display_name_format=True, overwrite_reversibility=True,
+                     collapse_hidden=False, groups=None, digest=False):
+    """Compute the map_info used to render the model, hiding excluded objects
+    and adding display names and reversibilities. Other arguments are as in
+    `flux_map`.
+
+    digest: bool
+        Whether to store the `overlay_digest` of the result under 'digest',
+        so the render cache hashes the map_info once, as it is built. The
+        digest is dropped by `create_model_dict`, which adds the fluxes to
+        the overlay; remove it as well if you modify the overlay.
+
+    The stored map_info of each object is copied and the derived entries are
+    layered over the copy, so the model itself is never modified. This makes
+    rendering safe inside `with model:` contexts (which don't track changes
+    to notes) and from several threads on a shared model.
+
+    Returns a dictionary with the model's map_info under 'model', and lists of
+    map_info dictionaries under 'metabolites' and 'reactions', in the same
+    order as cobra_model.metabolites and cobra_model.reactions.
+
+    Hiding is computed on the cached incidence index of the model (see
+    d3flux.core.model_index), which is reused across calls with different
+    exclusions.
+
+    """
+    overlay = stored_map_info(cobra_model)
+    met_info, rxn_info = overlay['metabolites'], overlay['reactions']
+    index = incidence_index(cobra_model)
+
+    # Excluded ids match metabolites exactly or in any compartment
+    excluded = np.zeros(len(met_info), dtype=bool)
+    excluded[index.resolve_metabolites(excluded_metabolites)] = True
+
+    # Hide metabolites in the excluded compartments
+    excluded |= index.compartment_mask(excluded_compartments)
+
+    for i in np.flatnonzero(excluded):
+        met_info[i] = {'hidden': True}
+
+    excluded_rxns = index.reaction_mask(excluded_reactions)
+    for i in np.flatnonzero(excluded_rxns):
+        rxn_info[i]['hidden'] = True
+
+    bounds = reaction_bounds(cobra_model)
+    reversible = (bounds[:, 0] < 0) & (bounds[:, 1] > 0)
+    if overwrite_reversibility:
+        for map_info, reversibility in zip(rxn_info, reversible.tolist()):
+            map_info['reversibility'] = reversibility
+
+    # Unless 'hidden' specifically set to False, hide the reaction if all
+    # the reactants or products are hidden (excluding cofactors)
+    cofactors = index.cofactor_matrix({
+        rxn_id: map_info['cofactors'] for rxn_id, map_info in
+        zip(index.reaction_ids, rxn_info) if map_info.get('cofactors')})
+
+    def hidden(infos):
+        return (np.array([bool(info.get('hidden')) for info in infos],
+                         dtype=bool),
+                np.array(['hidden' in info for info in infos], dtype=bool))
+
+    hidden_mets, fixed_mets = hidden(met_info)
+    hidden_rxns, fixed_rxns = hidden(rxn_info)
+
+    new_mets, new_rxns = index.propagate_hidden(
+        hidden_mets, hidden_rxns, fixed_mets, fixed_rxns, cofactors,
+        collapse=collapse_hidden,
+        reversible=reversible if collapse_hidden else None,
+        excluded_reactions=excluded_rxns)
+
+    for infos, new, old in ((met_info, new_mets, hidden_mets),
+                            (rxn_info, new_rxns, hidden_rxns)):
+        for i in np.flatnonzero(new & ~old):
+            infos[i]['hidden'] = True
 
     # Add diplay names to the cobra metabolites accoring to the
     # display_name_format function
@@ -176,115 +527,172 @@ def flux_map(cobra_model,
         # Handle the case for a default display name formatter. This is
         # optimized for models using the typical bigg_id naming convention,
         # ending with 'ID_c' compartment identifier.
+        # The default names are cached with the incidence index.
         if display_name_format is True:
-            display_name_format = (
-                lambda met: re.sub('__[D,L]', '', met.id[:-2].upper()))
+            names = index.display_names
+        else:
+            names = map(display_name_format, cobra_model.metabolites)
 
-        for met in cobra_model.metabolites:
+        for name, map_info in zip(names, met_info):
 
             # Don't overwrite existing display names
-            if 'display_name' not in met.notes['map_info']:
-                met.notes['map_info']['display_name'] = (
-                    display_name_format(met))
+            if 'display_name' not in map_info:
+                map_info['display_name'] = name
+
+    if groups is not None:
+        for rxn_id, map_info in zip(index.reaction_ids, rxn_info):
+            if rxn_id in groups:
+                group = groups[rxn_id]
+                if isinstance(group, np.generic):
+                    group = group.item()
+                if group is None or (isinstance(group, float) and
+                                     np.isnan(group)):
+                    map_info.pop('group', None)
+                else:
+                    map_info['group'] = group
+
+    if digest:
+        overlay['digest'] = overlay_digest(overlay)
+    return overlay
 
-    # Append model's map_info kwargs
-    render_kwargs = dict(cobra_model.notes['map_info'])
-    render_kwargs.update(kwargs)
 
-    return render_model(cobra_model, **render_kwargs)
+def prepare_map_info(cobra_model, excluded_metabolites=None,
+                     excluded_reactions=None, excluded_compartments=None,
+                     display_name_format=True, overwrite_reversibility=True,
+                     collapse_hidden=False, groups=None):
+    """Write the map_info computed by `map_info_overlay` into the model
+    notes. Rendering no longer requires this; it is kept for storing the
+    derived display names and hidden flags with the model."""
 
+    overlay = map_info_overlay(
+        cobra_model, excluded_metabolites, excluded_reactions,
+        excluded_compartments, display_name_format, overwrite_reversibility,
+        collapse_hidden, groups)
 
-def create_model_json(cobra_model, flux_dict=None, metabolite_dict=None):
+    cobra_model.notes['map_info'] = overlay['model']
+    for objs, key in ((cobra_model.metabolites, 'metabolites'),
+                      (cobra_model.reactions, 'reactions')):
+        for obj, map_info in zip(objs, overlay[key]):
+            obj.notes['map_info'] = map_info
+
+
+def create_model_json(cobra_model, flux_dict=None, metabolite_dict=None,
+                      overlay=None):
     """ Convert a cobra.Model object to a json string for d3. Adds flux
-    information if the model has been solved
+    information if the model has been solved. Arguments are as in
+    `create_model_dict`.
+
+    """
+    return json.dumps(create_model_dict(cobra_model, flux_dict,
+                                        metabolite_dict, overlay=overlay),
+                      allow_nan=False)
+
+
+def create_model_dict(cobra_model, flux_dict=None, metabolite_dict=None,
+                      full=True, overlay=None, samples=None):
+    """ Convert a cobra.Model object to the dictionary serialized for d3. Adds
+    flux information if the model has been solved. The model is not modified.
 
     flux_dict: dict-like
         Contains an external setting of the flux solution that should be
-        plotted.
+        plotted. A pandas.Series or cobra.Solution is also accepted. If None,
+        the fluxes are read from the model's most recent solution.
 
     metabolite_dict:
         A dictionary-like object containing the desired carried fluxes for each
         metabolite in the model
 
-    """
-    def get_flux(reaction):
-        if flux_dict is not None:
-            return flux_dict[reaction.id]
-        else:
+    full: bool
+        Whether to return the complete `model_to_dict` representation. If
+        False, only the ids, names, stoichiometry and map_info read by
+        d3flux.js are included.
 
-            try:
-                return reaction.flux
+    overlay: dict
+        The map_info to render, from `map_info_overlay`. Defaults to copies of
+        the map_info stored in the model notes. Fluxes and knockout groups are
+        added to it in place.
 
-            except OptimizationError:
-                # The model hasn't been solved, so we just throw in a None
-                return None
+    samples: dict
+        A summary from d3flux.core.samples.summarize_samples, whose quartiles
+        and nonzero fractions are added to the map_info of the objects drawn
+        with a flux, as `flux_q1`, `flux_q3` and `nonzero`. The fluxes
+        themselves are still set by flux_dict and metabolite_dict.
 
+    """
+    if overlay is None:
+        overlay = stored_map_info(cobra_model)
+
+    # The overlay no longer matches a digest taken when it was built
+    overlay.pop('digest', None)
+
+    # Pull the full flux vector from the solver (or flux_dict) in one pass.
+    # Metabolite throughputs are calculated for all metabolites at once from
+    # the sparse stoichiometric matrix, |S|.|v| / 2
+    with stage('fluxes'):
+        fluxes, met_fluxes = drawn_fluxes(
+            cobra_model, flux_dict, metabolite_dict,
+            stoichiometry=incidence_index(cobra_model).stoichiometry)
 
     # Add flux info
-    for reaction in cobra_model.reactions:
+    knockouts = knocked_out(reaction_bounds(cobra_model)).tolist()
+    for knockout, map_info, flux in zip(knockouts, overlay['reactions'],
+                                        fluxes):
 
         # If I'm styling reaction knockouts, don't set the flux for a
         # knocked out reaction
-        if reaction.lower_bound == reaction.upper_bound == 0:
-            reaction.notes['map_info']['group'] = 'ko'
-            
-            # Delete the flux key, if it exists
-            try:
-                del reaction.notes['map_info']['flux']
-            except KeyError:
-                pass
-
-        else: 
-            try:
-                if abs(get_flux(reaction)) < 1E-8:
-                    reaction.notes['map_info']['flux'] = 0.
-                else:
-                    reaction.notes['map_info']['flux'] = get_flux(reaction)
-            except (KeyError, TypeError):
-                if 'flux' in reaction.notes['map_info']:
-                    del reaction.notes['map_info']['flux']
-
-            # cobrapy doesn't track contexted changes to the notes field. So if
-            # a reaction is set to the 'ko' group, reset it if it doens't match
-            # the bounds requirements
-            if 'group' in reaction.notes['map_info']:
-                if reaction.notes['map_info']['group'] == 'ko':
-                    del reaction.notes['map_info']['group']
-
-    def get_met_flux(metabolite):
-        if metabolite_dict is not None:
-            return metabolite_dict[metabolite.id]
+        if knockout:
+            map_info['group'] = 'ko'
+
+        # Earlier versions stored the 'ko' group in the notes, which
+        # cobrapy doesn't reset with the bounds. Drop it if it doesn't match
+        # the bounds requirements
+        elif map_info.get('group') == 'ko':
+            del map_info['group']
+
+        # Knocked-out reactions and missing fluxes are NaN
+        if np.isnan(flux):
+            map_info.pop('flux', None)
         else:
-            return sum([abs(get_flux(r) * r.metabolites[metabolite]) for r in
-                        metabolite.reactions]) / 2
+            map_info['flux'] = float(flux)
 
-    for metabolite in cobra_model.metabolites:
+    for map_info, carried_flux in zip(overlay['metabolites'], met_fluxes):
 
-        try:
-            del metabolite.notes['map_info']['flux']
+        if np.isnan(carried_flux):
+            map_info.pop('flux', None)
+        else:
+            map_info['flux'] = float(carried_flux)
 
-        except KeyError:
-            pass
+    if samples is not None:
+        add_sample_channels(cobra_model, overlay, samples)
 
-        try:
-            carried_flux = get_met_flux(metabolite)
-            if carried_flux > 1E-8:
-                metabolite.notes['map_info']['flux'] = carried_flux
-            else:
-                metabolite.notes['map_info']['flux'] = 0.
+    if not full:
+        return renderer_dict(cobra_model, overlay)
 
-        except Exception:
-            pass
+    # model_to_dict copies the notes dictionaries, but not the map_info they
+    # contain, so the overlay is swapped in on the copies
+    with stage('model_to_dict'):
+        model_data = model_to_dict(cobra_model)
+    model_data['notes'] = dict(model_data.get('notes', {}),
+                               map_info=overlay['model'])
+    for key in ('metabolites', 'reactions'):
+        for obj, map_info in zip(model_data[key], overlay[key]):
+            obj['notes'] = dict(obj.get('notes', {}), map_info=map_info)
 
-    return json.dumps(model_to_dict(cobra_model), allow_nan=False)
+    return model_data
 
 
 def render_model(cobra_model, background_template=None, custom_css=None,
                  figure_id=None, hide_unused=None, hide_unused_cofactors=None,
                  inactive_alpha=1., figsize=None, label=None, fontsize=None,
                  default_flux_width=2.5, flux_dict=None, metabolite_dict=None,
-                 svg_scale=100, flowLayout=False):
-    """ Render a cobra.Model object in the current window
+                 svg_scale=100, flowLayout=False, layout=None,
+                 layout_cache=None, payload='full', include_library=None,
+                 overlay=None, settle_iterations=0, layout_worker=None,
+                 renderer='svg', lod_zoom=None, profile=False, cache=None,
+                 collapse=None, samples=None):
+    """ Render a cobra.Model object in the current window. Returns a FluxMap,
+    which displays as HTML and can push new fluxes to the drawn figure with
+    `FluxMap.update`.
 
     Parameters:
 
@@ -329,29 +737,258 @@ def render_model(cobra_model, background_template=None, custom_css=None,
         A dictionary-like object containing the desired carried fluxes for each
         metabolite in the model
 
-    """
+    flowLayout:
+        whether or not to use the webcola's flow layout to force a heirarchical
+        diagram
+
+    layout:
+        If 'python' or 'incremental', compute any missing node positions in
+        python before rendering (see `flux_map`).
+
+    layout_cache:
+        Cache of layouts keyed on the visible graph (see `flux_map`).
+
+    payload:
+        How the model is embedded in the figure (see `flux_map`).
+
+    include_library:
+        Whether to inline the d3flux.js library in the figure. Defaults to
+        True, unless the library was loaded with `init_notebook_mode`.
+
+    overlay:
+        The map_info to render, from `map_info_overlay`. Defaults to the
+        map_info stored in the model notes.
+
+    settle_iterations:
+        Layout iterations to run off-screen before drawing (see `flux_map`).
+
+    layout_worker:
+        Whether to run the browser layout in a Web Worker (see `flux_map`).
 
-    # Increment figure counter
+    renderer:
+        'svg' or 'canvas' (see `flux_map`).
+
+    lod_zoom:
+        Zoom scale at which the canvas renderer draws labels and cofactors
+        (see `flux_map`).
+
+    profile:
+        Time each stage and attach the statistics as `figure.stats` (see
+        `flux_map`).
+
+    cache:
+        A RenderCache to reuse figures from, or True for the default cache
+        (see `flux_map`).
+
+    collapse:
+        Draw one node per group of reactions, expanded on click (see
+        `flux_map`).
+
+    samples:
+        Flux samples, or their summary, to draw as distributions (see
+        `flux_map`).
+
+    """
 
     # Get figure name and JSON string for the cobra model
     if not figure_id:
-        render_model._fignum += 1
-        figure_id = 'd3flux{:0>3d}'.format(render_model._fignum)
+        figure_id = _new_figure_id()
 
     if not figsize:
         figsize = (1028, 768)
 
-    modeljson = create_model_json(cobra_model, flux_dict, metabolite_dict)
+    if payload not in ('full', 'compact', 'gzip'):
+        raise ValueError("payload must be one of 'full', 'compact', 'gzip'")
+
+    if include_library is None:
+        include_library = not render_model._library_loaded
+
+    if cache is True:
+        cache = default_cache
+
+    with profiled(profile) as stats:
+
+        groups = None
+        if collapse is not None and collapse is not False:
+            groups = reaction_groups(cobra_model, collapse)
+
+        # Sampled fluxes are drawn by their median
+        if samples is not None:
+            if not is_summary(samples):
+                with stage('samples'):
+                    samples = summarize_samples(cobra_model, samples)
+            flux_dict = samples['reactions']['median']
+            metabolite_dict = samples['metabolites']['median']
+
+        # Cached figures are stored with a placeholder id, replaced by the
+        # requested figure_id
+        key = None
+        render_id = figure_id
+        if cache is not None:
+            if overlay is None:
+                overlay = stored_map_info(cobra_model)
+            settings = _render_settings(
+                background_template=background_template,
+                custom_css=custom_css, hide_unused=hide_unused,
+                hide_unused_cofactors=hide_unused_cofactors,
+                inactive_alpha=inactive_alpha, figsize=figsize,
+                fontsize=fontsize, default_flux_width=default_flux_width,
+                svg_scale=svg_scale, flowLayout=flowLayout, layout=layout,
+                layout_cache=layout_cache, payload=payload,
+                include_library=include_library,
+                settle_iterations=settle_iterations,
+                layout_worker=layout_worker, renderer=renderer,
+                lod_zoom=lod_zoom, collapse=groups,
+                samples=(summary_digest(samples) if samples is not None
+                         else None))
+            with stage('fingerprint'):
+                key = fingerprint(cobra_model, overlay, flux_dict,
+                                  metabolite_dict, settings)
+
+            # Each figure updates its own copy of the cached fluxes
+            entry = cache.get(key)
+            if entry is not None:
+                figure = FluxMap(
+                    entry['html'].replace(FIGURE_ID_PLACEHOLDER, figure_id),
+                    figure_id, cobra_model, dict(entry['reaction_fluxes']),
+                    dict(entry['metabolite_fluxes']))
+                figure.stats = stats
+                figure.cache_key = key
+                return figure
+            render_id = FIGURE_ID_PLACEHOLDER
+
+        with stage('model_dict'):
+            model_data = create_model_dict(
+                cobra_model, flux_dict, metabolite_dict,
+                full=(payload == 'full' and groups is None),
+                overlay=overlay, samples=samples)
+
+        # Only the coarse model is drawn until groups are expanded
+        drawn_data = model_data
+        if groups is not None:
+            with stage('collapse'):
+                drawn_data, chunks = collapse_model(model_data, groups)
+
+        # Position the nodes server-side, so the browser only has to draw
+        # them
+        graph = None
+        if (layout is not None) or (layout_cache is not None):
+            with stage('layout'):
+                graph = _layout_figure(
+                    drawn_data, layout, layout_cache,
+                    hide_unused=hide_unused,
+                    hide_unused_cofactors=hide_unused_cofactors,
+                    figsize=figsize, flowLayout=flowLayout)
+
+        with stage('encode'):
+            if groups is not None:
+                modeljson = encode_payload(
+                    collapsed_payload(drawn_data, chunks),
+                    compress=(payload == 'gzip'))
+            else:
+                modeljson = _encode_model(model_data, payload)
+        record_size('model_json', len(modeljson))
+
+        with stage('template'):
+            html = _render_figure(
+                modeljson, render_id,
+                background_template=background_template,
+                custom_css=custom_css, hide_unused=hide_unused,
+                hide_unused_cofactors=hide_unused_cofactors,
+                inactive_alpha=inactive_alpha, figsize=figsize,
+                fontsize=fontsize, default_flux_width=default_flux_width,
+                svg_scale=svg_scale, flowLayout=flowLayout,
+                include_library=include_library,
+                settle_iterations=settle_iterations,
+                layout_worker=layout_worker, renderer=renderer,
+                lod_zoom=lod_zoom)
+        record_size('html', len(html))
+
+        if key is not None:
+            cache_html = html
+            html = html.replace(FIGURE_ID_PLACEHOLDER, figure_id)
+
+        figure = FluxMap.from_model_data(html, figure_id, cobra_model,
+                                         model_data)
+
+        if key is not None:
+            cache.set(key, {
+                'html': cache_html,
+                'payload': modeljson,
+                'reaction_fluxes': dict(figure.reaction_fluxes),
+                'metabolite_fluxes': dict(figure.metabolite_fluxes),
+            })
+
+    figure.stats = stats
+    figure.cache_key = key
+    figure.layout_diff = graph.layout_diff if graph is not None else None
+    return figure
+
+
+def _render_settings(**settings):
+    """The render_model arguments as JSON-serializable values for the cache
+    fingerprint, including the modification times of the files read"""
+    background = settings['background_template']
+    if background and os.path.exists(background):
+        settings['background_template'] = [
+            background, os.path.getmtime(background)]
+    if settings['layout_cache'] is not None:
+        settings['layout_cache'] = getattr(
+            settings['layout_cache'], 'path', settings['layout_cache'])
+    settings['library'] = os.path.getmtime(
+        os.path.join(template_dir, 'd3flux.js'))
+    return settings
+
+
+def _layout_figure(model_data, layout=None, layout_cache=None, **kwargs):
+    """Position the nodes of the model dictionary in python for `layout`
+    (None, 'python' or 'incremental'), or only apply cached positions if
+    layout is None. Returns the FluxGraph, or None if there was nothing to
+    do. Additional kwargs are passed to `layout_model`."""
+
+    if layout not in (None, 'python', 'incremental'):
+        raise ValueError("layout must be None, 'python' or 'incremental'")
+
+    if layout is None and layout_cache is None:
+        return None
+
+    return layout_model(model_data, layout_cache=layout_cache,
+                        compute=(layout is not None),
+                        incremental=(layout == 'incremental'), **kwargs)
+
+
+def _encode_model(model_data, payload='full'):
+    """Serialize the model dictionary as a javascript expression"""
+    if payload == 'full':
+        return json.dumps(model_data, allow_nan=False)
+    return encode_payload(compact_payload(model_data),
+                          compress=(payload == 'gzip'))
+
+
+def _new_figure_id(prefix='d3flux'):
+    """Increment the figure counter and return a new, unique figure id"""
+    with render_model._fignum_lock:
+        render_model._fignum += 1
+        fignum = render_model._fignum
+    return '{}{:0>3d}'.format(prefix, fignum)
 
-    if not hide_unused:
-        hide_unused = "false"
-    else:
-        hide_unused = "true"
 
-    if not hide_unused_cofactors:
-        hide_unused_cofactors = "false"
-    else:
-        hide_unused_cofactors = "true"
+def _render_figure(modeljson, figure_id, background_template=None,
+                   custom_css=None, hide_unused=None,
+                   hide_unused_cofactors=None, inactive_alpha=1.,
+                   figsize=None, fontsize=None, default_flux_width=2.5,
+                   svg_scale=100, flowLayout=False, include_library=None,
+                   settle_iterations=0, layout_worker=None, renderer='svg',
+                   lod_zoom=None):
+    """Render the HTML and javascript for a single figure. `modeljson` is
+    inserted verbatim as the javascript expression for the model, and the
+    remaining settings are passed to d3flux.js as one JSON config object."""
+
+    if renderer not in ('svg', 'canvas'):
+        raise ValueError("renderer must be one of 'svg', 'canvas'")
+
+    if not figsize:
+        figsize = (1028, 768)
 
     # Handle custom CSS
     if not custom_css:
@@ -363,40 +1000,53 @@ def render_model(cobra_model, background_template=None, custom_css=None,
     # Handle background template
     if not background_template:
         background_svg = ''
-        no_background = "true"
     else:
-        from IPython.display import SVG
-        background_svg = SVG(background_template).data
-        no_background = "false"
-
-    # Initialize the jinja templates
-    env = Environment(loader=FileSystemLoader(
-        os.path.join(os.path.dirname(d3flux.__file__), 'templates')))
-    
-    template_css = env.get_template('network_style.css')
-    template_html = env.get_template('output_template.html')
-    template_js = env.get_template('d3flux.js')
-
-    # Render the jinja templates with the given variables
-    css = template_css.render(inactive_alpha=inactive_alpha,
-                              fontsize=fontsize, cf_fontsize=0.8 * fontsize)
-
-    js = template_js.render(figure_id=figure_id, modeljson=modeljson,
-                            no_background=no_background,
-                            hide_unused=hide_unused,
-                            hide_unused_cofactors=hide_unused_cofactors,
-                            figwidth=figsize[0], figheight=figsize[1],
-                            css=compress(css + custom_css),
-                            default_flux_width=default_flux_width,
-                            svg_scale=svg_scale, flowLayout=flowLayout)
-
-    html = template_html.render(figure_id=figure_id,
-                                background_svg=background_svg,
-                                javascript_source=js)
-
-    # compile and return HTML
-    return HTML(html)
+        background_svg = load_background_svg(background_template)
+
+    # Compiled templates and compressed CSS are cached between calls
+    css = render_css(inactive_alpha, fontsize, custom_css)
+
+    config = {
+        'figure_id': figure_id,
+        'width': figsize[0],
+        'height': figsize[1],
+        'no_background': not background_template,
+        'hide_unused': bool(hide_unused),
+        'hide_unused_cofactors': bool(hide_unused_cofactors),
+        'css': css,
+        'default_flux_width': default_flux_width,
+        'svg_scale': svg_scale,
+        'flowLayout': bool(flowLayout),
+        'settle_iterations': int(settle_iterations or 0),
+        'layout_worker': layout_worker,
+        'renderer': renderer,
+        'lod_zoom': lod_zoom,
+        'fontsize': fontsize,
+        'inactive_alpha': inactive_alpha,
+    }
+
+    if include_library is None:
+        include_library = not render_model._library_loaded
+
+    return get_template('output_template.html').render(
+        figure_id=figure_id, background_svg=background_svg,
+        library=load_library() if include_library else None,
+        config=json.dumps(config), modeljson=modeljson)
+
+
+def init_notebook_mode():
+    """Load the d3flux.js library into the notebook once, so that
+    subsequent figures only contain their model and settings, rather than
+    an inlined copy of the library. Call at the top of the notebook."""
+
+    render_model._library_loaded = True
+    return HTML(get_template('library_template.html').render(
+        library=load_library()))
 
 
 # Initialize figure counter
 render_model._fignum = 0
+render_model._fignum_lock = threading.Lock()
+
+# Whether the d3flux.js library has been loaded with init_notebook_mode
+render_model._library_loaded = False
@@ -0,0 +1,164 @@
+"""
+Python mirror of the node and link construction in d3flux.js. Builds the
+metabolite -> reaction -> metabolite graph that is drawn in the browser from
+the JSON-serializable model dictionary produced by `create_model_dict`.
+"""
+
+import hashlib
+
+
+def _map_info(obj):
+    """Return the map_info dictionary of a serialized model object, or an
+    empty dictionary if it doesn't exist"""
+    return obj.get('notes', {}).get('map_info', {})
+
+
+def _is_unused(map_info):
+    """Mirrors `Math.abs(flux) < 1E-6` in d3flux.js, where a missing flux is
+    NaN and is therefore never considered unused"""
+    flux = map_info.get('flux')
+    return flux is not None and abs(flux) < 1E-6
+
+
+class FluxGraph(object):
+    """The graph drawn by d3flux.js.
+
+    nodes: list of dicts
+        Each node has an 'id', a 'type' ('metabolite', 'cofactor' or 'rxn'),
+        and the 'map_info' dictionary from the serialized model in which its
+        position is stored. Cofactor nodes also carry the 'reaction' they
+        belong to and the 'orig_id' of the displayed metabolite.
+
+    node_lookup: dict
+        node id -> index into nodes
+
+    links: list of (int, int)
+        Directed source -> reaction and reaction -> target pairs, as passed to
+        the cola layout
+
+    bilinks: list of (int, int, int)
+        (source, reaction, target) triplets, one per drawn path
+
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.node_lookup = {}
+        self.links = []
+        self.bilinks = []
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _add_node(self, node):
+        self.nodes.append(node)
+        self.node_lookup[node['id']] = len(self.nodes) - 1
+        return len(self.nodes) - 1
+
+    def fixed(self):
+        """Boolean list indicating which nodes have stored x/y positions"""
+        return [('x' in node['map_info']) and ('y' in node['map_info'])
+                for node in self.nodes]
+
+    def topology_key(self):
+        """Hash of the visible graph: the ids of all drawn nodes and the
+        metabolites each reaction connects. Independent of fluxes (and hence
+        the drawn direction of each reaction) and of node positions."""
+
+        ids = [node['id'] for node in self.nodes]
+        neighbors = {}
+        for s, r, t in self.bilinks:
+            neighbors.setdefault(r, set()).update((ids[s], ids[t]))
+
+        lines = sorted(node['type'] + ':' + node['id'] for node in self.nodes)
+        lines += sorted(ids[r] + ':' + ','.join(sorted(mets))
+                        for r, mets in neighbors.items())
+
+        return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def build_graph(model_data, hide_unused=False, hide_unused_cofactors=False):
+    """Construct the FluxGraph for a serialized model, following the same
+    rules as d3flux.js for hidden, unused and cofactor nodes.
+
+    model_data: dict
+        Model dictionary from `create_model_dict`
+
+    hide_unused, hide_unused_cofactors: bool
+        As in `render_model`
+
+    """
+    graph = FluxGraph()
+    metabolites = {met['id']: met for met in model_data['metabolites']}
+
+    for met in model_data['metabolites']:
+        map_info = _map_info(met)
+        if map_info.get('hidden'):
+            continue
+        if hide_unused and _is_unused(map_info):
+            continue
+        graph._add_node({'id': met['id'], 'type': 'metabolite',
+                         'map_info': map_info})
+
+    # Reaction stoichiometries, with cofactors replaced by their own nodes
+    stoichiometries = {}
+
+    for reaction in model_data['reactions']:
+        map_info = _map_info(reaction)
+        stoich = dict(reaction['metabolites'])
+        stoichiometries[reaction['id']] = stoich
+
+        if map_info.get('hidden'):
+            continue
+        if hide_unused_cofactors and _is_unused(map_info):
+            continue
+
+        for cofactor, cf_info in map_info.get('cofactors', {}).items():
+            if (cofactor not in metabolites) or (cofactor not in stoich):
+                continue
+
+            cf_id = cofactor + '_' + reaction['id']
+            stoich[cf_id] = stoich.pop(cofactor)
+            graph._add_node({'id': cf_id, 'type': 'cofactor',
+                             'map_info': cf_info, 'orig_id': cofactor,
+                             'reaction': reaction['id']})
+
+    for reaction in model_data['reactions']:
+        map_info = _map_info(reaction)
+        stoich = stoichiometries[reaction['id']]
+
+        if map_info.get('hidden'):
+            continue
+
+        if 'flux' in map_info:
+            if hide_unused and _is_unused(map_info):
+                continue
+            if map_info['flux'] < -1E-10:
+                # Reactions flowing in reverse switch products and reactants
+                stoich = {met: -coeff for met, coeff in stoich.items()}
+
+        reactants = [met for met, coeff in stoich.items()
+                     if coeff <= 0 and met in graph.node_lookup]
+        products = [met for met, coeff in stoich.items()
+                    if coeff > 0 and met in graph.node_lookup]
+
+        # Don't add links on the boundary
+        if not reactants or not products:
+            continue
+
+        rindex = graph._add_node({'id': reaction['id'], 'type': 'rxn',
+                                  'map_info': map_info})
+
+        if len(reactants) >= len(products):
+            pairs = [(reactant, products[i % len(products)])
+                     for i, reactant in enumerate(reactants)]
+        else:
+            pairs = [(reactants[i % len(reactants)], product)
+                     for i, product in enumerate(products)]
+
+        for source, target in pairs:
+            s, t = graph.node_lookup[source], graph.node_lookup[target]
+            graph.links += [(s, rindex), (rindex, t)]
+            graph.bilinks.append((s, rindex, t))
+
+    return graph
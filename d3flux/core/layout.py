@@ -0,0 +1,655 @@
+"""
+Server-side layout engine. Positions the FluxGraph nodes by stress
+majorization over graph-theoretic distances, the same objective minimized by
+the cola layout in the browser, so that d3flux.js only needs to draw a
+pre-positioned graph.
+
+The stress is sparse (Ortmann, Klimenta & Brandes, 2016): every link
+contributes a term, and the distant nodes are represented by a fixed number
+of pivots, so memory and the cost of each iteration grow with the number of
+links plus nodes times pivots rather than with the square of the nodes.
+Each connected component is laid out on its own.
+"""
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components, shortest_path
+
+from d3flux.core.graph import build_graph
+from d3flux.core.layout_cache import LayoutCache
+
+
+def _pivot_distances(adjacency, n_pivots=200, seed=0):
+    """Choose up to n_pivots max-min pivots of a connected graph, each the
+    node farthest from the pivots before it, and compute their shortest path
+    lengths.
+
+    Returns (pivots, dist), where dist is an (n_pivots, n_nodes) array of
+    path lengths in links.
+
+    """
+    n_nodes = adjacency.shape[0]
+    n_pivots = min(n_pivots, n_nodes)
+    rng = np.random.RandomState(seed)
+
+    pivots = np.zeros(n_pivots, dtype=int)
+    pivots[0] = rng.randint(n_nodes)
+    dist = np.empty((n_pivots, n_nodes))
+    nearest = np.full(n_nodes, np.inf)
+    for k in range(n_pivots):
+        dist[k] = shortest_path(adjacency, directed=False, unweighted=True,
+                                indices=pivots[k])
+        np.minimum(nearest, dist[k], out=nearest)
+        if k + 1 < n_pivots:
+            pivots[k + 1] = np.argmax(nearest)
+
+    return pivots, dist
+
+
+def _pivot_mds(pivots, pivot_dist):
+    """Approximate classical MDS embedding from the (n_pivots, n_nodes)
+    distances to a subset of pivot nodes (Brandes & Pich, 2007), scaled to
+    best match those distances. Used to initialize free layouts."""
+
+    c = pivot_dist.T ** 2
+    c -= c.mean(0)
+    c -= c.mean(1)[:, None]
+    _, vectors = np.linalg.eigh(c.T.dot(c))
+    x = c.dot(vectors[:, :-3:-1])
+    del c
+
+    # Least squares scale against the pivot distances, in blocks
+    ratio, squares = 0., 0.
+    step = max(1, 2 ** 20 // len(x))
+    for start in range(0, len(pivots), step):
+        d = pivot_dist[start:start + step]
+        e = np.hypot(x[:, 0] - x[pivots[start:start + step], 0, None],
+                     x[:, 1] - x[pivots[start:start + step], 1, None])
+        r = e[d > 0] / d[d > 0]
+        ratio += r.sum()
+        squares += (r ** 2).sum()
+    return x * (ratio / squares if squares > 0 else 1.)
+
+
+def _pivot_weights(pivot_dist):
+    """Weights of the node-pivot terms of the sparse stress, as an
+    (n_pivots, n_nodes) array.
+
+    Each node is paired with every pivot more than one link away, weighted
+    by the number of nodes nearest that pivot that are within half that
+    distance of it, so that the pivot stands in for the part of the graph
+    around it. Closer pairs are covered by the link terms and get no weight.
+
+    """
+    weights = np.zeros_like(pivot_dist)
+    region = np.argmin(pivot_dist, axis=0)
+    for k, d in enumerate(pivot_dist):
+        far = d > 1
+        near = np.sort(d[region == k])
+        count = np.searchsorted(near, d[far] / 2., side='right')
+        weights[k, far] = np.maximum(count, 1) / d[far] ** 2
+    return weights
+
+
+def _conjugate_gradient(matrix, b, x, maxiter=20, tol=1E-4):
+    """Solve matrix.dot(x) = b for each column of b by Jacobi-preconditioned
+    conjugate gradients, starting from x"""
+
+    inverse_diagonal = 1. / np.maximum(matrix.diagonal(), 1E-12)[:, None]
+    r = b - matrix.dot(x)
+    z = inverse_diagonal * r
+    p = z.copy()
+    rz = (r * z).sum(0)
+    threshold = (tol * np.sqrt((b ** 2).sum(0))) ** 2
+
+    for _ in range(maxiter):
+        if np.all((r ** 2).sum(0) <= threshold):
+            break
+        ap = matrix.dot(p)
+        alpha = rz / np.maximum((p * ap).sum(0), 1E-300)
+        x = x + alpha * p
+        r = r - alpha * ap
+        z = inverse_diagonal * r
+        rz_new = (r * z).sum(0)
+        p = z + (rz_new / np.maximum(rz, 1E-300)) * p
+        rz = rz_new
+
+    return x
+
+
+def _align(x, reference):
+    """Rotate and translate x onto reference (orthogonal Procrustes,
+    without reflection)"""
+    center, reference_center = x.mean(0), reference.mean(0)
+    u, _, vt = np.linalg.svd((x - center).T.dot(reference - reference_center))
+    rotation = u.dot(np.diag([1., np.linalg.det(u.dot(vt))])).dot(vt)
+    return (x - center).dot(rotation) + reference_center
+
+
+def _project_flow(x, links, fixed, gap, sweeps=50):
+    """Enforce the cola flowLayout('y', gap) separation constraints,
+    y[target] - y[source] >= gap, by iterative projection"""
+
+    source, target = links[:, 0], links[:, 1]
+    free = (~fixed).astype(float)
+
+    for _ in range(sweeps):
+        violation = gap - (x[target, 1] - x[source, 1])
+        active = (violation > 1E-6) & ((free[source] + free[target]) > 0)
+        if not active.any():
+            break
+
+        # Split the correction between free endpoints
+        share = violation[active] / (free[source] + free[target])[active]
+        shift = np.zeros(len(x))
+        counts = np.zeros(len(x))
+        np.add.at(shift, source[active], -share * free[source][active])
+        np.add.at(shift, target[active], share * free[target][active])
+        np.add.at(counts, source[active], free[source][active])
+        np.add.at(counts, target[active], free[target][active])
+        x[:, 1] += shift / np.maximum(counts, 1)
+
+    return x
+
+
+def _group(labels, n_groups):
+    """Split the indices 0..len(labels)-1 by label, as a list of arrays"""
+    order = np.argsort(labels, kind='stable')
+    return np.split(order, np.cumsum(np.bincount(labels,
+                                                 minlength=n_groups))[:-1])
+
+
+def _pack_components(x, components, fixed, link_distance):
+    """Translate the components without fixed nodes so that they sit side
+    by side in rows, largest first, to the right of any fixed nodes"""
+
+    free = [nodes for nodes in components if not fixed[nodes].any()]
+    if not free:
+        return x
+
+    free.sort(key=len, reverse=True)
+    sizes = np.array([x[nodes].max(0) - x[nodes].min(0) for nodes in free])
+    gap = link_distance
+    width = max(np.sqrt(((sizes + gap) ** 2).sum()), sizes[:, 0].max())
+
+    if fixed.any():
+        lower, upper = x[fixed].min(0), x[fixed].max(0)
+        origin = np.array([upper[0] + 2 * gap, lower[1]])
+        width = max(width, upper[1] - lower[1])
+    else:
+        origin = np.zeros(2)
+
+    corner = origin.copy()
+    row_height = 0.
+    for nodes, size in zip(free, sizes):
+        if corner[0] > origin[0] and corner[0] + size[0] > origin[0] + width:
+            corner = np.array([origin[0], corner[1] + row_height + gap])
+            row_height = 0.
+        x[nodes] += corner - x[nodes].min(0)
+        corner[0] += size[0] + gap
+        row_height = max(row_height, size[1])
+
+    return x
+
+
+def stress_layout(n_nodes, links, positions=None, fixed=None,
+                  link_distance=30, flow_gap=None, max_iter=300, tol=1E-2,
+                  seed=0, seeded=False, anchored=None, anchor_weight=10.,
+                  n_pivots=200):
+    """Sparse stress-majorization layout of an undirected graph, holding
+    fixed nodes in place.
+
+    Each connected component is laid out separately, as cola does with
+    `handleDisconnected`. Unless `seeded` is set, components without fixed
+    nodes are then packed into rows, to the right of any fixed nodes.
+
+    n_nodes: int
+        Number of nodes in the graph
+
+    links: list of (int, int)
+        Edges between node indices. Treated as directed only for the flow
+        constraint.
+
+    positions: (n_nodes, 2) array
+        Initial node positions. Rows for fixed nodes must be set.
+
+    fixed: boolean array
+        Nodes whose positions should not be changed.
+
+    link_distance: float
+        Ideal length of a single edge, as in cola's `linkDistance`.
+
+    flow_gap: float or None
+        If given, enforce y[target] >= y[source] + flow_gap for every link,
+        equivalent to cola's `flowLayout('y', flow_gap)`.
+
+    tol: float
+        Stop once the mean displacement of the free nodes in an iteration is
+        less than tol * link_distance.
+
+    seeded: bool
+        If True, start the free nodes from their rows in `positions` instead
+        of initializing them.
+
+    anchored: boolean array
+        Free nodes that are pulled towards their initial positions, with
+        `anchor_weight` times the stress weight of a single link.
+
+    n_pivots: int
+        Number of pivots standing in for the distant nodes of each
+        component. Memory use is about 40 * n_pivots bytes per node. More
+        pivots bring large layouts closer to the full stress optimum.
+
+    Returns an (n_nodes, 2) array of positions.
+
+    """
+    x = np.zeros((n_nodes, 2)) if positions is None else (
+        np.array(positions, dtype=float))
+    fixed = np.zeros(n_nodes, dtype=bool) if fixed is None else (
+        np.asarray(fixed, dtype=bool))
+    anchored = np.zeros(n_nodes, dtype=bool) if anchored is None else (
+        np.asarray(anchored, dtype=bool))
+
+    if n_nodes == 0 or fixed.all():
+        return x
+
+    links = np.asarray(links, dtype=int).reshape(-1, 2)
+    n_components, labels = connected_components(_adjacency(n_nodes, links),
+                                                directed=False)
+    components = _group(labels, n_components)
+    component_links = _group(labels[links[:, 0]], n_components)
+
+    # Free nodes connected to fixed ones start next to them
+    if not seeded and fixed.any():
+        x = seed_positions(x, fixed, links, link_distance, seed)
+
+    lookup = np.zeros(n_nodes, dtype=int)
+    for nodes, link_index in zip(components, component_links):
+        if fixed[nodes].all():
+            continue
+        lookup[nodes] = np.arange(len(nodes))
+        x[nodes] = _component_stress(
+            lookup[links[link_index]], x[nodes], fixed[nodes],
+            anchored[nodes], initialize=not (seeded or fixed[nodes].any()),
+            link_distance=link_distance, flow_gap=flow_gap,
+            max_iter=max_iter, tol=tol, seed=seed,
+            anchor_weight=anchor_weight, n_pivots=n_pivots)
+
+    if not seeded:
+        x = _pack_components(x, components, fixed, link_distance)
+
+    return x
+
+
+def _component_stress(links, x, fixed, anchored, initialize, link_distance,
+                      flow_gap, max_iter, tol, seed, anchor_weight,
+                      n_pivots):
+    """Sparse stress majorization of one connected component (see
+    `stress_layout`), starting from x unless `initialize` is set"""
+
+    n_nodes = len(x)
+    free = ~fixed
+    rng = np.random.RandomState(seed)
+    if n_nodes == 1:
+        return x if not initialize else np.zeros((1, 2))
+
+    adjacency = _adjacency(n_nodes, links)
+    pivots, pivot_dist = _pivot_distances(adjacency, n_pivots, seed)
+
+    if initialize:
+        x = (_pivot_mds(pivots, pivot_dist) * link_distance +
+             rng.normal(0, 1E-3, (n_nodes, 2)))
+
+    # Links are majorized as in SMACOF. Pivot terms only move the node, with
+    # the pivot held where it is for the iteration, as in the localized
+    # update of Ortmann et al.
+    upper = sparse.triu(adjacency, k=1).tocoo()
+    source, target = upper.row, upper.col
+    weights = _pivot_weights(pivot_dist) / float(link_distance) ** 2
+    inv_dist = pivot_dist
+    inv_dist *= weights * link_distance
+    del pivot_dist
+
+    # Anchors add anchor_weight * |x - x0|^2 to the stress of each anchored
+    # node
+    anchor = np.where(anchored & free,
+                      anchor_weight / float(link_distance) ** 2, 0.)
+    anchor_pull = anchor[:, None] * x
+
+    diagonal = anchor + weights.sum(0)
+    degree = np.asarray(adjacency.sum(1)).ravel()
+    laplacian = ((sparse.diags(degree) - adjacency) /
+                 float(link_distance) ** 2 + sparse.diags(diagonal)).tocsr()
+
+    system = laplacian[free][:, free]
+    coupling = (laplacian[free][:, fixed].dot(x[fixed]) -
+                anchor_pull[free])
+    # Without fixed nodes, anchors or pivot terms, the laplacian is singular
+    # under translation, and the right hand side is centered to keep the
+    # system consistent
+    singular = not fixed.any() and not diagonal.any()
+
+    # The pivot terms don't hold a free component's orientation, which may
+    # slowly turn without changing the stress, so its displacement is taken
+    # after aligning the previous positions
+    rigid = not fixed.any() and not anchor.any()
+
+    # Pivots are processed in blocks of about a million terms
+    step = max(1, 2 ** 20 // n_nodes)
+
+    for _ in range(max_iter):
+        # Guttman transform of the link terms
+        delta = x[source] - x[target]
+        b = 1. / link_distance / np.maximum(
+            np.sqrt((delta ** 2).sum(1)), 1E-9)
+        rhs = np.column_stack([
+            np.bincount(source, b * delta[:, k], minlength=n_nodes) -
+            np.bincount(target, b * delta[:, k], minlength=n_nodes)
+            for k in range(2)])
+
+        # Each pivot term pulls the node to the ideal distance from the
+        # pivot, along their current direction
+        rhs += weights.T.dot(x[pivots])
+        for start in range(0, len(pivots), step):
+            block = slice(start, start + step)
+            dx = x[:, 0] - x[pivots[block], 0, None]
+            dy = x[:, 1] - x[pivots[block], 1, None]
+            b = inv_dist[block] / np.maximum(np.hypot(dx, dy), 1E-9)
+            rhs[:, 0] += (b * dx).sum(0)
+            rhs[:, 1] += (b * dy).sum(0)
+
+        rhs = rhs[free] - coupling
+        if singular:
+            rhs -= rhs.mean(0)
+
+        previous = x.copy()
+        x[free] = _conjugate_gradient(system, rhs, x[free])
+
+        if flow_gap is not None and len(links):
+            x = _project_flow(x, links, fixed, flow_gap)
+
+        moved = _align(previous, x) if rigid else previous
+        displacement = np.sqrt(((x - moved) ** 2).sum(1))[free].mean()
+        if displacement < tol * link_distance:
+            break
+
+    return x
+
+
+def _fit_to_figure(x, figsize, margin=30):
+    """Scale and translate a free layout so that it fits in the figure"""
+    lower, upper = x.min(0), x.max(0)
+    extent = np.maximum(upper - lower, 1E-9)
+    room = np.array(figsize, dtype=float) - 2 * margin
+    ratio = min(1., (room / extent).min())
+    center = (lower + upper) / 2.
+    return (x - center) * ratio + np.array(figsize, dtype=float) / 2.
+
+
+def graph_layout(graph, figsize=(1028, 768), flowLayout=False,
+                 link_distance=30, **kwargs):
+    """Compute positions for every node in a FluxGraph, keeping any stored
+    map_info x/y positions fixed.
+
+    graph: FluxGraph from `build_graph`
+
+    figsize: (width, height) of the figure. Layouts without any fixed nodes
+        are scaled to fit.
+
+    flowLayout: bool
+        Apply the same constraint as `cola.flowLayout('y', 15)`
+
+    Additional kwargs are passed to `stress_layout`. Returns an
+    (len(graph), 2) array of positions.
+
+    """
+    fixed = np.array(graph.fixed(), dtype=bool)
+    positions = np.zeros((len(graph), 2))
+    for i, node in enumerate(graph.nodes):
+        if fixed[i]:
+            positions[i] = node['map_info']['x'], node['map_info']['y']
+
+    positions = stress_layout(
+        len(graph), graph.links, positions, fixed,
+        link_distance=link_distance, flow_gap=15 if flowLayout else None,
+        **kwargs)
+
+    if len(graph) and not fixed.any():
+        positions = _fit_to_figure(positions, figsize)
+
+    return positions
+
+
+def _adjacency(n_nodes, links):
+    """Symmetric sparse adjacency matrix of the layout links"""
+    links = np.asarray(links, dtype=int).reshape(-1, 2)
+    adjacency = sparse.coo_matrix(
+        (np.ones(len(links)), (links[:, 0], links[:, 1])),
+        shape=(n_nodes, n_nodes)).tocsr()
+    return ((adjacency + adjacency.T) > 0).astype(float)
+
+
+def seed_positions(positions, placed, links, link_distance=30, seed=0):
+    """Initial positions for unplaced nodes, next to their placed neighbors.
+
+    Nodes adjacent to placed nodes start at the mean position of those
+    neighbors, then nodes adjacent to these, and so on, with a small random
+    offset. Nodes not connected to any placed node start in a column to the
+    right of the placed ones.
+
+    Returns a copy of `positions` with the unplaced rows set.
+
+    """
+    x = np.array(positions, dtype=float)
+    seeded = np.asarray(placed, dtype=bool).copy()
+    adjacency = _adjacency(len(x), links)
+    rng = np.random.RandomState(seed)
+
+    while not seeded.all():
+        counts = adjacency.dot(seeded.astype(float))
+        new = ~seeded & (counts > 0)
+        if not new.any():
+            break
+        sums = adjacency.dot(x * seeded[:, None])
+        x[new] = (sums[new] / counts[new, None] +
+                  rng.normal(0, link_distance / 2., (new.sum(), 2)))
+        seeded |= new
+
+    rest = ~seeded
+    if rest.any():
+        lower = x[seeded].min(0) if seeded.any() else np.zeros(2)
+        upper = x[seeded].max(0) if seeded.any() else np.zeros(2)
+        x[rest, 0] = upper[0] + link_distance * (
+            1 + rng.uniform(0, np.sqrt(rest.sum()), rest.sum()))
+        x[rest, 1] = rng.uniform(lower[1], max(upper[1], lower[1] + 1),
+                                 rest.sum())
+
+    return x
+
+
+def incremental_layout(graph, radius=2, relax_placed=False,
+                       figsize=(1028, 768), flowLayout=False,
+                       link_distance=30, **kwargs):
+    """Place the nodes of a FluxGraph that have no stored position, e.g.
+    after reactions are added to a model with an existing layout, without
+    disturbing the rest of the map.
+
+    New nodes are seeded next to their placed neighbors (see
+    `seed_positions`), and only the neighborhood within `radius` links of
+    a new node is relaxed by stress majorization.
+
+    radius: int
+        Number of links around the new nodes included in the relaxation.
+
+    relax_placed: bool
+        If True, placed nodes in the neighborhood may also move, held near
+        their positions by anchors (see `stress_layout`); those on its
+        outer edge stay fixed. Defaults to False, which moves no placed
+        node.
+
+    figsize, flowLayout, link_distance:
+        As in `graph_layout`, which lays out graphs without any placed node.
+
+    Additional kwargs are passed to `stress_layout`. Returns an
+    (len(graph), 2) array of positions.
+
+    """
+    placed = np.array(graph.fixed(), dtype=bool)
+    if not placed.any():
+        return graph_layout(graph, figsize=figsize, flowLayout=flowLayout,
+                            link_distance=link_distance, **kwargs)
+
+    positions = np.zeros((len(graph), 2))
+    for i, node in enumerate(graph.nodes):
+        if placed[i]:
+            positions[i] = node['map_info']['x'], node['map_info']['y']
+    if placed.all():
+        return positions
+
+    positions = seed_positions(positions, placed, graph.links,
+                               link_distance)
+
+    # Grow the neighborhood outwards from the new nodes, one link at a time
+    adjacency = _adjacency(len(graph), graph.links)
+    region = ~placed
+    edge = np.zeros(len(graph), dtype=bool)
+    for _ in range(radius):
+        grown = region | (adjacency.dot(region.astype(float)) > 0)
+        if (grown & ~region).any():
+            edge = grown & ~region
+        region = grown
+
+    local = np.flatnonzero(region)
+    lookup = -np.ones(len(graph), dtype=int)
+    lookup[local] = np.arange(len(local))
+    links = np.asarray(graph.links, dtype=int).reshape(-1, 2)
+    links = lookup[links[region[links].all(1)]]
+
+    if relax_placed:
+        fixed = placed[local] & edge[local]
+    else:
+        fixed = placed[local]
+
+    positions[local] = stress_layout(
+        len(local), links, positions[local], fixed,
+        link_distance=link_distance, flow_gap=15 if flowLayout else None,
+        seeded=True, anchored=placed[local], **kwargs)
+
+    return positions
+
+
+def node_positions(graph):
+    """{node id: (x, y)} for the nodes of a FluxGraph with stored
+    positions"""
+    return {node['id']: (node['map_info']['x'], node['map_info']['y'])
+            for node, is_fixed in zip(graph.nodes, graph.fixed())
+            if is_fixed}
+
+
+def layout_diff(before, after, tol=0.5):
+    """Compare two layouts, as {node id: (x, y)} (see `node_positions`).
+
+    tol: float
+        Smallest displacement reported as a move.
+
+    Returns a dictionary of 'placed' (ids only positioned in `after`),
+    'removed' (ids only positioned in `before`), and 'moved' ({id:
+    displacement} for the nodes in both that moved more than tol).
+
+    """
+    common = [node_id for node_id in after if node_id in before]
+    moved = {}
+    if common:
+        shift = np.hypot(*(np.array([after[i] for i in common], dtype=float) -
+                           np.array([before[i] for i in common],
+                                    dtype=float)).T)
+        moved = {node_id: float(d) for node_id, d in zip(common, shift)
+                 if d > tol}
+
+    return {'placed': sorted(set(after) - set(before)),
+            'removed': sorted(set(before) - set(after)),
+            'moved': moved}
+
+
+def apply_layout(graph, positions, indices=None):
+    """Write computed positions into the map_info of the graph nodes, which is
+    shared with the serialized model the graph was built from.
+
+    indices: list of int
+        Only update these nodes. Defaults to all nodes in the graph.
+
+    """
+    if indices is None:
+        indices = range(len(graph))
+
+    for i in indices:
+        node = graph.nodes[i]
+        node['map_info']['x'] = float(positions[i][0])
+        node['map_info']['y'] = float(positions[i][1])
+
+
+def layout_model(model_data, hide_unused=False, hide_unused_cofactors=False,
+                 layout_cache=None, compute=True, incremental=False,
+                 **kwargs):
+    """Position the visible graph of a serialized model, reusing and storing
+    layouts in `layout_cache` if one is given.
+
+    model_data:
+        The model dictionary from `create_model_dict`. Positions are written
+        into its map_info; the cobra.Model itself is not modified.
+
+    layout_cache: LayoutCache, str, or None
+        Cache (or cache directory) of layouts keyed on the graph topology.
+        Nodes without stored positions are first looked up in the cache.
+
+    compute: bool
+        Whether to run `graph_layout` for nodes that are still unplaced and
+        store the result in the cache. If False, only cached positions are
+        applied.
+
+    incremental: bool
+        Place the unplaced nodes with `incremental_layout`, relaxing only
+        their neighborhood, instead of `graph_layout`.
+
+    Additional kwargs are passed to `graph_layout` (or
+    `incremental_layout`). Returns the FluxGraph, whose `layout_diff`
+    attribute lists the nodes placed or moved by the layout (see
+    `layout_diff`).
+
+    """
+    graph = build_graph(model_data, hide_unused, hide_unused_cofactors)
+    before = node_positions(graph)
+
+    if isinstance(layout_cache, str):
+        layout_cache = LayoutCache(layout_cache)
+
+    if layout_cache is not None:
+        key = graph.topology_key()
+        cached = layout_cache.get(key) or {}
+        fixed = graph.fixed()
+        hits = [i for i, node in enumerate(graph.nodes)
+                if not fixed[i] and node['id'] in cached]
+        apply_layout(graph, [cached.get(node['id']) for node in graph.nodes],
+                     hits)
+
+    if not compute:
+        graph.layout_diff = layout_diff(before, node_positions(graph))
+        return graph
+
+    fixed = graph.fixed()
+    if incremental:
+        positions = incremental_layout(graph, **kwargs)
+        # Placed nodes only move if relax_placed is set
+        current = node_positions(graph)
+        unplaced = [i for i, node in enumerate(graph.nodes) if not fixed[i]
+                    or np.any(positions[i] != current[node['id']])]
+    else:
+        positions = graph_layout(graph, **kwargs)
+        unplaced = [i for i, is_fixed in enumerate(fixed) if not is_fixed]
+    apply_layout(graph, positions, unplaced)
+    graph.layout_diff = layout_diff(before, node_positions(graph))
+
+    if layout_cache is not None and (unplaced or key not in layout_cache):
+        layout_cache.set(key, [node['id'] for node in graph.nodes], positions)
+
+    return graph
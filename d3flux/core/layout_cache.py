@@ -0,0 +1,117 @@
+"""
+On-disk cache of converged layouts, keyed by the topology of the visible
+graph. Strain variants of the same base model that draw the same nodes and
+links reuse one layout instead of recomputing it on every render.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+
+
+def default_cache_dir():
+    """~/.cache/d3flux/layouts, or $XDG_CACHE_HOME/d3flux/layouts"""
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'd3flux', 'layouts')
+
+
+class LayoutCache(object):
+    """A directory of compressed .npz files, each holding the node ids and
+    positions of one layout.
+
+    path: str
+        Cache directory, created if it doesn't exist. Defaults to
+        `default_cache_dir()`.
+
+    max_entries: int
+        Maximum number of layouts to keep. The least recently used layouts
+        are removed once the cache grows beyond this size.
+
+    """
+
+    def __init__(self, path=None, max_entries=512):
+        self.path = path or default_cache_dir()
+        self.max_entries = max_entries
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def __len__(self):
+        return len(self._entries())
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def _entries(self):
+        return [os.path.join(self.path, f) for f in os.listdir(self.path)
+                if f.endswith('.npz')]
+
+    def get(self, key):
+        """Return a dictionary of node id -> (x, y) for the layout stored
+        under key, or None if there isn't one."""
+
+        filename = self._filename(key)
+        try:
+            with np.load(filename) as data:
+                ids, positions = data['ids'], data['positions']
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        # Mark as recently used, unless another process has evicted it
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return {str(node_id): (float(x), float(y))
+                for node_id, (x, y) in zip(ids, positions)}
+
+    def set(self, key, ids, positions):
+        """Store the positions (an (n, 2) array) of the node ids under key,
+        evicting the least recently used layouts if needed."""
+
+        handle, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                np.savez_compressed(f, ids=np.array(ids, dtype=str),
+                                    positions=np.asarray(positions,
+                                                         dtype=float))
+            os.replace(tmp, self._filename(key))
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        if self.max_entries is None or len(entries) <= self.max_entries:
+            return
+
+        # Entries removed by other processes sharing the directory are
+        # skipped
+        used = []
+        for filename in entries:
+            try:
+                used.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        used.sort()
+        for _, filename in used[:max(len(used) - self.max_entries, 0)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def clear(self):
+        for filename in self._entries():
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -0,0 +1,315 @@
+"""
+Cached incidence index of a cobra.Model, used to compute which metabolites
+and reactions are hidden with sparse boolean operations instead of per-object
+loops.
+"""
+
+import hashlib
+import re
+import threading
+import weakref
+from itertools import chain
+from operator import attrgetter
+
+import numpy as np
+from scipy import sparse
+
+from d3flux.core.flux_arrays import stoichiometric_matrix
+
+# Indices are stored per model and dropped when the model is collected
+_index_cache = weakref.WeakKeyDictionary()
+_index_lock = threading.Lock()
+
+_get_id = attrgetter('_id')
+_get_compartment = attrgetter('compartment')
+_get_metabolites = attrgetter('_metabolites')
+
+
+def model_signature(cobra_model):
+    """Hashable summary of the model's metabolites and reactions, which
+    changes whenever the index must be rebuilt: when metabolites or reactions
+    are added, removed, reordered or renamed, when a metabolite moves to
+    another compartment, or when a reaction's stoichiometry changes,
+    including coefficients changed in place (e.g. inside a `with model:`
+    block).
+
+    Only the identity, id and compartment of each object and the ids and
+    coefficients of each reaction's metabolites are compared, flattened with
+    C-level maps rather than a walk over the stoichiometric matrix, so the
+    check is cheap enough for every lookup. The signature holds ids rather
+    than the objects, so the cached index keeps no references to the model.
+
+    """
+    metabolites, reactions = cobra_model.metabolites, cobra_model.reactions
+    stoichiometries = list(map(_get_metabolites, reactions))
+    return (tuple(map(id, metabolites)),
+            tuple(map(_get_id, metabolites)),
+            tuple(map(_get_compartment, metabolites)),
+            tuple(map(id, reactions)),
+            tuple(map(_get_id, reactions)),
+            tuple(map(len, stoichiometries)),
+            tuple(map(_get_id, chain.from_iterable(stoichiometries))),
+            tuple(chain.from_iterable(map(dict.values, stoichiometries))))
+
+
+class IncidenceIndex(object):
+    """Sparse incidence structure of a cobra.Model.
+
+    signature: tuple
+        The `model_signature` the index was built from.
+
+    metabolite_ids, reaction_ids: list
+        Object ids, in model order.
+
+    stoichiometry: scipy.sparse.csr_matrix
+        The (metabolites x reactions) stoichiometric matrix.
+
+    reactants, products: scipy.sparse.csr_matrix
+        (reactions x metabolites) 0/1 matrices marking each reaction's
+        reactants and products.
+
+    compartments: dict
+        Boolean mask over the metabolites for each compartment.
+
+    variants: dict
+        Base metabolite id -> indices of its compartment variants, e.g.
+        'atp' -> [atp_c, atp_p]. Built on first use.
+
+    digest: str
+        SHA1 of the object ids and the stoichiometric matrix, stable across
+        sessions. Computed on first use.
+
+    display_names: list
+        Default display name of each metabolite: its id without the
+        compartment suffix and __D/__L tags, upper-cased, as for BiGG ids.
+        Built on first use.
+
+    """
+
+    def __init__(self, cobra_model, signature=None):
+        if signature is None:
+            signature = model_signature(cobra_model)
+        self.signature = signature
+        self.metabolite_ids = [met.id for met in cobra_model.metabolites]
+        self.reaction_ids = [rxn.id for rxn in cobra_model.reactions]
+        self.metabolite_index = {met_id: i for i, met_id in
+                                 enumerate(self.metabolite_ids)}
+        self.reaction_index = {rxn_id: i for i, rxn_id in
+                               enumerate(self.reaction_ids)}
+
+        self.stoichiometry = stoichiometric_matrix(cobra_model)
+        incidence = self.stoichiometry.T.tocsr()
+        self.reactants = (incidence < 0).astype(np.int32)
+        self.products = (incidence > 0).astype(np.int32)
+
+        compartments = np.array([met.compartment for met in
+                                 cobra_model.metabolites], dtype=object)
+        self.compartments = {
+            compartment: compartments == compartment
+            for compartment in set(compartments) if compartment}
+        self._variants = None
+        self._digest = None
+        self._display_names = None
+
+    @property
+    def variants(self):
+        if self._variants is None:
+            suffixes = ['_' + compartment for compartment in self.compartments]
+            variants = {}
+            for i, met_id in enumerate(self.metabolite_ids):
+                for suffix in suffixes:
+                    if met_id.endswith(suffix):
+                        variants.setdefault(
+                            met_id[:-len(suffix)], []).append(i)
+            self._variants = variants
+        return self._variants
+
+    @property
+    def display_names(self):
+        if self._display_names is None:
+            self._display_names = [re.sub('__[D,L]', '', met_id[:-2].upper())
+                                   for met_id in self.metabolite_ids]
+        return self._display_names
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            stoichiometry = self.stoichiometry.tocsr()
+            stoichiometry.sort_indices()
+            sha = hashlib.sha1()
+            sha.update('\0'.join(self.metabolite_ids).encode('utf-8'))
+            sha.update(b'\1')
+            sha.update('\0'.join(self.reaction_ids).encode('utf-8'))
+            for array in (stoichiometry.indptr, stoichiometry.indices,
+                          stoichiometry.data):
+                sha.update(np.ascontiguousarray(array, dtype=float).tobytes())
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def resolve_metabolites(self, ids):
+        """Indices of the metabolites matching each id, either exactly or as
+        the base id of compartment variants ('atp' matches atp_c, atp_p,
+        ...). Unknown ids are ignored."""
+        indices = set()
+        for met_id in ids or []:
+            if met_id in self.metabolite_index:
+                indices.add(self.metabolite_index[met_id])
+            indices.update(self.variants.get(met_id, ()))
+        return sorted(indices)
+
+    def cofactor_reactions(self, ids):
+        """{reaction id: [metabolite ids]} for every reaction that contains
+        one of the metabolites matching `ids` (see `resolve_metabolites`)"""
+        rows = self.resolve_metabolites(ids)
+        participants = self.stoichiometry[rows].tocoo()
+        reactions = {}
+        for row, col in zip(participants.row, participants.col):
+            reactions.setdefault(self.reaction_ids[col], []).append(
+                self.metabolite_ids[rows[row]])
+        return reactions
+
+    def metabolite_mask(self, ids):
+        """Boolean mask of the given metabolite ids. Unknown ids are ignored"""
+        return self._mask(self.metabolite_index, ids)
+
+    def reaction_mask(self, ids):
+        """Boolean mask of the given reaction ids. Unknown ids are ignored"""
+        return self._mask(self.reaction_index, ids)
+
+    def compartment_mask(self, compartments):
+        """Boolean mask of the metabolites in any of the given compartments"""
+        mask = np.zeros(len(self.metabolite_ids), dtype=bool)
+        for compartment in compartments or []:
+            if compartment in self.compartments:
+                mask |= self.compartments[compartment]
+        return mask
+
+    @staticmethod
+    def _mask(index, ids):
+        mask = np.zeros(len(index), dtype=bool)
+        mask[[index[obj_id] for obj_id in ids or [] if obj_id in index]] = True
+        return mask
+
+    def cofactor_matrix(self, cofactors):
+        """(reactions x metabolites) 0/1 matrix from a {reaction id:
+        [metabolite ids]} dictionary of cofactors"""
+        rows, cols = [], []
+        for rxn_id, met_ids in cofactors.items():
+            for met_id in met_ids:
+                if met_id in self.metabolite_index:
+                    rows.append(self.reaction_index[rxn_id])
+                    cols.append(self.metabolite_index[met_id])
+
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=self.reactants.shape)
+
+    def propagate_hidden(self, hidden_metabolites, hidden_reactions,
+                         fixed_metabolites=None, fixed_reactions=None,
+                         cofactors=None, collapse=False, reversible=None,
+                         excluded_reactions=None):
+        """Hide every reaction whose (non-cofactor) reactants or products are
+        all hidden.
+
+        hidden_metabolites, hidden_reactions: bool arrays
+            The currently hidden objects.
+
+        fixed_metabolites, fixed_reactions: bool arrays
+            Objects whose hidden state was set explicitly, and is kept.
+
+        cofactors: scipy.sparse matrix
+            Reaction participants to ignore, from `cofactor_matrix`.
+
+        collapse: bool
+            Also hide the dead ends left behind by hidden reactions:
+            metabolites next to a removed reaction which are no longer both
+            produced and consumed. Repeats until nothing changes, so
+            dead-end chains collapse entirely. Reactions that are hidden
+            explicitly or have no reactants or products (e.g., exchanges) are
+            only undrawn, and still count as connections.
+
+        reversible: bool array
+            Reversibility of the reactions, used with collapse.
+
+        excluded_reactions: bool array
+            Reactions removed by the user. Unlike other explicitly hidden
+            reactions, these do not count as connections with collapse.
+
+        Returns the new (hidden_metabolites, hidden_reactions) arrays.
+
+        """
+        hidden_metabolites = np.asarray(hidden_metabolites, dtype=bool)
+        hidden_reactions = np.asarray(hidden_reactions, dtype=bool)
+        n_mets, n_rxns = len(hidden_metabolites), len(hidden_reactions)
+        if fixed_metabolites is None:
+            fixed_metabolites = np.zeros(n_mets, dtype=bool)
+        if fixed_reactions is None:
+            fixed_reactions = np.zeros(n_rxns, dtype=bool)
+        if reversible is None:
+            reversible = np.zeros(n_rxns, dtype=bool)
+        if excluded_reactions is None:
+            excluded_reactions = np.zeros(n_rxns, dtype=bool)
+
+        reactants, products = self.reactants, self.products
+        if cofactors is not None and cofactors.nnz:
+            reactants = reactants - reactants.multiply(cofactors)
+            products = products - products.multiply(cofactors)
+
+        # Reactions that are hidden regardless of the metabolites
+        boundary = ((np.asarray(reactants.sum(1)).ravel() == 0) |
+                    (np.asarray(products.sum(1)).ravel() == 0))
+        removable = ~boundary & (~fixed_reactions | excluded_reactions)
+        consumed_by, produced_by = reactants.T.tocsr(), products.T.tocsr()
+
+        while True:
+            visible = (~hidden_metabolites).astype(np.int32)
+            dead = ((reactants.dot(visible) == 0) |
+                    (products.dot(visible) == 0))
+            hidden_reactions = np.where(fixed_reactions, hidden_reactions,
+                                        hidden_reactions | dead)
+            if not collapse:
+                break
+
+            removed = hidden_reactions & removable
+            kept = (~removed).astype(np.int32)
+            kept_reversible = (~removed & reversible).astype(np.int32)
+
+            produced = (produced_by.dot(kept) +
+                        consumed_by.dot(kept_reversible)) > 0
+            consumed = (consumed_by.dot(kept) +
+                        produced_by.dot(kept_reversible)) > 0
+            touched = (produced_by + consumed_by).dot(
+                removed.astype(np.int32)) > 0
+
+            dead_ends = (touched & ~(produced & consumed) &
+                         ~fixed_metabolites & ~hidden_metabolites)
+            if not dead_ends.any():
+                break
+            hidden_metabolites = hidden_metabolites | dead_ends
+
+        return hidden_metabolites, hidden_reactions
+
+
+def incidence_index(cobra_model):
+    """Return the IncidenceIndex of the model, reusing the cached index
+    unless the model's metabolites or reactions have changed (see
+    `model_signature`)"""
+
+    signature = model_signature(cobra_model)
+    with _index_lock:
+        index = _index_cache.get(cobra_model)
+    if index is None or index.signature != signature:
+        index = IncidenceIndex(cobra_model, signature)
+        with _index_lock:
+            _index_cache[cobra_model] = index
+    return index
+
+
+def clear_index(cobra_model=None):
+    """Drop the cached IncidenceIndex of the model (or of every model), e.g.
+    to free its memory"""
+    with _index_lock:
+        if cobra_model is None:
+            _index_cache.clear()
+        else:
+            _index_cache.pop(cobra_model, None)
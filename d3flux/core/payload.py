@@ -0,0 +1,148 @@
+"""
+Compact, columnar serialization of the model for d3flux.js. Only the fields
+read by the renderer are included: ids, names, the stoichiometry as a
+coordinate list, and map_info, with fluxes and positions stored as arrays.
+"""
+
+import base64
+import gzip
+import io
+import json
+
+PAYLOAD_FORMAT = 'd3flux.compact.v1'
+OVERLAY_FORMAT = 'd3flux.overlay.v1'
+
+
+def renderer_dict(cobra_model, overlay=None):
+    """Model dictionary in the same layout as `model_to_dict`, but with only
+    the fields used by d3flux.js (ids, names, stoichiometry and map_info).
+
+    overlay: dict
+        The map_info to include, as returned by `map_info_overlay`. Defaults
+        to the map_info stored in the model notes.
+
+    """
+    if overlay is None:
+        def map_infos(objs):
+            return [obj.notes.get('map_info', {}) for obj in objs]
+
+        overlay = {'model': cobra_model.notes.get('map_info', {}),
+                   'metabolites': map_infos(cobra_model.metabolites),
+                   'reactions': map_infos(cobra_model.reactions)}
+
+    return {
+        'id': cobra_model.id,
+        'notes': {'map_info': overlay['model']},
+        'metabolites': [{'id': met.id, 'name': met.name,
+                         'notes': {'map_info': map_info}}
+                        for met, map_info in zip(cobra_model.metabolites,
+                                                 overlay['metabolites'])],
+        'reactions': [{'id': rxn.id, 'name': rxn.name,
+                       'metabolites': {met.id: coeff for met, coeff in
+                                       rxn.metabolites.items()},
+                       'notes': {'map_info': map_info}}
+                      for rxn, map_info in zip(cobra_model.reactions,
+                                               overlay['reactions'])],
+    }
+
+
+def _columns(objs):
+    columns = {'id': [], 'name': [], 'flux': [], 'x': [], 'y': [],
+               'map_info': {}}
+
+    for i, obj in enumerate(objs):
+        map_info = dict(obj.get('notes', {}).get('map_info', {}))
+        columns['id'].append(obj['id'])
+        columns['name'].append(obj.get('name', ''))
+        for key in ('flux', 'x', 'y'):
+            columns[key].append(map_info.pop(key, None))
+
+        # Remaining map_info entries are stored sparsely, by index
+        if map_info:
+            columns['map_info'][str(i)] = map_info
+
+    return columns
+
+
+def compact_payload(model_data):
+    """Convert a model dictionary (from `create_model_dict`) to the columnar
+    payload expanded by `expand_model` in d3flux.js"""
+
+    met_index = {met['id']: i for i, met in
+                 enumerate(model_data['metabolites'])}
+
+    rows, cols, coeffs = [], [], []
+    for j, rxn in enumerate(model_data['reactions']):
+        for met_id, coeff in rxn['metabolites'].items():
+            rows.append(met_index[met_id])
+            cols.append(j)
+            coeffs.append(coeff)
+
+    return {
+        'format': PAYLOAD_FORMAT,
+        'id': model_data.get('id'),
+        'notes': {'map_info': model_data.get('notes', {}).get('map_info',
+                                                               {})},
+        'metabolites': _columns(model_data['metabolites']),
+        'reactions': _columns(model_data['reactions']),
+        'stoichiometry': {'metabolite': rows, 'reaction': cols,
+                          'coefficient': coeffs},
+    }
+
+
+def encode_payload(payload, compress=False):
+    """Return the javascript expression for a payload: a JSON object, or, if
+    compress is True, a string of the base64-encoded, gzipped JSON which is
+    decompressed in the browser"""
+
+    if not compress:
+        return json.dumps(payload, allow_nan=False, separators=(',', ':'))
+    return json.dumps(compress_payload(payload))
+
+
+def compress_payload(payload):
+    """The base64-encoded, gzipped JSON of a payload, as a string"""
+    data = json.dumps(payload, allow_nan=False, separators=(',', ':'))
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data.encode('utf-8'))
+
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+def decode_payload(data):
+    """Inverse of `encode_payload`, mainly for testing"""
+    payload = json.loads(data)
+    if isinstance(payload, str):
+        with gzip.GzipFile(fileobj=io.BytesIO(base64.b64decode(payload))) as f:
+            payload = json.loads(f.read().decode('utf-8'))
+    return payload
+
+
+def load_map_info(cobra_model, saved_model):
+    """Copy the map_info notes from a model saved with the "Save JSON" button
+    into cobra_model, by reaction and metabolite id. Useful when the figure
+    was rendered with a compact payload, which saves only the fields used by
+    the renderer.
+
+    saved_model: str or dict
+        Filename of the saved JSON, or its parsed contents
+
+    """
+    if not isinstance(saved_model, dict):
+        with open(saved_model) as f:
+            saved_model = json.load(f)
+
+    def copy(objs, saved_objs):
+        for saved in saved_objs:
+            map_info = saved.get('notes', {}).get('map_info')
+            if map_info is not None and saved['id'] in objs:
+                objs.get_by_id(saved['id']).notes['map_info'] = map_info
+
+    copy(cobra_model.metabolites, saved_model.get('metabolites', []))
+    copy(cobra_model.reactions, saved_model.get('reactions', []))
+
+    map_info = saved_model.get('notes', {}).get('map_info')
+    if map_info is not None:
+        cobra_model.notes['map_info'] = map_info
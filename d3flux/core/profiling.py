@@ -0,0 +1,162 @@
+"""
+Per-stage timing of the python render pipeline. Stages of `flux_map`,
+`render_model` and `flux_svg` are recorded while a profile is active:
+
+    with profile() as stats:
+        flux_map(model)
+    print(stats)
+
+or equivalently `flux_map(model, profile=True).stats`. Each stage records its
+wall time and, unless disabled, the memory allocated by python (with
+tracemalloc, which slows the profiled code down). Payload sizes are recorded
+in bytes. The browser-side spans (graph build, layout, first paint) are
+written by d3flux.js to the figure's data-d3flux-stats attribute.
+"""
+
+import contextlib
+import threading
+import time
+import tracemalloc
+
+_local = threading.local()
+
+
+class RenderStats(object):
+    """Timings of a profiled render.
+
+    stages: list of dict
+        One entry per stage, in the order they finished, with the stage
+        name, its wall time in `seconds`, and if memory is traced, the net
+        memory `allocated` and the `peak_memory` above the memory in use when
+        the stage started, in bytes. Nested stages are listed before the
+        stage containing them, with `depth` > 0.
+
+    sizes: dict
+        Payload sizes in bytes, e.g. 'model_json' and 'html', summed over the
+        renders in the profile.
+
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.sizes = {}
+        self._open = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Record the time (and allocations) of the enclosed block"""
+        frame = {'stage': name, 'depth': len(self._open)}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self._open:
+                # The enclosing stage's peak up to now, before it is reset
+                self._open[-1]['_peak'] = max(self._open[-1]['_peak'], peak)
+            tracemalloc.reset_peak()
+            frame['_start'] = frame['_peak'] = current
+
+        self._open.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            frame['seconds'] = time.perf_counter() - start
+            self._open.pop()
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                peak = max(frame.pop('_peak'), peak)
+                start_memory = frame.pop('_start')
+                frame['allocated'] = current - start_memory
+                frame['peak_memory'] = peak - start_memory
+                if self._open:
+                    self._open[-1]['_peak'] = max(
+                        self._open[-1]['_peak'], peak)
+            self.stages.append(frame)
+
+    def record_size(self, name, size):
+        self.sizes[name] = self.sizes.get(name, 0) + size
+
+    @property
+    def total(self):
+        """Wall time of the top-level stages, in seconds"""
+        return sum(s['seconds'] for s in self.stages if s['depth'] == 0)
+
+    def as_dict(self):
+        """A JSON-serializable copy of the statistics, for logging"""
+        return {'stages': [dict(s) for s in self.stages],
+                'sizes': dict(self.sizes),
+                'total_seconds': self.total}
+
+    def __repr__(self):
+        lines = ['{:<24s} {:>10s} {:>12s} {:>12s}'.format(
+            'stage', 'ms', 'allocated', 'peak')]
+        for s in self.stages:
+            lines.append('{:<24s} {:>10.2f} {:>12s} {:>12s}'.format(
+                '  ' * s['depth'] + s['stage'], 1E3 * s['seconds'],
+                str(s.get('allocated', '')), str(s.get('peak_memory', ''))))
+        for name, size in sorted(self.sizes.items()):
+            lines.append('{:<24s} {:>10d} B'.format(name, size))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def profile(trace_memory=True):
+    """Record the stages of the renders run in the enclosed block, in this
+    thread. Yields a RenderStats.
+
+    trace_memory: bool
+        Whether to record allocations with tracemalloc. Tracing is started
+        for the block if it isn't already running.
+
+    """
+    stats = RenderStats(trace_memory)
+    started = trace_memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+        if started:
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def profiled(enable):
+    """The active RenderStats, starting a new profile if `enable` is True
+    and none is active. Yields None when not profiling."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None or not enable:
+        yield stats
+    else:
+        with profile() as stats:
+            yield stats
+
+
+def stage(name):
+    """Context manager recording a stage in the active profile, if any"""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return _null_stage
+    return stats.stage(name)
+
+
+def record_size(name, size):
+    """Record a payload size in the active profile, if any"""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.record_size(name, size)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
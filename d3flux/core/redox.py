@@ -0,0 +1,99 @@
+"""
+Redox analysis of many flux solutions at once. The oxidized cofactor balance
+of every reaction is computed for all solutions in one product with the
+sparse stoichiometric matrix, and turned into a table of reaction groups
+that can be passed to `flux_map(..., groups=...)` without touching the
+model's notes.
+"""
+
+import numpy as np
+import pandas as pd
+
+from d3flux.core.flux_arrays import get_flux_vector
+from d3flux.core.model_index import incidence_index
+
+common_ox_cofactors = ['nad_c', 'nadp_c', 'q8_c']
+
+
+def flux_table(cobra_model, fluxes=None):
+    """Return fluxes as a (reactions x solutions) DataFrame, ordered as
+    `cobra_model.reactions`. Reactions missing from `fluxes` are NaN.
+
+    fluxes: pandas.DataFrame, dict-like, cobra.Solution or None
+        A DataFrame of reactions x solutions, or a single solution in any
+        form accepted by `get_flux_vector`. If None, the model's current
+        solution is used.
+
+    """
+    reaction_ids = [reaction.id for reaction in cobra_model.reactions]
+
+    if isinstance(fluxes, pd.DataFrame):
+        fluxes = fluxes[~fluxes.index.duplicated()].reindex(reaction_ids)
+        return fluxes.apply(pd.to_numeric, errors='coerce').astype(float)
+
+    return pd.DataFrame({'flux': get_flux_vector(cobra_model, fluxes)},
+                        index=reaction_ids)
+
+
+def redox_balance(cobra_model, fluxes=None, ox_cofactors=None):
+    """Net production of the oxidized cofactors by each reaction, for each
+    solution. Positive values are oxidizing reactions, negative values
+    reducing ones.
+
+    fluxes:
+        Flux solutions, see `flux_table`.
+
+    ox_cofactors: list
+        Oxidized cofactor ids, defaults to common_ox_cofactors.
+
+    Returns a (reactions x solutions) DataFrame.
+
+    """
+    if ox_cofactors is None:
+        ox_cofactors = common_ox_cofactors
+
+    index = incidence_index(cobra_model)
+    table = flux_table(cobra_model, fluxes)
+
+    rows = [index.metabolite_index[cofactor] for cofactor in ox_cofactors]
+    coefficients = np.asarray(
+        index.stoichiometry[rows].sum(0)).ravel() if rows else (
+            np.zeros(len(index.reaction_ids)))
+
+    balance = coefficients[:, None] * table.values
+    return pd.DataFrame(balance, index=table.index, columns=table.columns)
+
+
+def redox_groups(cobra_model, fluxes=None, ox_cofactors=None, tol=1E-8,
+                 starting_group=1, color_knockouts=True):
+    """Assign reaction groups from the redox balance of each solution:
+    `starting_group` for oxidizing reactions, `starting_group + 1` for
+    reducing reactions, and 'ko' for knocked-out reactions (bounds of
+    (0, 0)) if color_knockouts is True.
+
+    fluxes, ox_cofactors:
+        As in `redox_balance`.
+
+    tol: float
+        Flux tolerance above which to include the reaction.
+
+    Returns a (reactions x solutions) DataFrame of groups, None where a
+    reaction has no group. Each column can be passed as the `groups` argument
+    of `flux_map`.
+
+    """
+    balance = redox_balance(cobra_model, fluxes, ox_cofactors)
+    values = balance.values
+
+    groups = np.full(values.shape, None, dtype=object)
+    if color_knockouts:
+        knocked_out = np.array([
+            reaction.lower_bound == reaction.upper_bound == 0
+            for reaction in cobra_model.reactions], dtype=bool)
+        groups[knocked_out] = 'ko'
+
+    with np.errstate(invalid='ignore'):
+        groups[values > tol] = starting_group
+        groups[values < -tol] = starting_group + 1
+
+    return pd.DataFrame(groups, index=balance.index, columns=balance.columns)
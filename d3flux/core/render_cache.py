@@ -0,0 +1,226 @@
+"""
+Content-addressed cache of rendered figures. Repeated calls to `flux_map` or
+`render_model` with the same model topology, map_info, fluxes and settings
+return the previously rendered HTML instead of serializing and templating
+the model again:
+
+    cache = RenderCache(maxsize=32, path='~/.cache/d3flux/figures')
+    flux_map(model, flux_dict=fluxes, cache=cache)
+
+`cache=True` uses the module's `default_cache`, which is memory only.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from d3flux.core.cache import LRUCache
+from d3flux.core.flux_arrays import drawn_fluxes, reaction_bounds
+from d3flux.core.model_index import incidence_index
+
+# Cached figures are rendered with this figure id, which is replaced by the
+# id requested for each figure that is returned
+FIGURE_ID_PLACEHOLDER = 'd3flux_cached_figure'
+
+
+def overlay_digest(overlay):
+    """SHA1 hex digest of the map_info in an overlay (see
+    `map_info_overlay`), ignoring any digest already stored in it"""
+    sha = hashlib.sha1()
+    for key in ('model', 'metabolites', 'reactions'):
+        sha.update(json.dumps(overlay[key], sort_keys=True, default=str,
+                              allow_nan=True).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def fingerprint(cobra_model, overlay, flux_dict=None, metabolite_dict=None,
+                settings=None):
+    """Stable SHA1 hex digest identifying a render.
+
+    Combines the digest of the model's incidence index (object ids and
+    stoichiometry), the map_info overlay, the drawn reaction and metabolite
+    fluxes rounded to 1E-8, the reaction bounds, and the JSON-encoded
+    `settings` (the render keyword arguments). Other model attributes, such
+    as gene rules or annotations embedded by a 'full' payload, are not
+    included.
+
+    The overlay is identified by the 'digest' computed when it was built
+    (see `map_info_overlay`), or hashed here if it has none.
+
+    """
+    index = incidence_index(cobra_model)
+    sha = hashlib.sha1(index.digest.encode('ascii'))
+
+    digest = overlay.get('digest') or overlay_digest(overlay)
+    sha.update(digest.encode('ascii'))
+
+    fluxes, met_fluxes = drawn_fluxes(
+        cobra_model, flux_dict, metabolite_dict,
+        stoichiometry=index.stoichiometry)
+
+    # Adding 0. turns -0. into 0., which would otherwise hash differently
+    for array in (fluxes, met_fluxes):
+        sha.update((np.round(array, 8) + 0.).tobytes())
+    sha.update((reaction_bounds(cobra_model) + 0.).tobytes())
+
+    sha.update(json.dumps(settings or {}, sort_keys=True,
+                          default=repr).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class RenderCache(object):
+    """Cache of rendered figures keyed by `fingerprint`, in memory with an
+    optional on-disk tier.
+
+    Each entry holds the figure HTML (with FIGURE_ID_PLACEHOLDER in place of
+    the figure id), the embedded model payload, and the drawn reaction and
+    metabolite fluxes.
+
+    maxsize: int
+        Maximum number of figures kept in memory.
+
+    path: str or None
+        Directory of gzipped JSON entries shared between sessions, created
+        if it doesn't exist. If None (default), the cache is memory only.
+
+    max_entries: int
+        Maximum number of figures kept on disk. The least recently used
+        entries are removed once the directory grows beyond this size.
+
+    hits, disk_hits, misses: int
+        Lookup counters. `hits` includes the lookups served from disk.
+
+    """
+
+    def __init__(self, maxsize=32, path=None, max_entries=256):
+        self.memory = LRUCache(maxsize=maxsize)
+        self.path = os.path.expanduser(path) if path else None
+        self.max_entries = max_entries
+        if self.path and not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.memory)
+
+    def __contains__(self, key):
+        return key in self.memory or (
+            self.path is not None and os.path.exists(self._filename(key)))
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.json.gz')
+
+    def _entries(self):
+        return [os.path.join(self.path, f) for f in os.listdir(self.path)
+                if f.endswith('.json.gz')]
+
+    def get(self, key):
+        """Return the entry stored under key, or None"""
+        entry = self.memory.get(key)
+        if entry is None and self.path is not None:
+            entry = self._load(key)
+            if entry is not None:
+                self.memory[key] = entry
+                self.disk_hits += 1
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _load(self, key):
+        filename = self._filename(key)
+        try:
+            with gzip.open(filename, 'rt') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        # Mark as recently used, unless another process has evicted it
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def set(self, key, entry):
+        """Store an entry in memory, and on disk if the cache has a path"""
+        self.memory[key] = entry
+        if self.path is None:
+            return
+
+        handle, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            # Fast compression: entries are mostly the inlined library
+            with gzip.open(os.fdopen(handle, 'wb'), 'wt',
+                           compresslevel=1) as f:
+                json.dump(entry, f)
+            os.replace(tmp, self._filename(key))
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+        self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        if self.max_entries is None or len(entries) <= self.max_entries:
+            return
+
+        # Entries removed by other processes sharing the directory are
+        # skipped
+        used = []
+        for filename in entries:
+            try:
+                used.append((os.path.getmtime(filename), filename))
+            except OSError:
+                pass
+        used.sort()
+        for _, filename in used[:max(len(used) - self.max_entries, 0)]:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def payload(self, key):
+        """The model payload embedded in the figure stored under key (the
+        model JSON or compact payload expression), or None"""
+        entry = self.get(key)
+        return entry['payload'] if entry is not None else None
+
+    def stats(self):
+        """Counters and sizes, as a dictionary"""
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self.memory),
+            'maxsize': self.memory.maxsize,
+            'disk_entries': len(self._entries()) if self.path else 0,
+            'max_entries': self.max_entries if self.path else 0,
+        }
+
+    def clear(self):
+        """Remove all entries, from disk as well, and reset the counters"""
+        self.memory.clear()
+        if self.path is not None:
+            for filename in self._entries():
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+        self.hits = self.disk_hits = self.misses = 0
+
+
+# Memory-only cache used by `flux_map(..., cache=True)`
+default_cache = RenderCache()
@@ -0,0 +1,275 @@
+"""
+Streaming summaries of flux samples (e.g. from cobra.sampling.sample), for
+drawing flux distributions on the map. Samples are read in blocks of rows
+from a .npy file (memory-mapped), an array or DataFrame, or an iterator of
+chunks, so the sample matrix never has to fit in memory:
+
+    summary = summarize_samples(model, 'samples.npy')
+    flux_map(model, samples=summary)
+
+Each reaction is drawn with its median flux as the link width, its
+interquartile range as a translucent band around the link, and the fraction
+of samples in which it carries flux as its opacity. Metabolites are
+summarized the same way by their throughput (|S|.|v| / 2) in each sample.
+"""
+
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from d3flux.core.model_index import incidence_index
+
+# Statistics of each reaction and metabolite, the columns of the summaries
+STATISTICS = ['median', 'q1', 'q3', 'nonzero', 'mean', 'count']
+
+# Samples below this magnitude count as zero flux, as in drawn_fluxes
+ZERO_FLUX = 1E-8
+
+
+class StreamingQuantiles(object):
+    """Per-column quantiles, nonzero fractions and means of a stream of
+    sample blocks, in memory independent of the number of samples.
+
+    Nonzero values are counted in a histogram of asinh(value / scale) with
+    `bins` equal bins between -limit and limit (values beyond are counted in
+    the outermost bins), so quantiles are accurate to a fixed fraction of
+    their magnitude (about 2.8% before interpolation with the defaults),
+    down to `scale`. Zeros are counted exactly, so a quantile falling among
+    them is 0. NaN values are skipped.
+
+    n_columns: int
+        Number of columns (reactions or metabolites) in each block.
+
+    limit: float
+        Largest expected absolute value, e.g. the largest reaction bound.
+
+    scale: float
+        Magnitude below which bins are evenly spaced rather than logarithmic.
+
+    bins: int
+        Number of histogram bins per column. Memory use is 4 * bins bytes per
+        column.
+
+    """
+
+    def __init__(self, n_columns, limit=1000., scale=1E-3, bins=1024):
+        if bins % 2:
+            raise ValueError('bins must be even')
+        self.n_columns = n_columns
+        self.scale = scale
+        self.bins = bins
+        self.half_range = np.arcsinh(limit / scale)
+        self.width = 2 * self.half_range / bins
+        self.histogram = np.zeros((n_columns, bins), dtype=np.int32)
+        self.zeros = np.zeros(n_columns, dtype=np.int64)
+        self.count = np.zeros(n_columns, dtype=np.int64)
+        self.total = np.zeros(n_columns)
+
+    def update(self, block):
+        """Add a (samples x columns) block of values"""
+        block = np.asarray(block, dtype=float)
+        valid = np.isfinite(block)
+        zero = valid & (np.abs(block) < ZERO_FLUX)
+        self.count += valid.sum(0)
+        self.zeros += zero.sum(0)
+        self.total += np.where(valid, block, 0.).sum(0)
+
+        rows, cols = np.nonzero(valid & ~zero)
+        index = np.floor(
+            (np.arcsinh(block[rows, cols] / self.scale) + self.half_range) /
+            self.width).astype(np.int64)
+        np.clip(index, 0, self.bins - 1, out=index)
+        self.histogram += np.bincount(
+            cols * self.bins + index,
+            minlength=self.n_columns * self.bins).reshape(
+                self.n_columns, self.bins)
+
+    def quantile(self, q):
+        """The q-th quantile (0 <= q <= 1) of each column, NaN for columns
+        without values"""
+        half = self.bins // 2
+
+        # Zeros sit between the negative and positive bins
+        counts = np.concatenate([self.histogram[:, :half],
+                                 self.zeros[:, np.newaxis],
+                                 self.histogram[:, half:]], axis=1)
+        cumulative = counts.cumsum(1)
+        rank = q * self.count
+        index = np.minimum((cumulative < rank[:, np.newaxis]).sum(1),
+                           self.bins)
+
+        rows = np.arange(self.n_columns)
+        below = np.where(index > 0,
+                         cumulative[rows, np.maximum(index - 1, 0)], 0)
+        within = counts[rows, index]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip(np.where(within > 0,
+                                        (rank - below) / within, 0.5), 0, 1)
+
+        # Position in the histogram, skipping the zero column
+        bin_index = np.where(index > half, index - 1, index)
+        t = -self.half_range + (bin_index + fraction) * self.width
+        values = self.scale * np.sinh(t)
+        values[index == half] = 0.
+        values[self.count == 0] = np.nan
+        return values
+
+    def nonzero(self):
+        """Fraction of the values of each column that are nonzero"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return 1. - self.zeros / self.count.astype(float)
+
+    def mean(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.total / self.count
+
+    def summary(self, index=None):
+        """The statistics as a DataFrame with the STATISTICS columns"""
+        return pd.DataFrame({
+            'median': self.quantile(.5),
+            'q1': self.quantile(.25),
+            'q3': self.quantile(.75),
+            'nonzero': self.nonzero(),
+            'mean': self.mean(),
+            'count': self.count,
+        }, index=index, columns=STATISTICS)
+
+
+def sample_blocks(samples, reaction_ids, columns=None, block_rows=None):
+    """Yield the samples as float arrays of (samples x reactions) blocks,
+    with columns ordered as `reaction_ids` and NaN for missing reactions.
+
+    samples: str, array, pandas.DataFrame, or iterable
+        A .npy filename, which is memory-mapped; an array (e.g. a
+        numpy.memmap) or DataFrame of one sample per row; or an iterable of
+        such blocks. DataFrame columns are matched by reaction id.
+
+    columns: list
+        Reaction ids of the array columns. Defaults to `reaction_ids`.
+
+    block_rows: int
+        Rows per block read from an array or DataFrame. Defaults to about 8
+        MB of samples per block.
+
+    """
+    if isinstance(samples, str):
+        samples = np.load(samples, mmap_mode='r')
+
+    if block_rows is None:
+        block_rows = max(1, 2 ** 20 // max(len(reaction_ids), 1))
+
+    positions = {rxn_id: j for j, rxn_id in enumerate(reaction_ids)}
+
+    def align(block):
+        if isinstance(block, pd.DataFrame):
+            return block.reindex(columns=reaction_ids).values.astype(float)
+        block = np.asarray(block, dtype=float)
+        if block.ndim == 1:
+            block = block[np.newaxis, :]
+        if columns is None or list(columns) == list(reaction_ids):
+            if block.shape[1] != len(reaction_ids):
+                raise ValueError(
+                    'Samples have {} columns, expected {} reactions'.format(
+                        block.shape[1], len(reaction_ids)))
+            return block
+        aligned = np.full((block.shape[0], len(reaction_ids)), np.nan)
+        for i, rxn_id in enumerate(columns):
+            if rxn_id in positions:
+                aligned[:, positions[rxn_id]] = block[:, i]
+        return aligned
+
+    if isinstance(samples, (np.ndarray, pd.DataFrame)):
+        for start in range(0, len(samples), block_rows):
+            if isinstance(samples, pd.DataFrame):
+                yield align(samples.iloc[start:start + block_rows])
+            else:
+                yield align(samples[start:start + block_rows])
+    else:
+        for block in samples:
+            yield align(block)
+
+
+def summarize_samples(cobra_model, samples, columns=None, block_rows=None,
+                      bins=1024, limit=None):
+    """Median, quartiles, nonzero fraction and mean of the sampled fluxes of
+    each reaction, and of the throughput of each metabolite, computed in one
+    streaming pass over the samples.
+
+    samples: str, array, pandas.DataFrame, or iterable
+        The flux samples, one per row (see `sample_blocks`). Arrays and .npy
+        files must have columns ordered as `cobra_model.reactions`, unless
+        `columns` is given.
+
+    bins: int
+        Histogram bins per reaction and metabolite (see StreamingQuantiles).
+
+    limit: float
+        Largest expected absolute flux. Defaults to the largest finite
+        reaction bound in the model.
+
+    Returns a dictionary with 'reactions' and 'metabolites' DataFrames,
+    indexed by id with the STATISTICS columns, to pass as `samples` to
+    `flux_map`.
+
+    """
+    index = incidence_index(cobra_model)
+    reaction_ids = index.reaction_ids
+    absolute = abs(index.stoichiometry).tocsr()
+
+    if limit is None:
+        bounds = np.array([reaction.bounds for reaction in
+                           cobra_model.reactions], dtype=float)
+        bounds = np.abs(bounds[np.isfinite(bounds)])
+        limit = bounds.max() if bounds.size and bounds.max() > 0 else 1000.
+
+    # Throughputs are at most half the largest row sum of |S| times limit
+    met_limit = limit * max(absolute.sum(1).max() / 2., 1.)
+
+    reactions = StreamingQuantiles(len(reaction_ids), limit=limit, bins=bins)
+    metabolites = StreamingQuantiles(len(index.metabolite_ids),
+                                     limit=met_limit, bins=bins)
+
+    for block in sample_blocks(samples, reaction_ids, columns, block_rows):
+        reactions.update(block)
+        metabolites.update(absolute.dot(np.abs(block).T).T / 2)
+
+    return {'reactions': reactions.summary(reaction_ids),
+            'metabolites': metabolites.summary(index.metabolite_ids)}
+
+
+def is_summary(samples):
+    """Whether `samples` is a summary from `summarize_samples`, rather than
+    the samples themselves"""
+    return isinstance(samples, dict) and 'reactions' in samples
+
+
+def add_sample_channels(cobra_model, overlay, summary):
+    """Write the quartiles of a sample summary into the overlay map_info as
+    `flux_q1` and `flux_q3`, and the fraction of samples carrying flux as
+    `nonzero`, for the reactions and metabolites drawn with a flux"""
+    index = incidence_index(cobra_model)
+    for key, ids in (('reactions', index.reaction_ids),
+                     ('metabolites', index.metabolite_ids)):
+        table = summary[key].reindex(ids)
+        values = table[['q1', 'q3', 'nonzero']].values.astype(float)
+        with np.errstate(invalid='ignore'):
+            values[:, :2] = np.where(np.abs(values[:, :2]) < ZERO_FLUX, 0.,
+                                     values[:, :2])
+        for map_info, (q1, q3, nonzero) in zip(overlay[key], values):
+            if 'flux' not in map_info or np.isnan(q1) or np.isnan(q3):
+                continue
+            map_info['flux_q1'] = float(q1)
+            map_info['flux_q3'] = float(q3)
+            map_info['nonzero'] = float(nonzero)
+
+
+def summary_digest(summary):
+    """SHA1 hex digest of a sample summary, for the render cache"""
+    sha = hashlib.sha1()
+    for key in ('reactions', 'metabolites'):
+        table = summary[key]
+        sha.update('\n'.join(str(i) for i in table.index).encode('utf-8'))
+        sha.update((np.round(table[STATISTICS].values.astype(float), 8) +
+                    0.).tobytes())
+    return sha.hexdigest()
@@ -0,0 +1,254 @@
+"""
+Maps collapsed by subsystem. The model is drawn as one node per group of
+reactions (by default, per `reaction.subsystem`), linked through the
+metabolites the groups share. The reactions of each group are embedded in the
+figure as a compressed chunk, which d3flux.js decodes and draws in place of
+the group's node when it is clicked:
+
+    flux_map(model, flux_dict=fluxes, collapse=True)
+
+The initial payload and the browser layout then scale with the number of
+groups rather than the number of reactions.
+"""
+
+import math
+
+from d3flux.core.payload import compact_payload, compress_payload
+
+COLLAPSED_FORMAT = 'd3flux.collapsed.v1'
+
+# Group nodes are named GROUP_PREFIX + their position in the group order
+GROUP_PREFIX = 'd3flux_group_'
+
+# Group of the reactions without a subsystem
+UNASSIGNED = 'Unassigned'
+
+
+def reaction_groups(cobra_model, collapse=True):
+    """The group name of each reaction in the model, as a list.
+
+    collapse: True, dict-like or function
+        True groups reactions by `reaction.subsystem`. A dict-like (such as a
+        pandas.Series) maps reaction ids to group names, and a function is
+        called with each reaction. Reactions without a group (an empty
+        subsystem, missing from the mapping, None or NaN) are placed in the
+        'Unassigned' group.
+
+    """
+    reactions = cobra_model.reactions
+    if collapse is True:
+        names = [reaction.subsystem for reaction in reactions]
+    elif callable(collapse):
+        names = [collapse(reaction) for reaction in reactions]
+    else:
+        names = [collapse.get(reaction.id) for reaction in reactions]
+
+    def name(group):
+        if group is None or (isinstance(group, float) and math.isnan(group)):
+            return UNASSIGNED
+        return str(group) or UNASSIGNED
+
+    return [name(group) for group in names]
+
+
+def _map_info(obj):
+    return obj.get('notes', {}).get('map_info', {})
+
+
+def _flux(map_info):
+    flux = map_info.get('flux')
+    if flux is None or math.isnan(flux):
+        return None
+    return flux
+
+
+def collapse_model(model_data, groups):
+    """Split a model dictionary (from `create_model_dict`) into a coarse model
+    with one node per group of reactions, and the detailed model of each
+    group.
+
+    groups: list
+        The group name of each reaction in model_data, e.g. from
+        `reaction_groups`.
+
+    Returns (coarse, chunks). `coarse` is a model dictionary in the same
+    layout as model_data, and `chunks` maps the id of each group node to the
+    model dictionary of the group's reactions and their metabolites.
+
+    Hidden reactions are left out. Each group node is drawn as a metabolite
+    whose map_info holds the group name as `subsystem` and `display_name`,
+    the number of `reactions`, and as its flux, the summed absolute flux
+    through them. It is placed at the mean position of the group's
+    metabolites, if any are placed.
+
+    Groups sharing visible metabolites are linked by a reaction from the
+    producing to the consuming group, whose flux is the amount of the shared
+    metabolites passed between them (each group's net production, split
+    between the consuming groups in proportion to their net consumption).
+    Without fluxes, groups are linked wherever one produces a metabolite the
+    other consumes. The linked pair of group nodes is stored as
+    `subsystem_link`.
+
+    Each chunk also holds the links from its shared metabolites to the other
+    groups using them, drawn once the group is expanded, with the group's net
+    production or consumption of the metabolite as flux. These name the
+    other group's node as `subsystem_node`.
+
+    """
+    metabolites = {met['id']: met for met in model_data['metabolites']}
+
+    order = []
+    members = {}
+    for reaction, group in zip(model_data['reactions'], groups):
+        if _map_info(reaction).get('hidden'):
+            continue
+        if group not in members:
+            order.append(group)
+            members[group] = []
+        members[group].append(reaction)
+
+    node_ids = {group: GROUP_PREFIX + str(i) for i, group in enumerate(order)}
+
+    # Net production of each metabolite by each group, whether the group
+    # produces or consumes it in any reaction, and whether all those
+    # reactions have fluxes
+    net = {}
+    users = {}
+    for group in order:
+        for reaction in members[group]:
+            flux = _flux(_map_info(reaction))
+            for met_id, coeff in reaction['metabolites'].items():
+                key = (group, met_id)
+                if key not in net:
+                    net[key] = [0., False, False, True]
+                    users.setdefault(met_id, []).append(group)
+                entry = net[key]
+                if flux is None:
+                    entry[3] = False
+                else:
+                    entry[0] += coeff * flux
+                entry[1] = entry[1] or coeff > 0
+                entry[2] = entry[2] or coeff < 0
+
+    def visible(met_id):
+        return not _map_info(metabolites[met_id]).get('hidden')
+
+    shared = set(met_id for met_id, used_by in users.items()
+                 if len(used_by) > 1 and visible(met_id))
+
+    def direction(group, met_id):
+        """(coefficient of met_id for the group, flux or None)"""
+        production, produces, consumes, has_flux = net[(group, met_id)]
+        if has_flux:
+            return (1 if production > 0 else -1), abs(production)
+        return (1 if produces else -1), None
+
+    # Amount of the shared metabolites passed between each pair of groups
+    transfers = {}
+    for met_id in shared:
+        entries = [(group, net[(group, met_id)]) for group in users[met_id]]
+        if all(entry[3] for group, entry in entries):
+            consumed = sum(-entry[0] for group, entry in entries
+                           if entry[0] < 0)
+            for source, entry in entries:
+                for target, other in entries:
+                    if entry[0] > 0 and other[0] < 0:
+                        transfer = transfers.setdefault(
+                            (source, target), [0., True])
+                        transfer[0] += entry[0] * -other[0] / consumed
+        else:
+            for source, entry in entries:
+                for target, other in entries:
+                    if source != target and entry[1] and other[2]:
+                        transfers.setdefault(
+                            (source, target), [0., True])[1] = False
+
+    coarse_metabolites = []
+    coarse_reactions = []
+    chunks = {}
+
+    for group in order:
+        node_id = node_ids[group]
+        reactions = members[group]
+        fluxes = [_flux(_map_info(reaction)) for reaction in reactions]
+        map_info = {'display_name': group, 'subsystem': group,
+                    'reactions': len(reactions)}
+        if any(flux is not None for flux in fluxes):
+            map_info['flux'] = sum(abs(flux) for flux in fluxes
+                                   if flux is not None)
+
+        used = {}
+        for reaction in reactions:
+            used.update(dict.fromkeys(reaction['metabolites']))
+
+        placed = [_map_info(metabolites[met_id]) for met_id in used
+                  if visible(met_id)]
+        placed = [info for info in placed if 'x' in info and 'y' in info]
+        if placed:
+            map_info['x'] = sum(info['x'] for info in placed) / len(placed)
+            map_info['y'] = sum(info['y'] for info in placed) / len(placed)
+
+        node = {'id': node_id, 'name': group, 'notes': {'map_info': map_info}}
+        coarse_metabolites.append(node)
+
+        # Links from the shared metabolites to the other groups' nodes
+        links = []
+        linked = {}
+        for met_id in used:
+            if met_id not in shared:
+                continue
+            for other in users[met_id]:
+                if other == group:
+                    continue
+                other_id = node_ids[other]
+                coeff, flux = direction(other, met_id)
+                link_info = {'subsystem_node': other_id}
+                if flux is not None:
+                    link_info['flux'] = flux
+                links.append({
+                    'id': '{}__{}'.format(other_id, met_id),
+                    'metabolites': {other_id: -coeff, met_id: coeff},
+                    'notes': {'map_info': link_info}})
+                linked[other_id] = None
+
+        chunks[node_id] = {
+            'id': model_data.get('id'),
+            'notes': {'map_info': {}},
+            'metabolites': ([metabolites[met_id] for met_id in used] +
+                            [{'id': other_id, 'name': other_id,
+                              'notes': {'map_info': {'subsystem_stub': True}}}
+                             for other_id in linked]),
+            'reactions': reactions + links,
+        }
+
+    def pair_order(item):
+        return node_ids[item[0][0]], node_ids[item[0][1]]
+
+    for (source, target), (flux, has_flux) in sorted(transfers.items(),
+                                                     key=pair_order):
+        source_id, target_id = node_ids[source], node_ids[target]
+        map_info = {'subsystem_link': [source_id, target_id]}
+        if has_flux:
+            map_info['flux'] = flux
+        coarse_reactions.append({
+            'id': '{}__{}'.format(source_id, target_id),
+            'name': '{} to {}'.format(source, target),
+            'metabolites': {source_id: -1, target_id: 1},
+            'notes': {'map_info': map_info}})
+
+    coarse = {'id': model_data.get('id'), 'notes': model_data.get('notes', {}),
+              'metabolites': coarse_metabolites,
+              'reactions': coarse_reactions}
+    return coarse, chunks
+
+
+def collapsed_payload(coarse, chunks):
+    """The payload of a collapsed figure, loaded by `load_model` in
+    d3flux.js: the coarse model as a compact payload, and the compact payload
+    of each group's chunk, gzipped and base64-encoded"""
+    return {
+        'format': COLLAPSED_FORMAT,
+        'model': compact_payload(coarse),
+        'chunks': {node_id: compress_payload(compact_payload(chunk))
+                   for node_id, chunk in chunks.items()},
+    }
@@ -0,0 +1,479 @@
+"""
+Headless SVG export. Draws the same figure as d3flux.js -- flux-scaled
+links, dash arrays, group colors, arrowhead markers, aligned labels and the
+ranges of sampled fluxes -- directly from the node positions in map_info,
+without a browser.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+from d3flux.core.graph import build_graph, _map_info, _is_unused
+from d3flux.core.template_cache import render_css
+
+# rxncolor in d3flux.js: 'undefined' (no group), 'ko', then groups 1-8.
+# Other groups are assigned the next colors in order of appearance, as with
+# d3.scale.ordinal.
+RXN_COLORS = ["#bbb", "#d62728", "#eb6a9b", "#6f3589", "#f18572", "#246035",
+              "#009fea", "#83522b", "#29378a", "#989033"]
+RXN_GROUPS = ['undefined', 'ko', '1', '2', '3', '4', '5', '6', '7', '8']
+
+# Padding between a link and the circle of the node it ends on
+PADDING = 5
+
+
+def _flux(map_info):
+    """Absolute flux, or NaN if missing (as Math.abs(undefined) in JS)"""
+    flux = map_info.get('flux')
+    return np.nan if flux is None else abs(flux)
+
+
+def _iqr_extent(map_info):
+    """Largest absolute flux in the interquartile range of sampled fluxes"""
+    return max(abs(map_info['flux_q1']), abs(map_info['flux_q3']))
+
+
+def _linear_scale(values, lower, upper):
+    """d3.scale.linear with the domain [min(values), max(values)]. NaNs are
+    ignored; without any values the scale returns NaN."""
+    values = [value for value in values if not np.isnan(value)]
+    if not values:
+        return lambda x: np.nan
+    d0, d1 = min(values), max(values)
+    slope = (upper - lower) / (d1 - d0) if d1 != d0 else 0.
+    return lambda x: lower + (x - d0) * slope
+
+
+class FluxStyles(object):
+    """Python mirror of the styling functions in d3flux.js"""
+
+    def __init__(self, fluxes, mfluxes, default_flux_width=2.5):
+        self.flux_scale = _linear_scale(fluxes, 1.5, 6)
+        self.metabolite_scale = _linear_scale(mfluxes, 4, 8)
+        self.default_flux_width = default_flux_width
+        self.groups = list(RXN_GROUPS)
+
+    @staticmethod
+    def arrowhead_scale(width):
+        return 6 + (width - 1.5) * 6 / 4.5
+
+    def rxncolor(self, group):
+        key = 'undefined' if group is None else str(group)
+        if key not in self.groups:
+            self.groups.append(key)
+        return RXN_COLORS[self.groups.index(key) % len(RXN_COLORS)]
+
+    def flux_width(self, map_info):
+        if 'stroke' in map_info:
+            return map_info['stroke']
+        width = self.flux_scale(_flux(map_info))
+        return self.default_flux_width if np.isnan(width) else width
+
+    @staticmethod
+    def flux_dasharray(map_info):
+        if 'dasharray' in map_info:
+            return map_info['dasharray']
+        if map_info.get('group') == 'ko':
+            return "5, 5, 1, 5"
+        if _flux(map_info) < 1E-6:
+            return "5,5"
+        return None
+
+    def flux_stroke(self, map_info):
+        if 'color' in map_info:
+            return map_info['color']
+        return self.rxncolor(map_info.get('group'))
+
+    def node_radius(self, node):
+        if node['type'] == 'cofactor':
+            return 4
+        radius = self.metabolite_scale(_flux(node['map_info']))
+        return 5 if np.isnan(radius) else radius
+
+    @staticmethod
+    def flux_alpha(map_info):
+        """Opacity from the fraction of flux samples carrying flux, or None
+        if the map doesn't show sampled fluxes"""
+        if 'nonzero' in map_info:
+            return max(map_info['nonzero'], .1)
+        return None
+
+    def iqr_width(self, map_info):
+        """Width of the band showing the interquartile range of a reaction's
+        sampled fluxes, or None if it has none"""
+        if 'stroke' in map_info or 'flux_q3' not in map_info:
+            return None
+        return self.flux_scale(_iqr_extent(map_info))
+
+    def iqr_radius(self, node):
+        """Radius of the ring showing the interquartile range of a
+        metabolite's sampled throughput, or None if it has none"""
+        if node['type'] != 'metabolite' or 'flux_q3' not in node['map_info']:
+            return None
+        return self.metabolite_scale(_iqr_extent(node['map_info']))
+
+    @staticmethod
+    def reverse_arrowhead(map_info):
+        flux = _flux(map_info)
+        return bool((np.isnan(flux) or flux < 1E-8) and
+                    map_info.get('reversibility'))
+
+
+def _is_inactive(map_info):
+    return map_info.get('flux', np.nan) == 0
+
+
+def _opacity(attr, alpha):
+    """An opacity attribute, or nothing at full opacity"""
+    return '' if alpha is None else ' {}="{}"'.format(attr, alpha)
+
+
+def _circle_roots(p1, p2, p3, center, radius):
+    """Parameters t in [0, 1] at which each quadratic Bezier curve (p1, p2,
+    p3) crosses a circle, as Intersection.intersectBezier2Circle. All
+    arguments are (n, 2) arrays, except radius (n,). Returns the (first,
+    last) crossings, NaN where there is none."""
+
+    c2 = p1 - 2 * p2 + p3
+    c1 = 2 * (p2 - p1)
+    c0 = p1 - center
+    coeffs = np.stack([
+        (c2 * c2).sum(1),
+        2 * (c2 * c1).sum(1),
+        2 * (c2 * c0).sum(1) + (c1 * c1).sum(1),
+        2 * (c1 * c0).sum(1),
+        (c0 * c0).sum(1) - radius ** 2], axis=1)
+
+    roots = np.full((len(coeffs), 4), np.nan, dtype=complex)
+
+    # Quartics are solved together as eigenvalues of their companion
+    # matrices; curves that are straight lines fall back to np.roots
+    scale = np.abs(coeffs).max(1)
+    quartic = np.abs(coeffs[:, 0]) > 1E-9 * np.maximum(scale, 1E-300)
+    if quartic.any():
+        monic = coeffs[quartic, 1:] / coeffs[quartic, :1]
+        companion = np.zeros((len(monic), 4, 4))
+        companion[:, 0, :] = -monic
+        companion[:, [1, 2, 3], [0, 1, 2]] = 1.
+        roots[quartic] = np.linalg.eigvals(companion)
+    for i in np.flatnonzero(~quartic):
+        found = np.roots(coeffs[i]) if np.isfinite(coeffs[i]).all() else []
+        roots[i, :len(found)] = found
+
+    real = roots.real
+    valid = ((np.abs(roots.imag) <= 1E-7 * np.maximum(1, np.abs(real))) &
+             (real >= 0) & (real <= 1))
+    with np.errstate(invalid='ignore'):
+        first = np.where(valid, real, np.inf).min(1)
+        last = np.where(valid, real, -np.inf).max(1)
+    first[~valid.any(1)] = np.nan
+    last[~valid.any(1)] = np.nan
+    return first, last
+
+
+def link_paths(graph, positions, styles):
+    """SVG path strings for each of the graph's bilinks, following
+    calculate_path in d3flux.js: two quadratic Bezier segments through the
+    reaction node, bent along the mean direction of its metabolites and
+    trimmed to the node circles and arrowheads.
+
+    graph: FluxGraph
+    positions: (len(graph), 2) array of node positions
+    styles: FluxStyles
+
+    """
+    if not graph.bilinks:
+        return []
+
+    nodes = graph.nodes
+    bilinks = np.array(graph.bilinks, dtype=int)
+    s, r, t = positions[bilinks[:, 0]], positions[bilinks[:, 1]], \
+        positions[bilinks[:, 2]]
+
+    # rstoich of each reaction node: +1 for link sources, -1 for targets
+    rstoich = {}
+    for source, rxn, target in graph.bilinks:
+        rstoich.setdefault(rxn, {})[source] = 1
+        rstoich[rxn][target] = -1
+
+    entries = np.array([(rxn, n, sign) for rxn, stoich in rstoich.items()
+                        for n, sign in stoich.items()], dtype=int)
+    rxns, members, signs = entries.T
+    offsets = positions[rxns] - positions[members]
+    counts = np.bincount(rxns, minlength=len(nodes))
+    dist = np.bincount(rxns, np.sqrt((offsets ** 2).sum(1)),
+                       minlength=len(nodes))
+
+    # Mean direction to the non-cofactor metabolites, as a complex number
+    primary = np.array([nodes[n]['type'] != 'cofactor' for n in members])
+    phase = signs * primary * np.exp(
+        1j * np.arctan2(offsets[:, 0], offsets[:, 1]))
+    mean = (np.bincount(rxns, phase.real, minlength=len(nodes)) +
+            1j * np.bincount(rxns, phase.imag, minlength=len(nodes)))
+    angle = np.where(np.bincount(rxns, primary, minlength=len(nodes)) > 0,
+                     np.angle(mean), np.nan)[bilinks[:, 1]]
+    dist = (dist / np.maximum(counts, 1))[bilinks[:, 1]]
+
+    bend = .5 * dist[:, None] * np.stack([np.sin(angle), np.cos(angle)], 1)
+    cp, cp_inv = r - bend, r + bend
+
+    radius = np.array([styles.node_radius(node) for node in nodes])
+    arrowhead = np.array([
+        styles.arrowhead_scale(styles.flux_width(nodes[rxn]['map_info']))
+        for rxn in bilinks[:, 1]])
+    reverse = np.array([styles.reverse_arrowhead(nodes[rxn]['map_info'])
+                        for rxn in bilinks[:, 1]])
+
+    a, _ = _circle_roots(s, cp, r, s, PADDING + radius[bilinks[:, 0]] +
+                         np.where(reverse, arrowhead, 0.))
+    _, b = _circle_roots(r, cp_inv, t, t,
+                         PADDING + arrowhead + radius[bilinks[:, 2]])
+    a, b = a[:, None], b[:, None]
+
+    # Split the curves at a and b (de Casteljau)
+    source = s * (1 - a) ** 2 + 2 * cp * a * (1 - a) + r * a ** 2
+    control = cp * (1 - a) + r * a
+    control_inv = r * (1 - b) + cp_inv * b
+    target = r * (1 - b) ** 2 + 2 * cp_inv * b * (1 - b) + t * b ** 2
+
+    curved = np.isfinite(np.hstack([source, control, control_inv, target])
+                         ).all(1)
+
+    paths = []
+    for i in range(len(bilinks)):
+        if curved[i]:
+            paths.append('M{:.2f},{:.2f} Q{:.2f},{:.2f} {:.2f},{:.2f} '
+                         'Q{:.2f},{:.2f} {:.2f},{:.2f}'.format(
+                             source[i, 0], source[i, 1],
+                             control[i, 0], control[i, 1], r[i, 0], r[i, 1],
+                             control_inv[i, 0], control_inv[i, 1],
+                             target[i, 0], target[i, 1]))
+        else:
+            paths.append('M{:.2f},{:.2f} L{:.2f},{:.2f} L{:.2f},{:.2f}'.format(
+                s[i, 0], s[i, 1], r[i, 0], r[i, 1], t[i, 0], t[i, 1]))
+    return paths
+
+
+def _label_lines(node, name):
+    if 'display_name' in node['map_info']:
+        return node['map_info']['display_name'].split('\n')
+    return [name] if name is not None else []
+
+
+def _label_attrs(map_info):
+    """y offset and text-anchor of a label, and the x offset of its lines,
+    from map_info['align']"""
+    align = map_info.get('align', '')
+    vertical = ('upper' in align) or ('lower' in align)
+
+    y = '-.65em' if 'upper' in align else '1.35em' if 'lower' in align \
+        else '.35em'
+    if 'left' in align:
+        return y, 'end', '-.6em' if vertical else '-.9em'
+    if 'center' in align:
+        return y, 'middle', '0em'
+    return y, 'start', '.6em' if vertical else '.9em'
+
+
+def model_svg(model_data, figure_id='d3flux', hide_unused=None,
+              hide_unused_cofactors=None, inactive_alpha=1., figsize=None,
+              fontsize=None, default_flux_width=2.5, custom_css=None,
+              graph=None, **kwargs):
+    """Draw a serialized model as an SVG document.
+
+    model_data:
+        The model dictionary from `create_model_dict`. Every drawn node must
+        have x and y positions in its map_info (see `layout_model`).
+
+    figure_id:
+        Prefix of the arrowhead marker ids.
+
+    graph:
+        The FluxGraph of model_data, if it was already built (e.g., by
+        `layout_model`).
+
+    The remaining arguments are as in `render_model`. Options that only
+    affect the browser (e.g. svg_scale or settle_iterations) are accepted and
+    ignored. Returns the SVG markup as a string.
+
+    """
+    if not figsize:
+        figsize = (1028, 768)
+    if not fontsize:
+        fontsize = 12
+    if not figure_id:
+        figure_id = 'd3flux'
+
+    width, height = figsize
+    if graph is None:
+        graph = build_graph(model_data, hide_unused, hide_unused_cofactors)
+    metabolites = {met['id']: met for met in model_data['metabolites']}
+
+    # Cofactor nodes inherit the flux, color and display name of the
+    # metabolite they stand for, without changing the reaction's map_info
+    for node in graph.nodes:
+        if node['type'] == 'cofactor':
+            orig_info = _map_info(metabolites[node['orig_id']])
+            map_info = dict(node['map_info'])
+            for key in ('flux', 'color', 'display_name'):
+                if key in orig_info and (key != 'display_name' or
+                                         key not in map_info):
+                    map_info[key] = orig_info[key]
+            node['map_info'] = map_info
+
+    missing = [node['id'] for node in graph.nodes
+               if not ('x' in node['map_info'] and 'y' in node['map_info'])]
+    if missing:
+        raise ValueError('Nodes have no position: {}. Compute a layout with '
+                         'layout_model first'.format(', '.join(missing[:5])))
+
+    positions = np.array([(node['map_info']['x'], node['map_info']['y'])
+                          for node in graph.nodes], dtype=float).reshape(-1, 2)
+
+    # Scale domains, collected as in d3flux.js' build_graph, including the
+    # interquartile ranges of sampled fluxes
+    fluxes = []
+    for rxn in model_data['reactions']:
+        map_info = _map_info(rxn)
+        if map_info.get('hidden') or map_info.get('flux') is None or (
+                hide_unused and _is_unused(map_info)):
+            continue
+        fluxes.append(abs(map_info['flux']))
+        if 'flux_q3' in map_info:
+            fluxes.append(_iqr_extent(map_info))
+    mfluxes = []
+    for node in graph.nodes:
+        if node['type'] == 'metabolite':
+            mfluxes.append(_flux(node['map_info']))
+            if 'flux_q3' in node['map_info']:
+                mfluxes.append(_iqr_extent(node['map_info']))
+    styles = FluxStyles(fluxes, mfluxes, default_flux_width)
+
+    paths = link_paths(graph, positions, styles)
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" version="1.1" '
+           'viewBox="0 0 {0} {1}" width="{0}" height="{1}">'.format(
+               width, height),
+           '<style>{}</style>'.format(
+               escape(render_css(inactive_alpha, fontsize, custom_css or '')))]
+
+    # Arrowhead markers, one per drawn reaction
+    out.append('<defs>')
+    drawn = sorted(set(r for _, r, _ in graph.bilinks))
+    for rxn in drawn:
+        map_info = graph.nodes[rxn]['map_info']
+        size = '{}pt'.format(styles.arrowhead_scale(
+            styles.flux_width(map_info)))
+        inactive = ' inactive' if _is_inactive(map_info) else ''
+        color = styles.flux_stroke(map_info)
+        marker_id = escape(figure_id + graph.nodes[rxn]['id'])
+
+        out.append(
+            '<marker id="{}" viewBox="0 0 10 10" refX="1" refY="5" '
+            'markerUnits="userSpaceOnUse" markerWidth="{}" '
+            'markerHeight="{}" orient="auto" class="endmarker{}">'
+            '<path d="M 0 0 L 10 5 L 0 10 z" fill={}{}/></marker>'.format(
+                marker_id, size, size, inactive, quoteattr(color),
+                _opacity('fill-opacity', styles.flux_alpha(map_info))))
+        if styles.reverse_arrowhead(map_info):
+            out.append(
+                '<marker id="{}_rev" viewBox="0 0 10 10" refX="9" refY="5" '
+                'markerUnits="userSpaceOnUse" markerWidth="{}" '
+                'markerHeight="{}" orient="auto" class="startmarker{}">'
+                '<path d="M 10,10 0,5 10,0 Z" fill={}{}/></marker>'.format(
+                    marker_id, size, size, inactive, quoteattr(color),
+                    _opacity('fill-opacity', styles.flux_alpha(map_info))))
+    out.append('</defs>')
+
+    # Interquartile ranges of sampled fluxes, as translucent bands under the
+    # links
+    bands = []
+    for (_, rxn, _), path in zip(graph.bilinks, paths):
+        map_info = graph.nodes[rxn]['map_info']
+        band_width = styles.iqr_width(map_info)
+        if band_width is not None:
+            bands.append('<path class="flux-iqr" fill="none" '
+                         'stroke-opacity="0.25" stroke-width="{}" stroke={} '
+                         'd="{}"/>'.format(
+                             band_width, quoteattr(styles.flux_stroke(map_info)),
+                             path))
+    if bands:
+        out += ['<g>'] + bands + ['</g>']
+
+    # Links
+    out.append('<g>')
+    for (_, rxn, _), path in zip(graph.bilinks, paths):
+        map_info = graph.nodes[rxn]['map_info']
+        marker_id = escape(figure_id + graph.nodes[rxn]['id'])
+        dasharray = styles.flux_dasharray(map_info)
+
+        out.append('<path class="link {}{}" marker-end="url(#{})"{} '
+                   'stroke-width="{}" stroke={}{}{} d="{}"/>'.format(
+                       marker_id,
+                       ' inactive' if _is_inactive(map_info) else '',
+                       marker_id,
+                       ' marker-start="url(#{}_rev)"'.format(marker_id)
+                       if styles.reverse_arrowhead(map_info) else '',
+                       styles.flux_width(map_info),
+                       quoteattr(styles.flux_stroke(map_info)),
+                       ' stroke-dasharray={}'.format(quoteattr(dasharray))
+                       if dasharray else '',
+                       _opacity('stroke-opacity', styles.flux_alpha(map_info)),
+                       path))
+    out.append('</g>')
+
+    # Nodes and labels. Reaction nodes are hidden by default in d3flux.js and
+    # only their labels are drawn.
+    out.append('<g>')
+    for node, (x, y) in zip(graph.nodes, positions):
+        map_info = node['map_info']
+        inactive = ' inactive' if _is_inactive(map_info) else ''
+        out.append('<g transform="translate({:.2f},{:.2f})">'.format(
+            min(max(x, 0), width), min(max(y, 0), height)))
+
+        if node['type'] != 'rxn':
+            color = map_info.get('color', '#1f77b4')
+            out.append('<circle class="node metabolite{}" r="{}"{} '
+                       'style="fill: {}"/>'.format(
+                           inactive, styles.node_radius(node),
+                           _opacity('fill-opacity',
+                                    styles.flux_alpha(map_info)),
+                           escape(color)))
+
+            # Interquartile range of sampled throughput, as a ring
+            radius = styles.iqr_radius(node)
+            if radius is not None:
+                out.append('<circle class="flux-iqr" r="{}" fill="none" '
+                           'stroke-opacity="0.5" stroke={}/>'.format(
+                               radius, quoteattr(color)))
+
+        if node['type'] == 'rxn':
+            name = None
+        elif node['type'] == 'cofactor':
+            name = metabolites[node['orig_id']].get('name')
+        else:
+            name = metabolites[node['id']].get('name')
+
+        lines = _label_lines(node, name)
+        if lines:
+            label_y, anchor, line_x = _label_attrs(map_info)
+            classes = 'nodelabel'
+            if node['type'] == 'cofactor':
+                classes += ' cofactor'
+            classes += inactive
+            if node['type'] == 'rxn':
+                classes += ' rxn'
+
+            out.append('<text class="{}" y="{}" text-anchor="{}">'.format(
+                classes, label_y, anchor))
+            for i, line in enumerate(lines):
+                out.append('<tspan class="text" dy="{}" x="{}">{}</tspan>'
+                           .format('1.2em' if i else '0', line_x,
+                                   escape(line)))
+            out.append('</text>')
+        out.append('</g>')
+    out.append('</g>')
+
+    out.append('</svg>')
+    return '\n'.join(out)
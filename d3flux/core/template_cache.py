@@ -0,0 +1,87 @@
+"""
+Module-level caches for the jinja templates and static assets used by
+`render_model`. Templates are compiled once per session and reloaded when the
+files change on disk; compressed CSS and background SVGs are memoized.
+"""
+
+import os
+
+from jinja2 import Environment, FileSystemLoader
+from csscompressor import compress
+
+import d3flux
+from d3flux.core.cache import LRUCache
+
+template_dir = os.path.join(os.path.dirname(d3flux.__file__), 'templates')
+
+# auto_reload checks the template's mtime on each `get_template` call, so
+# edits to the template files are picked up without restarting the kernel.
+env = Environment(loader=FileSystemLoader(template_dir), auto_reload=True)
+
+_css_cache = LRUCache(maxsize=64)
+_svg_cache = LRUCache(maxsize=16)
+_library_cache = LRUCache(maxsize=1)
+
+
+def get_template(name):
+    """Return the compiled jinja template `name` from d3flux/templates"""
+    return env.get_template(name)
+
+
+def render_css(inactive_alpha, fontsize, custom_css=''):
+    """Render and compress the network stylesheet, memoized on the style
+    arguments and the template's modification time."""
+
+    template = get_template('network_style.css')
+    key = (inactive_alpha, fontsize, custom_css,
+           os.path.getmtime(template.filename))
+
+    css = _css_cache.get(key)
+    if css is None:
+        css = compress(template.render(inactive_alpha=inactive_alpha,
+                                       fontsize=fontsize,
+                                       cf_fontsize=0.8 * fontsize)
+                       + custom_css)
+        _css_cache[key] = css
+
+    return css
+
+
+def load_library():
+    """Return the source of the static d3flux.js library, memoized on the
+    file's modification time."""
+
+    filename = os.path.join(template_dir, 'd3flux.js')
+    key = os.path.getmtime(filename)
+
+    library = _library_cache.get(key)
+    if library is None:
+        with open(filename) as f:
+            library = f.read()
+        _library_cache[key] = library
+
+    return library
+
+
+def load_background_svg(filename):
+    """Return the SVG markup of a background template, memoized on the file's
+    path and modification time."""
+
+    filename = os.path.abspath(filename)
+    key = (filename, os.path.getmtime(filename))
+
+    svg = _svg_cache.get(key)
+    if svg is None:
+        from IPython.display import SVG
+        svg = SVG(filename).data
+        _svg_cache[key] = svg
+
+    return svg
+
+
+def clear_caches():
+    """Empty the compressed CSS, library and background SVG caches"""
+    _css_cache.clear()
+    _svg_cache.clear()
+    _library_cache.clear()
+    env.cache.clear()
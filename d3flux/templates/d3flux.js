@@ -1,4 +1,6 @@
-var {{ figure_id }}model = {{ modeljson }};
+// d3flux rendering library. Registered once per page as the AMD module
+// 'd3flux'; each figure then calls `d3flux.render(config, model)` with its
+// own settings (see d3flux.core.flux_layouts._render_figure).
 
 require.config({
   paths: {
@@ -18,20 +20,553 @@ require.config({
   }
 });
 
-require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
-	d3, math, FileSaver) {
+define("d3flux", ["jQuery", "cola", "d3", "math", "FileSaver"], function (
+	jQuery, cola, d3, math, FileSaver) {
 
-  function main(model) {
-    // Render a metabolic network representation of a cobra.Model object.
-    //
-    // `model` is a json-serialized representation of a metabolic network,
-    // generated by cobra.display.flux_analysis.create_model_json
+  function index_by_id(objs) {
+    // Map each object's id to its position in the array
+    var index = {};
+    for (var i = 0, len = objs.length; i < len; i++) {
+      index[objs[i].id] = i;
+    }
+    return index;
+  }
 
-    // Height and width of the SVG figure, passed via jinja2
-    var width = {{ figwidth }},
-    height = {{ figheight }};
+  function iqr_extent(map_info) {
+    // Largest absolute flux in the interquartile range of sampled fluxes
+    return Math.max(Math.abs(map_info.flux_q1), Math.abs(map_info.flux_q3));
+  }
 
-    // var color = d3.scale.category10();
+  function build_graph(model, config) {
+    // Build the nodes and links of the figure from the model. Works on a copy
+    // of the model's metabolites and reactions, and only touches each
+    // reaction's metabolites once, so the cost is linear in the size of the
+    // stoichiometry.
+    var metabolites = JSON.parse(JSON.stringify(model.metabolites)),
+    reactions = JSON.parse(JSON.stringify(model.reactions)),
+    metabolite_index = index_by_id(metabolites),
+    reaction_index = index_by_id(reactions),
+    nodes = [],
+    node_lookup = {},
+    links = [],
+    mlinks = [],
+    bilinks = [],
+    rxn_stoich = {},
+    fluxes = [],
+    mfluxes = [];
+
+    metabolites.forEach(function(metabolite) {
+      // Don't add hidden reactions
+      if ('notes' in metabolite) {
+        if ('map_info' in metabolite.notes) {
+          if (metabolite.notes.map_info.hidden) {
+            return;
+          } else {
+            if (config.hide_unused && (Math.abs(metabolite.notes.map_info.flux) < 1E-6)) {
+              return;
+            }
+            mfluxes.push(Math.abs(metabolite.notes.map_info.flux));
+            if ('flux_q3' in metabolite.notes.map_info) {
+              mfluxes.push(iqr_extent(metabolite.notes.map_info));
+            }
+          }
+        }
+      }
+      // It's not hidden, add it to the nodes, and to the lookup table of
+      // node indices by id
+      node_lookup[metabolite.id] = nodes.length;
+      nodes.push(metabolite);
+    });
+
+    // Handle cofactor metabolites. Cofactor nodes are created in the same
+    // pass over the reactions, with the original metabolites found through
+    // metabolite_index.
+    reactions.forEach(function(reaction) {
+      if ('notes' in reaction) {
+        if ('map_info' in reaction.notes) {
+          if ('hidden' in reaction.notes.map_info) {
+            if (reaction.notes.map_info.hidden) {
+              return;
+            }
+          }
+          if (config.hide_unused_cofactors &&
+              (Math.abs(reaction.notes.map_info.flux) < 1E-6)) {
+            return;
+          } 
+          if ('cofactors' in reaction.notes.map_info) {
+            for (var cofactor in reaction.notes.map_info.cofactors) {
+
+              var orig_metabolite = metabolites[metabolite_index[cofactor]];
+              var cf_id = cofactor + '_' + reaction.id;
+
+              var cofactor_node = {
+                'id' : cf_id,
+                'name' : orig_metabolite.name,
+                'notes' : {
+                  'map_info' : reaction.notes.map_info.cofactors[cofactor],
+                  'orig_id' : cofactor
+                },
+                'cofactor' : reaction.id
+              };
+
+              if (reaction.seed) {
+                cofactor_node.seed = reaction.seed;
+              }
+
+              if ('flux' in orig_metabolite.notes.map_info) {
+                cofactor_node.notes.map_info['flux'] = orig_metabolite.notes.map_info.flux;
+              }
+
+              // Inheret color from original metabolite
+              if ('color' in orig_metabolite.notes.map_info) {
+                cofactor_node.notes.map_info.color = 
+                  orig_metabolite.notes.map_info.color;
+              }
+
+              // Get the cofactor display name from the original 
+              // metabolite node
+              if ('map_info' in orig_metabolite.notes) {
+                if (('display_name' in orig_metabolite.notes.map_info) &
+                    !('display_name' in cofactor_node.notes.map_info)) {
+                  cofactor_node.notes.map_info.display_name =
+                    orig_metabolite.notes.map_info.display_name;
+                }
+              }
+
+              reaction.metabolites[cf_id] = reaction.metabolites[cofactor];
+              delete reaction.metabolites[cofactor];
+
+              // Update nodes and node_lookup table
+              nodes.push(cofactor_node);
+              node_lookup[cf_id]  = nodes.length - 1;
+
+            }
+          }
+        }
+      }
+    });
+
+    reactions.forEach(function(reaction) {
+
+      // Don't add hidden reactions
+      if ('notes' in reaction) {
+        if ('map_info' in reaction.notes) {
+          if (reaction.notes.map_info.hidden) {
+            return;
+          } else if ('flux' in reaction.notes.map_info) {
+            if (config.hide_unused && (Math.abs(reaction.notes.map_info.flux) < 1E-6)) {
+              return;
+            }
+            fluxes.push(Math.abs(reaction.notes.map_info.flux));
+            if ('flux_q3' in reaction.notes.map_info) {
+              fluxes.push(iqr_extent(reaction.notes.map_info));
+            }
+            if (reaction.notes.map_info.flux < -1E-10) {
+              // If the reaction is flowing in reverse, switch products and
+              // reactants.
+              reaction.drawn_reverse = true;
+              for (var item in reaction.metabolites) {
+                reaction.metabolites[item] *= -1;
+              }
+            }
+          }
+        }
+      }
+
+      reaction['reactants'] = []
+      reaction['products'] = []
+
+      for (var item in reaction.metabolites) {
+        if (reaction.metabolites[item] > 0) {
+          if (item in node_lookup) {
+            // Only add if the node hasn't been hidden
+            reaction.products.push(item);
+          }
+        } else if (item in node_lookup) {
+          reaction.reactants.push(item);
+        }
+      }
+
+      var r_length = reaction.reactants.length,
+      p_length = reaction.products.length,
+      r_node = {
+        "id" : reaction.id,
+        "type" : "rxn",
+        "drawn_reverse" : !!reaction.drawn_reverse
+      };
+
+      // Add notes to reaction, if it exists (for map_info)
+      if ("notes" in reaction) {
+        r_node["notes"] = reaction.notes;
+      }
+
+      if (reaction.seed) {
+        r_node.seed = reaction.seed;
+      }
+
+      // Don't add links on the boundary
+      if (r_length == 0 || p_length == 0) {
+        return; 
+      }
+
+      // Add reaction to the nodes list, get the current length of the nodes
+      // list as the reaction index for later.
+      nodes.push(r_node);
+      var rindex = nodes.length - 1;
+
+
+      if (r_length >= p_length) {
+        reaction.reactants.forEach(function (reactant, i) {
+          // Add source -> rxn -> product triplets for drawing the line. For
+          // each reactant (product), just get any product (reactant), as the
+          // lines will overlap)
+          mlinks.push({
+            "source" : node_lookup[reactant],
+            "target" : node_lookup[reaction.products[i % p_length]],
+            "rxn" : rindex
+          });
+        });
+      } else {
+        reaction.products.forEach(function (product, i) {
+          mlinks.push({
+            "source" : node_lookup[reaction.reactants[i % r_length]],
+            "target" : node_lookup[product],
+            "rxn" : rindex
+          });
+        });
+      }
+    });
+
+    // Build the reaction stoichiometry database to remember which nodes are
+    // reactants and which are products. Used to calculate path angles.
+    mlinks.forEach(function(link) {
+      if (!(link.rxn in rxn_stoich)) {
+        rxn_stoich[link.rxn] = {};
+      }
+      rxn_stoich[link.rxn][link.source] = 1;
+      rxn_stoich[link.rxn][link.target] = -1;
+    });
+
+    mlinks.forEach(function(link) {
+      var s = nodes[link.source],
+      t = nodes[link.target],
+      r = nodes[link.rxn];
+
+      links.push({source: s, target: r}, {source: r, target: t});
+      bilinks.push({
+        "source" : s,
+        "target" : t,
+        "rxn" : r,
+        "rstoich" : rxn_stoich[link.rxn],
+      });
+    });
+
+    nodes.forEach( function (node) {
+      if ("notes" in node) {
+        if ("map_info" in node.notes) {
+          if (("x" in node.notes.map_info) && ("y" in node.notes.map_info)) {
+            node.x = node.notes.map_info.x;
+            node.y = node.notes.map_info.y;
+            node.fixed = 1;
+            return;
+          }
+        }
+      }
+      if (node.seed) {
+        // Nodes of an expanded group start around the group's node, free to
+        // move
+        node.x = node.seed.x + 30 * (Math.random() - .5);
+        node.y = node.seed.y + 30 * (Math.random() - .5);
+      }
+    });
+
+    return {
+      metabolites: metabolites,
+      reactions: reactions,
+      metabolite_index: metabolite_index,
+      reaction_index: reaction_index,
+      nodes: nodes,
+      node_lookup: node_lookup,
+      links: links,
+      bilinks: bilinks,
+      fluxes: fluxes,
+      mfluxes: mfluxes
+    };
+  }
+
+  function layout_worker() {
+    // Body of the layout Web Worker. Runs the cola layout and posts node
+    // positions back to the page as transferable Float64Array buffers of
+    // interleaved x, y coordinates.
+    var layout, nodes, running = false;
+
+    function post(type) {
+      var positions = new Float64Array(2 * nodes.length);
+      for (var i = 0; i < nodes.length; i++) {
+        positions[2 * i] = nodes[i].x;
+        positions[2 * i + 1] = nodes[i].y;
+      }
+      self.postMessage({type: type, positions: positions},
+                       [positions.buffer]);
+    }
+
+    function step() {
+      // Iterate for about one frame, then yield so that drag messages from
+      // the page are handled
+      var start = Date.now(), converged = false;
+      while (!converged && (Date.now() - start < 12)) {
+        converged = layout.tick();
+      }
+      post(converged ? 'end' : 'tick');
+      if (converged) {
+        running = false;
+      } else {
+        setTimeout(step, 0);
+      }
+    }
+
+    function set_fixed(index, fixed, x, y) {
+      var v = nodes[index];
+      v.fixed = fixed;
+      if (fixed) {
+        v.x = v.px = x;
+        v.y = v.py = y;
+      }
+    }
+
+    self.onmessage = function (e) {
+      var msg = e.data;
+      if (msg.type == 'init') {
+        importScripts(msg.cola_url);
+        nodes = msg.nodes;
+        layout = new cola.Layout()
+          .linkDistance(msg.link_distance)
+          .size(msg.size)
+          .nodes(nodes)
+          .links(msg.links);
+        if (msg.flow) {
+          layout.flowLayout(msg.flow.axis, msg.flow.gap);
+        }
+
+        // Replace the synchronous kick loop with one that yields
+        layout.kick = function () {
+          if (!running) {
+            running = true;
+            step();
+          }
+        };
+
+        var it = msg.iterations;
+        layout.start(it[0], it[1], it[2], it[3], msg.keep_running);
+        if (!msg.keep_running) {
+          post('end');
+        }
+      } else if (msg.type == 'fix') {
+        set_fixed(msg.index, msg.fixed, msg.x, msg.y);
+        layout.resume();
+      } else if (msg.type == 'resume') {
+        for (var i = 0; i < nodes.length; i++) {
+          set_fixed(i, msg.fixed[i], msg.positions[2 * i],
+                    msg.positions[2 * i + 1]);
+        }
+        layout.resume();
+      }
+    };
+  }
+
+  function worker_layout() {
+    // Drop-in replacement for the parts of cola.d3adaptor used by main, which
+    // runs the layout iterations in a Web Worker. The page only copies the
+    // position snapshots into the nodes and fires 'tick' and 'end'. Falls
+    // back to cola.d3adaptor on the main thread if the worker can't start.
+    var nodes = [],
+    links = [],
+    size = [1, 1],
+    link_distance = 30,
+    flow = null,
+    listeners = {},
+    worker = null,
+    fallback = null;
+
+    var layout = {
+      worker: true,
+      linkDistance: function (x) { link_distance = x; return layout; },
+      size: function (x) { size = x; return layout; },
+      flowLayout: function (axis, gap) {
+        flow = {axis: axis, gap: gap};
+        return layout;
+      },
+      nodes: function (x) {
+        if (!arguments.length) { return nodes; }
+        nodes = x;
+        return layout;
+      },
+      links: function (x) {
+        if (!arguments.length) { return links; }
+        links = x;
+        return layout;
+      },
+      on: function (type, listener) {
+        listeners[type] = listener;
+        if (fallback) { fallback.on(type, listener); }
+        return layout;
+      }
+    };
+
+    function trigger(type) {
+      if (listeners[type]) { listeners[type].call(layout); }
+    }
+
+    function index_of(d) {
+      // Link ends are nodes, numbered in start(), or already node indices
+      return (typeof d === 'number') ? d : d.index;
+    }
+
+    function start_fallback(iterations, keep_running) {
+      // Run the layout on the main thread instead
+      worker = null;
+      layout.worker = false;
+      fallback = cola.d3adaptor()
+        .linkDistance(link_distance)
+        .size(size)
+        .nodes(nodes)
+        .links(links);
+      if (flow) { fallback.flowLayout(flow.axis, flow.gap); }
+      for (var type in listeners) { fallback.on(type, listeners[type]); }
+      fallback.start.apply(fallback, iterations.concat([keep_running]));
+      if (!keep_running) { trigger('end'); }
+    }
+
+    layout.start = function (a, b, c, d, keep_running) {
+      var iterations = [a || 0, b || 0, c || 0, d || 0];
+      keep_running = (keep_running === undefined) || keep_running;
+
+      try {
+        var source = '(' + layout_worker.toString() + ')()';
+        worker = new Worker(URL.createObjectURL(
+          new Blob([source], {type: 'application/javascript'})));
+      } catch (err) {
+        start_fallback(iterations, keep_running);
+        return layout;
+      }
+
+      nodes.forEach(function (v, i) { v.index = i; });
+      worker.onerror = function (e) {
+        e.preventDefault();
+        worker.terminate();
+        start_fallback(iterations, keep_running);
+      };
+      worker.onmessage = function (e) {
+        var positions = e.data.positions;
+        nodes.forEach(function (v, i) {
+          // Nodes being dragged follow the pointer, not the worker
+          if (!(v.fixed & 2)) {
+            v.x = positions[2 * i];
+            v.y = positions[2 * i + 1];
+          }
+        });
+        trigger(e.data.type);
+      };
+      worker.postMessage({
+        type: 'init',
+        cola_url: new URL(require.toUrl('cola') + '.js',
+                          document.baseURI).href,
+        nodes: nodes.map(function (v) {
+          return {x: v.x, y: v.y, px: v.x, py: v.y, fixed: v.fixed ? 1 : 0};
+        }),
+        links: links.map(function (l) {
+          return {source: index_of(l.source), target: index_of(l.target)};
+        }),
+        size: size,
+        link_distance: link_distance,
+        flow: flow,
+        iterations: iterations,
+        keep_running: keep_running
+      });
+      return layout;
+    };
+
+    layout.resume = function () {
+      if (fallback) { return fallback.resume(); }
+      var fixed = new Uint8Array(nodes.length),
+      positions = new Float64Array(2 * nodes.length);
+      nodes.forEach(function (v, i) {
+        fixed[i] = v.fixed ? 1 : 0;
+        positions[2 * i] = v.x;
+        positions[2 * i + 1] = v.y;
+      });
+      worker.postMessage({type: 'resume', fixed: fixed, positions: positions},
+                         [fixed.buffer, positions.buffer]);
+      return layout;
+    };
+
+    layout.stop = function () {
+      if (fallback) { fallback.stop(); }
+      if (worker) {
+        worker.terminate();
+        worker = null;
+      }
+      return layout;
+    };
+
+    function send_fixed(d) {
+      worker.postMessage({type: 'fix', index: d.index, fixed: d.fixed,
+                          x: d.x, y: d.y});
+    }
+
+    layout.drag_node = function (d, type, x, y) {
+      // Same behaviour as the d3adaptor drag: the node is locked at the
+      // pointer while dragged, and the layout resumes around it
+      if (fallback) { return drag_node(fallback, d, type, x, y); }
+      if (type == 'start') {
+        d.fixed |= 2;
+      } else if (type == 'drag') {
+        d.x = x;
+        d.y = y;
+        send_fixed(d);
+        trigger('tick');
+      } else {
+        d.fixed &= ~6;
+        send_fixed(d);
+      }
+    };
+
+    layout.drag = function () {
+      return d3.behavior.drag()
+        .origin(function (d) { return {x: d.x, y: d.y}; })
+        .on("dragstart.layout", function (d) {
+          layout.drag_node(d, 'start');
+        })
+        .on("drag.layout", function (d) {
+          layout.drag_node(d, 'drag', d3.event.x, d3.event.y);
+        })
+        .on("dragend.layout", function (d) {
+          layout.drag_node(d, 'end');
+        });
+    };
+
+    return layout;
+  }
+
+  function drag_node(force, d, type, x, y) {
+    // Drag node `d` through the layout, for renderers that draw no DOM
+    // element per node to attach force.drag() to. `type` is 'start', 'drag'
+    // (to layout coordinates x, y) or 'end'.
+    if (force.drag_node) { return force.drag_node(d, type, x, y); }
+    if (type == 'start') {
+      cola.Layout.dragStart(d);
+    } else if (type == 'drag') {
+      cola.Layout.drag(d, {x: x, y: y});
+      force.resume();
+    } else {
+      cola.Layout.dragEnd(d);
+    }
+  }
+
+  function flux_styles(config, fluxes, mfluxes) {
+    // Scales, styling functions and link geometry shared by the SVG and
+    // canvas renderers. `fluxes` and `mfluxes` are the absolute reaction and
+    // metabolite fluxes that set the initial scale domains.
 
     // Reaction color allows different reaction groups to be colored
     // accordingly. Grouping is mainly handled by color_redox_reactions. First
@@ -52,59 +587,104 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
         "#989033"])
       .domain([undefined, 'ko', 1, 2, 3, 4, 5, 6, 7, 8]);
 
-    // Initialize the d3 force diagram. Parameters like charge, gavity, and
-    // link distance are currently hard-coded in -- probably should change
-    // this?
-    var force = cola.d3adaptor()
-      .linkDistance(30)
-      {% if flowLayout %}
-      .flowLayout('y', 15)
-      {% endif %}
-      .size([width, height]);
-    // var force = d3.layout.force()
-    //   .linkDistance(30)
-    //   .charge(-100)
-    //   .chargeDistance(400)
-    //   .gravity(.015)
-    //   .size([width, height]);
+    // flux_scale = d3.scale.pow().exponent(1/2)
+    var flux_scale = d3.scale.linear()
+      .domain([d3.min(fluxes), d3.max(fluxes)])
+      .range([1.5, 6]);
 
-    // Allow for a background SVG template if one has been provided, otherwise
-    // initalize the svg canvas
-    if ({{ no_background }}) {
-      var svg = d3.select("#{{ figure_id }}").append("svg")
-        .attr("viewBox", "0 0 {{ figwidth }} {{ figheight }}")
-        .attr("style", "display:block;margin:auto;width:{{ svg_scale }}%");
-    } else {
-      var svg = d3.select("#{{ figure_id }}").select("svg");
+    // metabolite_scale = d3.scale.pow().exponent(1/2)
+    var metabolite_scale = d3.scale.linear()
+      .domain([d3.min(mfluxes), d3.max(mfluxes)])
+      .range([4, 8]);
+
+    var arrowhead_scale = d3.scale.linear()
+      .domain([1.5, 6])
+      .range([6, 12]);
+
+    function get_flux_width (rxn) {
+      if ('stroke' in rxn.notes.map_info) {
+	return rxn.notes.map_info.stroke;
+      } else try {
+        var flux = flux_scale(Math.abs(rxn.notes.map_info.flux));
+        if (!isNaN(flux)) {
+          return flux;
+        } else{
+          return config.default_flux_width;
+        }
+      }
+      catch(err) {
+        return config.default_flux_width; // Default linewidth
+      }
     }
 
-    // Append the CSS styles
-    svg.append("style").text("{{ css }}");
+    function get_flux_dasharray (d) {
+      if ('dasharray' in d.notes.map_info) {
+	return d.notes.map_info.dasharray;
+      } else try {
+	  if (d.notes.map_info.group == 'ko') {
+	    return "5, 5, 1, 5";
+	  }
+	  else if (Math.abs(d.notes.map_info.flux) < 1E-6) {
+	    return "5,5";
+	  }
+	}
+	catch(err) {
+	  return;
+      }
+    }
 
-    // Code for the figure manipulation buttons.
-    d3.select("#{{ figure_id }}_options .reactionbutton").on("click", function() {
-      // Show/hide the reaction control node points.
-      var $this = $(this);
-      $this.toggleClass('btn-danger');
-      d3.selectAll(".node.rxn")
-        .classed("hidden", function (d, i) {
-          return !d3.select(this).classed("hidden");
-        });
-      if($this.hasClass('btn-danger')){
-        $this.text('Hide Reaction Nodes');
+    function get_flux_stroke (d) {
+      if ('color' in d.notes.map_info) {
+        return d.notes.map_info.color;
       } else {
-        $this.text('Show Reaction Nodes');
+          return rxncolor(d.notes.map_info.group);
+        }
+    }
+
+    function markerscale (d) {
+      return arrowhead_scale(get_flux_width(d)) + "pt";
+    }
+
+    function get_flux_alpha (d) {
+      // Opacity from the fraction of flux samples in which the reaction or
+      // metabolite carries flux, if the map shows sampled fluxes
+      if ('nonzero' in d.notes.map_info) {
+        return Math.max(d.notes.map_info.nonzero, .1);
       }
-    });
+      return 1;
+    }
+
+    function get_iqr_width (rxn) {
+      // Width of the band showing the interquartile range of sampled
+      // fluxes, or null if the reaction has none
+      if ('stroke' in rxn.notes.map_info ||
+          !('flux_q3' in rxn.notes.map_info)) {
+        return null;
+      }
+      return flux_scale(iqr_extent(rxn.notes.map_info));
+    }
 
-    d3.select("#{{ figure_id }}_options .svgbutton").on("click", function() { 
-      // Download the svg using SVG Crowbar. This is still very buggy.
+    function get_iqr_radius (d) {
+      // Radius of the ring showing the interquartile range of a
+      // metabolite's sampled throughput, or null if it has none
+      if (('cofactor' in d) || !('flux_q3' in d.notes.map_info)) {
+        return null;
+      }
+      return metabolite_scale(iqr_extent(d.notes.map_info));
+    }
 
-      var e = document.createElement('script'); 
-      e.setAttribute('src', 'https://rawgit.com/pstjohn/svg-crowbar/gh-pages/svg-crowbar.js'); 
-      e.setAttribute('class', 'svg-crowbar'); 
-      document.body.appendChild(e); 
-    });
+    function get_node_radius (d) {
+      if ('cofactor' in d) {return 4;}
+      try {
+        var nodewidth = metabolite_scale(Math.abs(d.notes.map_info.flux));
+        if (!isNaN(nodewidth)) {
+          return nodewidth;
+        } else {
+          return 5;
+        }
+      }
+      catch(err){ return 5; }
+    }
 
     function calc_imag_angle(x1, y1, x2, y2) {
       // Function to calculate the imaginary angle of the line between two
@@ -142,25 +722,29 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       return math.mean(dist);
     }
 
-    function calculate_path(d, force) {
+    function link_geometry(d, nodes) {
+      // Control points of the two quadratic Bezier segments drawn for a
+      // link, from the source through the reaction node to the target,
+      // trimmed to the node circles and arrowheads
       var s = d.source,
       t = d.target,
       r = d.rxn,
       a=.1, b=.1,
       cp_inv = {};
 
-      var angle = average_angles(r, d.rstoich, force.nodes());
-      var dist = average_dist(r, d.rstoich, force.nodes());
+      var angle = average_angles(r, d.rstoich, nodes);
+      var dist = average_dist(r, d.rstoich, nodes);
 
-      cp = new Point2D(r.x - math.multiply(.5*dist, math.sin(angle)),
+      var cp = new Point2D(r.x - math.multiply(.5*dist, math.sin(angle)),
                  r.y - math.multiply(.5*dist, math.cos(angle)));
 
       cp_inv = new Point2D(r.x + math.multiply(.5*dist, math.sin(angle)),
                      r.y + math.multiply(.5*dist, math.cos(angle)));
 
-      s_point = new Point2D(s.x, s.y)
-      r_point = new Point2D(r.x, r.y)
-      t_point = new Point2D(t.x, t.y)
+      var s_point = new Point2D(s.x, s.y),
+      r_point = new Point2D(r.x, r.y),
+      t_point = new Point2D(t.x, t.y),
+      first_intersect, last_intersect;
 
       var padding = 5;
       // var total_len = quadraticBezierLength(s, cp, r) + quadraticBezierLength(r, cp_inv, t);
@@ -205,15 +789,31 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       var target_y = r.y*b**2 - 2*r.y*b + r.y - 2*cp_inv.y*b**2 + 2*cp_inv.y*b + t.y*b**2;
 
       if ( isFinite(source_x) & isFinite(cp_x) & isFinite(cp_inv_x) & isFinite(target_x) ) {
-        return "M" + source_x + "," + source_y
-          + " Q" + cp_x + "," + cp_y
-          + " " + r.x + "," + r.y
-          + " Q" + cp_inv_x + "," + cp_inv_y
-          +" " + target_x + "," + target_y;
+        return {
+          source: [source_x, source_y],
+          cp: [cp_x, cp_y],
+          rxn: [r.x, r.y],
+          cp_inv: [cp_inv_x, cp_inv_y],
+          target: [target_x, target_y]
+        };
+      } else {
+        // Straight segments through the reaction node
+        return {source: [s.x, s.y], rxn: [r.x, r.y], target: [t.x, t.y]};
+      }
+    }
+
+    function calculate_path(d, nodes) {
+      var g = link_geometry(d, nodes);
+      if ('cp' in g) {
+        return "M" + g.source[0] + "," + g.source[1]
+          + " Q" + g.cp[0] + "," + g.cp[1]
+          + " " + g.rxn[0] + "," + g.rxn[1]
+          + " Q" + g.cp_inv[0] + "," + g.cp_inv[1]
+          +" " + g.target[0] + "," + g.target[1];
       } else {
-        return "M" + s.x + "," + s.y
-          + " L" + r.x + "," + r.y
-          +" L" + t.x + "," + t.y;
+        return "M" + g.source[0] + "," + g.source[1]
+          + " L" + g.rxn[0] + "," + g.rxn[1]
+          +" L" + g.target[0] + "," + g.target[1];
       }
     }
 
@@ -222,233 +822,299 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       && rxn.notes.map_info.reversibility);
     }
 
-    var metabolites = jQuery.extend(true, [], model.metabolites),
-    reactions = jQuery.extend(true, [], model.reactions),
-    nodes = [],
-    node_lookup = {},
-    links = [],
-    mlinks = [],
-    bilinks = []
-    rxn_stoich = {};
+    return {
+      rxncolor: rxncolor,
+      flux_scale: flux_scale,
+      metabolite_scale: metabolite_scale,
+      arrowhead_scale: arrowhead_scale,
+      get_flux_width: get_flux_width,
+      get_flux_dasharray: get_flux_dasharray,
+      get_flux_stroke: get_flux_stroke,
+      markerscale: markerscale,
+      get_node_radius: get_node_radius,
+      get_flux_alpha: get_flux_alpha,
+      get_iqr_width: get_iqr_width,
+      get_iqr_radius: get_iqr_radius,
+      plot_reverse_arrowhead: plot_reverse_arrowhead,
+      link_geometry: link_geometry,
+      calculate_path: calculate_path
+    };
+  }
 
-    var mfluxes = [];
-    metabolites.forEach(function(metabolite) {
-      // Don't add hidden reactions
-      if ('notes' in metabolite) {
-        if ('map_info' in metabolite.notes) {
-          if (metabolite.notes.map_info.hidden) {
-            return;
-          } else {
-            if ({{ hide_unused }} && (Math.abs(metabolite.notes.map_info.flux) < 1E-6)) {
-              return;
-            }
-            mfluxes.push(Math.abs(metabolite.notes.map_info.flux));
-          }
-        }
-      }
-      // It's not hidden, add it to the nodes
-      nodes.push(metabolite);
-    });
+  function is_inactive(d) {
+    return ('flux' in d.notes.map_info) && (d.notes.map_info.flux == 0);
+  }
 
-    // Create a dictionary-like structure to allow us to look up nodes by their
-    // id, rather than numerical index
-    for (var i = 0, len = nodes.length; i < len; i++) {
-      var node = nodes[i]
-      node_lookup[node.id] = i;
+  function set_flux(map_info, flux) {
+    if (flux === null) {
+      delete map_info.flux;
+    } else {
+      map_info.flux = flux;
     }
+  }
 
-    // Handle cofactor metabolites
-    reactions.forEach(function(reaction) {
-      if ('notes' in reaction) {
-        if ('map_info' in reaction.notes) {
-          if ('hidden' in reaction.notes.map_info) {
-            if (reaction.notes.map_info.hidden) {
-              return;
-            }
-          }
-          if ({{ hide_unused_cofactors }} &&
-              (Math.abs(reaction.notes.map_info.flux) < 1E-6)) {
-            return;
-          } 
-          if ('cofactors' in reaction.notes.map_info) {
-            for (var cofactor in reaction.notes.map_info.cofactors) {
-
-              var orig_metabolite = obj = $.grep(model.metabolites,
-                  function(e){ return e.id == cofactor; })[0];
-              var cf_id = cofactor + '_' + reaction.id;
-
-              var cofactor_node = {
-                'id' : cf_id,
-                'name' : orig_metabolite.name,
-                'notes' : {
-                  'map_info' : reaction.notes.map_info.cofactors[cofactor],
-                  'orig_id' : cofactor
-                },
-                'cofactor' : reaction.id
-              };
-
-              if ('flux' in orig_metabolite.notes.map_info) {
-                cofactor_node.notes.map_info['flux'] = orig_metabolite.notes.map_info.flux;
-              }
-
-              // Inheret color from original metabolite
-              if ('color' in orig_metabolite.notes.map_info) {
-                cofactor_node.notes.map_info.color = 
-                  orig_metabolite.notes.map_info.color;
-              }
+  function apply_flux_update(message, graph, styles) {
+    // Set new fluxes on the graph's reactions and metabolites, flip the
+    // links of reactions that changed direction and rescale the flux
+    // styles. `message.reactions` and `message.metabolites` map ids to the
+    // new flux, or null if the flux is undefined.
+    var rxn_updates = message.reactions || {},
+    met_updates = message.metabolites || {};
+
+    graph.reactions.forEach(function (reaction) {
+      if (reaction.id in rxn_updates) {
+        set_flux(reaction.notes.map_info, rxn_updates[reaction.id]);
+      }
+    });
 
-              // Get the cofactor display name from the original 
-              // metabolite node
-              if ('map_info' in orig_metabolite.notes) {
-                if (('display_name' in orig_metabolite.notes.map_info) &
-	            !('display_name' in cofactor_node.notes.map_info)) {
-                  cofactor_node.notes.map_info.display_name =
-                    orig_metabolite.notes.map_info.display_name;
-                }
-              }
+    graph.nodes.forEach(function (node) {
+      if (node.type == 'rxn') { return; }
+      var met_id = ('cofactor' in node) ? node.notes.orig_id : node.id;
+      if (met_id in met_updates) {
+        set_flux(node.notes.map_info, met_updates[met_id]);
+      }
+    });
 
-              reaction.metabolites[cf_id] = reaction.metabolites[cofactor];
-              delete reaction.metabolites[cofactor];
+    // Flip the drawn direction of reactions that changed sign
+    var flipped = {};
+    graph.bilinks.forEach(function (d) {
+      var flux = d.rxn.notes.map_info.flux,
+      reverse = (flux < -1E-10);
+      if (isNaN(flux)) { return; }
+      if (Math.abs(flux) > 1E-10 && (reverse != !!d.rxn.drawn_reverse)) {
+        var s = d.source;
+        d.source = d.target;
+        d.target = s;
+        if (!(d.rxn.id in flipped)) {
+          flipped[d.rxn.id] = true;
+          for (var n in d.rstoich) { d.rstoich[n] *= -1; }
+        }
+      }
+    });
+    graph.nodes.forEach(function (node) {
+      if (node.id in flipped && node.type == 'rxn') {
+        node.drawn_reverse = !node.drawn_reverse;
+      }
+    });
 
-              // Update nodes and node_lookup table
-              nodes.push(cofactor_node);
-              node_lookup[cf_id]  = nodes.length - 1;
+    // Rescale widths and radii to the new flux ranges
+    var rxn_fluxes = [], met_fluxes = [];
+    graph.nodes.forEach(function (node) {
+      var flux = Math.abs(node.notes.map_info.flux);
+      if (isNaN(flux)) { return; }
+      if (node.type == 'rxn') {
+        rxn_fluxes.push(flux);
+      } else if (!('cofactor' in node)) {
+        met_fluxes.push(flux);
+      }
+    });
+    styles.flux_scale.domain([d3.min(rxn_fluxes), d3.max(rxn_fluxes)]);
+    styles.metabolite_scale.domain([d3.min(met_fluxes), d3.max(met_fluxes)]);
+  }
 
-            }
-          }
+  function save_model_json(model, graph, nodes) {
+    // Download the model with the positions of the fixed nodes added to
+    // their map_info. Reactions and metabolites are in the same order in the
+    // model as in the graph, so the graph's id->index maps locate them
+    // directly.
+    nodes.forEach(function (node) {
+      if (node.fixed) {
+        var obj;
+        if (node.type == "rxn") {
+          // Reaction object
+          obj = model.reactions[graph.reaction_index[node.id]];
+        } else if (!('cofactor' in node)) {
+          // Look in metabolites
+          obj = model.metabolites[graph.metabolite_index[node.id]];
+        } else {
+          var rxn = model.reactions[graph.reaction_index[node.cofactor]];
+          rxn.notes.map_info.cofactors[node.notes.orig_id]['x'] = node.x;
+          rxn.notes.map_info.cofactors[node.notes.orig_id]['y'] = node.y;
+          return;
         }
+        if (!("notes" in obj)) { obj.notes = {}; }
+        if (!("map_info" in obj.notes)) { obj.notes.map_info = {}; }
+        obj.notes.map_info['x'] = node.x;
+        obj.notes.map_info['y'] = node.y;
       }
     });
 
+    var json = JSON.stringify(model);
+    var blob = new Blob([json], {type: "application/json"});
+    saveAs(blob, model.id + ".json");
+  }
 
-    // Create a dictionary-like structure to allow us to look up nodes by their
-    // id, rather than numerical index
-    // for (var i = 0, len = nodes.length; i < len; i++) {
-    //   var node = nodes[i]
-    //   node_lookup[node.id] = i;
-    // }
+  function figure_profiler(figure_id) {
+    // Rendering statistics of a figure, in milliseconds. Exposed as
+    // window.d3flux_figures[figure_id].stats, and as JSON in the figure
+    // div's data-d3flux-stats attribute, which is refreshed whenever a span
+    // ends. Spans ('decode', 'graph', 'layout', 'first_paint') are also
+    // recorded with performance.mark/measure as "d3flux:<figure_id>:<span>",
+    // so they show up in the browser's performance profiler.
+    var stats = {
+      ticks: 0,
+      frames: 0,
+      last_frame_ms: 0,
+      mean_frame_ms: 0,
+      max_frame_ms: 0,
+      settle_ms: null,
+      spans_ms: {}
+    },
+    starts = {},
+    user_timing = ((typeof performance.mark === 'function') &&
+                   (typeof performance.measure === 'function'));
 
-    var fluxes = [];
-    reactions.forEach(function(reaction) {
+    function span_name(span) {
+      return 'd3flux:' + figure_id + ':' + span;
+    }
 
-      // Don't add hidden reactions
-      if ('notes' in reaction) {
-        if ('map_info' in reaction.notes) {
-          if (reaction.notes.map_info.hidden) {
-            return;
-          } else if ('flux' in reaction.notes.map_info) {
-            if ({{ hide_unused }} && (Math.abs(reaction.notes.map_info.flux) < 1E-6)) {
-              return;
-            }
-            fluxes.push(Math.abs(reaction.notes.map_info.flux));
-            if (reaction.notes.map_info.flux < -1E-10) {
-              // If the reaction is flowing in reverse, switch products and
-              // reactants.
-              for (var item in reaction.metabolites) {
-                reaction.metabolites[item] *= -1;
-              }
-            }
-          }
-        }
+    function publish() {
+      var element = document.getElementById(figure_id);
+      if (element) {
+        element.setAttribute('data-d3flux-stats', JSON.stringify(stats));
       }
+    }
 
-      reaction['reactants'] = []
-      reaction['products'] = []
-
-      for (var item in reaction.metabolites) {
-        if (reaction.metabolites[item] > 0) {
-          if (item in node_lookup) {
-            // Only add if the node hasn't been hidden
-            reaction.products.push(item);
+    return {
+      stats: stats,
+      publish: publish,
+      start: function (span) {
+        starts[span] = performance.now();
+        if (user_timing) {
+          performance.mark(span_name(span) + ':start');
+        }
+      },
+      end: function (span) {
+        // Returns the duration of the span, or null if it wasn't started
+        if (!(span in starts)) {
+          return null;
+        }
+        stats.spans_ms[span] = performance.now() - starts[span];
+        delete starts[span];
+        if (user_timing) {
+          try {
+            performance.measure(span_name(span), span_name(span) + ':start');
+          } catch (err) {
+            // The start mark was cleared by the page
           }
-        } else if (item in node_lookup) {
-          reaction.reactants.push(item);
         }
+        publish();
+        return stats.spans_ms[span];
+      },
+      frame: function (elapsed) {
+        stats.frames += 1;
+        stats.last_frame_ms = elapsed;
+        stats.max_frame_ms = Math.max(stats.max_frame_ms, elapsed);
+        stats.mean_frame_ms += (elapsed - stats.mean_frame_ms) / stats.frames;
       }
+    };
+  }
 
-      var r_length = reaction.reactants.length,
-      p_length = reaction.products.length,
-      r_node = {
-        "id" : reaction.id,
-        "type" : "rxn"
-      };
+  function main(model, config, profiler) {
+    // Render a metabolic network representation of a cobra.Model object.
+    //
+    // `model` is a json-serialized representation of a metabolic network,
+    // generated by cobra.display.flux_analysis.create_model_json
+    //
+    // `config` holds the per-figure settings passed from render_model, and
+    // `profiler` (optional) the figure_profiler started by `render`
 
-      // Add notes to reaction, if it exists (for map_info)
-      if ("notes" in reaction) {
-        r_node["notes"] = reaction.notes;
-      }
+    profiler = profiler || figure_profiler(config.figure_id);
+    profiler.start('first_paint');
+    var stats = profiler.stats;
 
-      // Don't add links on the boundary
-      if (r_length == 0 || p_length == 0) {
-        return; 
-      }
+    // Height and width of the SVG figure
+    var width = config.width,
+    height = config.height;
 
-      // Add reaction to the nodes list, get the current length of the nodes
-      // list as the reaction index for later.
-      nodes.push(r_node);
-      rindex = nodes.length - 1;
+    // var color = d3.scale.category10();
 
+    // Large maps are laid out in a Web Worker, so the page stays responsive
+    // while the layout converges
+    var use_worker = config.layout_worker;
+    if ((use_worker === null) || (use_worker === undefined)) {
+      use_worker = ((typeof Worker !== 'undefined') &&
+        (model.metabolites.length + model.reactions.length >= 500));
+    }
 
-      if (r_length >= p_length) {
-        reaction.reactants.forEach(function (reactant, i) {
-          // Add source -> rxn -> product triplets for drawing the line. For
-          // each reactant (product), just get any product (reactant), as the
-          // lines will overlap)
-          mlinks.push({
-            "source" : node_lookup[reactant],
-            "target" : node_lookup[reaction.products[i % p_length]],
-            "rxn" : rindex
-          });
-        });
-      } else {
-        reaction.products.forEach(function (product, i) {
-          mlinks.push({
-            "source" : node_lookup[reaction.reactants[i % r_length]],
-            "target" : node_lookup[product],
-            "rxn" : rindex
-          });
-        });
-      }
-    });
+    // Initialize the d3 force diagram. Parameters like charge, gavity, and
+    // link distance are currently hard-coded in -- probably should change
+    // this?
+    var force = (use_worker ? worker_layout() : cola.d3adaptor())
+      .linkDistance(30)
+      .size([width, height]);
 
-    // Build the reaction stoichiometry database to remember which nodes are
-    // reactants and which are products. Used to calculate path angles.
-    mlinks.forEach(function(link) {
-      if (link.rxn in rxn_stoich) {
-        rxn_stoich[link.rxn][link.source] = 1;
-        rxn_stoich[link.rxn][link.target] = -1;
+    if (config.flowLayout) {
+      force.flowLayout('y', 15);
+    }
+    // var force = d3.layout.force()
+    //   .linkDistance(30)
+    //   .charge(-100)
+    //   .chargeDistance(400)
+    //   .gravity(.015)
+    //   .size([width, height]);
+
+    // Allow for a background SVG template if one has been provided, otherwise
+    // initalize the svg canvas
+    if (config.no_background) {
+      var svg = d3.select("#" + config.figure_id).append("svg")
+        .attr("viewBox", "0 0 " + width + " " + height)
+        .attr("style", "display:block;margin:auto;width:" + config.svg_scale + "%");
+    } else {
+      var svg = d3.select("#" + config.figure_id).select("svg");
+    }
+
+    // Append the CSS styles
+    svg.append("style").text(config.css);
+
+    // Code for the figure manipulation buttons.
+    d3.select("#" + config.figure_id + "_options .reactionbutton").on("click", function() {
+      // Show/hide the reaction control node points.
+      var $this = $(this);
+      $this.toggleClass('btn-danger');
+      d3.selectAll(".node.rxn")
+        .classed("hidden", function (d, i) {
+          return !d3.select(this).classed("hidden");
+        });
+      if($this.hasClass('btn-danger')){
+        $this.text('Hide Reaction Nodes');
       } else {
-        rxn_stoich[link.rxn] = {};
-        rxn_stoich[link.rxn][link.source] = 1;
-        rxn_stoich[link.rxn][link.target] = -1;
+        $this.text('Show Reaction Nodes');
       }
     });
 
-    mlinks.forEach(function(link) {
-      var s = nodes[link.source],
-      t = nodes[link.target],
-      r = nodes[link.rxn];
-
-      links.push({source: s, target: r}, {source: r, target: t});
-      bilinks.push({
-        "source" : s,
-        "target" : t,
-        "rxn" : r,
-        "rstoich" : rxn_stoich[link.rxn],
-      });
+    d3.select("#" + config.figure_id + "_options .svgbutton").on("click", function() {
+      // Download the figure's SVG element, including its stylesheet
+      var markup = new XMLSerializer().serializeToString(svg.node());
+      var blob = new Blob([markup], {type: "image/svg+xml"});
+      saveAs(blob, model.id + ".svg");
     });
 
-    nodes.forEach( function (node) {
-      if ("notes" in node) {
-        if ("map_info" in node.notes) {
-          if (("x" in node.notes.map_info) && ("y" in node.notes.map_info)) {
-            node.x = node.notes.map_info.x;
-            node.y = node.notes.map_info.y;
-            node.fixed = 1;
-          }
-        }
-      }
-    });
+    profiler.start('graph');
+    var graph = build_graph(model, config);
+    profiler.end('graph');
+
+    var metabolites = graph.metabolites,
+    reactions = graph.reactions,
+    nodes = graph.nodes,
+    links = graph.links,
+    bilinks = graph.bilinks,
+    fluxes = graph.fluxes,
+    mfluxes = graph.mfluxes;
+
+    var styles = flux_styles(config, fluxes, mfluxes),
+    flux_scale = styles.flux_scale,
+    metabolite_scale = styles.metabolite_scale,
+    arrowhead_scale = styles.arrowhead_scale,
+    get_flux_width = styles.get_flux_width,
+    get_flux_dasharray = styles.get_flux_dasharray,
+    get_flux_stroke = styles.get_flux_stroke,
+    markerscale = styles.markerscale,
+    get_node_radius = styles.get_node_radius,
+    get_flux_alpha = styles.get_flux_alpha,
+    get_iqr_width = styles.get_iqr_width,
+    get_iqr_radius = styles.get_iqr_radius,
+    plot_reverse_arrowhead = styles.plot_reverse_arrowhead;
 
     // Modify link strength based on flux:
     // link_strength_scale = d3.scale.pow().exponent(1/2)
@@ -466,16 +1132,30 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
     //     }
     //   });
 
+    profiler.start('layout');
+
     force
       .nodes(nodes)
-      .links(links)
-      .start();
+      .links(links);
+
+    if (config.settle_iterations) {
+      // Run the layout off-screen, without tick events, and draw it once
+      // the DOM has been built below. In a worker, the layout settles in the
+      // background and is drawn on the 'end' event.
+      force.start(config.settle_iterations, 0, config.settle_iterations, 0,
+                  false);
+      if (!force.worker) {
+        stats.settle_ms = profiler.end('layout');
+      }
+    } else {
+      force.start();
+    }
 
     svg.append("defs").selectAll("marker")
       .data(reactions)
       .enter()
       .append("marker")
-      .attr("id", function (d) { return "{{ figure_id }}" + d.id; })
+      .attr("id", function (d) { return config.figure_id + d.id; })
       .attr("viewBox", "0 0 10 10")
       .attr("refX", 1)
       .attr("refY", 5)
@@ -499,7 +1179,7 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       .data(reactions)
       .enter()
       .append("marker")
-      .attr("id", function (d) { return "{{ figure_id }}" + d.id + "_rev"; })
+      .attr("id", function (d) { return config.figure_id + d.id + "_rev"; })
       .attr("viewBox", "0 0 10 10")
       .attr("refX", 9)
       .attr("refY", 5)
@@ -519,12 +1199,24 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       .append("path")
       .attr("d", "M 10,10 0,5 10,0 Z");
 
+    // Interquartile ranges of sampled fluxes, drawn as translucent bands
+    // under the links
+    var iqr = svg.append('g').selectAll(".flux-iqr")
+      .data(bilinks.filter(function (d) {
+        return get_iqr_width(d.rxn) !== null;
+      }))
+      .enter()
+      .append("path")
+      .attr("class", "flux-iqr")
+      .attr("fill", "none")
+      .attr("stroke-opacity", .25);
+
     var link = svg.append('g').selectAll(".link")
       .data(bilinks)
       .enter()
       .append("path")
       .attr("class", function (d) {
-        var labels = "link {{ figure_id }}" + d.rxn.id;
+        var labels = "link " + config.figure_id + d.rxn.id;
         if ('flux' in d.rxn.notes.map_info) {
           if (d.rxn.notes.map_info.flux == 0) {
             labels = labels.concat(" inactive");
@@ -533,13 +1225,13 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
         return labels;
       })
       .attr("marker-end", function(d) {
-        return "url(#{{ figure_id }}" + d.rxn.id + ")"; 
+        return "url(#" + config.figure_id + d.rxn.id + ")"; 
       })
       .attr("marker-start", function(d) {
   // Only show the reversible arrow if the reaction isnt carrying flux in
   // a particular direction
         if (plot_reverse_arrowhead(d.rxn)) {
-    return "url(#{{ figure_id }}" + d.rxn.id + "_rev)";
+    return "url(#" + config.figure_id + d.rxn.id + "_rev)";
   }
       });
 
@@ -559,12 +1251,21 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       force.resume();
     }
 
+    function expand_node(d) {
+      // Clicking the node of a collapsed group draws its reactions instead
+      if (d3.event.defaultPrevented || !config.expand) { return; }
+      if ((d.type != 'rxn') && ('subsystem' in d.notes.map_info)) {
+        config.expand(d, force);
+      }
+    }
+
     // define the nodes
     var node = svg.append("g").selectAll(".node")
       .data(nodes)
       .enter()
       .append("g")
       .on('dblclick', releasenode)
+      .on('click', expand_node)
       .call(node_drag);
 
 
@@ -576,6 +1277,9 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
         } else {
           labels = labels.concat(" metabolite");
         }
+        if ('subsystem' in d.notes.map_info) {
+          labels = labels.concat(" subsystem");
+        }
         if ('flux' in d.notes.map_info) {
           if (d.notes.map_info.flux == 0) {
             labels = labels.concat(" inactive");
@@ -594,6 +1298,12 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
           }
         } else return "";});
 
+    node.filter(function (d) { return get_iqr_radius(d) !== null; })
+      .append("circle")
+      .attr("class", "flux-iqr")
+      .attr("fill", "none")
+      .attr("stroke-opacity", .5);
+
     // add the text 
     var text = node.append("text")
       .attr("class", function(d) {
@@ -727,7 +1437,7 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
     var updateLink = function() {
         try {
           this.attr("d", function(d) {
-            return calculate_path(d, force, Math.max(this.getTotalLength(), 15));
+            return styles.calculate_path(d, force.nodes());
           });
         }
         catch(err) {
@@ -756,134 +1466,936 @@ require(["jQuery", "cola", "d3", "math", "FileSaver"], function (jQuery, cola,
       });
     }
 
+    // Nodes that moved less than this many pixels since they were last
+    // drawn are left in place
+    var move_threshold = 0.5,
+    frame_requested = false;
+
+    // Each path depends on the positions of its reaction node and all of the
+    // reaction's metabolites
+    bilinks.forEach(function (d) {
+      d.dependencies = [d.rxn];
+      for (var n in d.rstoich) {
+        d.dependencies.push(nodes[n]);
+      }
+    });
+
+    function mark_moved() {
+      nodes.forEach(function (d) {
+        d.moved = !((Math.abs(d.x - d.drawn_x) <= move_threshold) &&
+                    (Math.abs(d.y - d.drawn_y) <= move_threshold));
+        if (d.moved) {
+          d.drawn_x = d.x;
+          d.drawn_y = d.y;
+        }
+      });
+    }
+
+    function draw(all) {
+      // Redraw the nodes that moved, and the paths attached to them
+      var frame_start = performance.now();
+      mark_moved();
+
+      function moved(d) {
+        return d.dependencies.some(function (n) { return n.moved; });
+      }
+
+      if (all) {
+        link.call(updateLink);
+        iqr.call(updateLink);
+        node.call(updateNode);
+      } else {
+        link.filter(moved).call(updateLink);
+        iqr.filter(moved).call(updateLink);
+        node.filter(function (d) { return d.moved; }).call(updateNode);
+      }
+
+      profiler.frame(performance.now() - frame_start);
+      if (stats.frames === 1) {
+        profiler.end('first_paint');
+      }
+    }
+
+    // Coalesce layout ticks into at most one draw per animation frame
     force.on("tick", function() {
-      link.call(updateLink);
-      node.call(updateNode);
+      stats.ticks += 1;
+      if (!frame_requested) {
+        frame_requested = true;
+        window.requestAnimationFrame(function () {
+          frame_requested = false;
+          draw(false);
+        });
+      }
     });
 
-    // flux_scale = d3.scale.pow().exponent(1/2)
-    flux_scale = d3.scale.linear()
-      .domain([d3.min(fluxes), d3.max(fluxes)])
-      .range([1.5, 6]);
+    force.on("end", function() {
+      if (stats.settle_ms === null) {
+        stats.settle_ms = profiler.end('layout');
+        if (config.settle_iterations) {
+          draw(true);
+        }
+      }
+    });
 
-    // metabolite_scale = d3.scale.pow().exponent(1/2)
-    metabolite_scale = d3.scale.linear()
-      .domain([d3.min(mfluxes), d3.max(mfluxes)])
-      .range([4, 8]);
+    function apply_flux_styles() {
+      svg.selectAll(".link")
+        .attr("stroke-width", function (d) {return get_flux_width(d.rxn);})
+        .attr("stroke", function (d) {return get_flux_stroke(d.rxn);})
+        .attr("stroke-opacity", function (d) {return get_flux_alpha(d.rxn);})
+        .attr("stroke-dasharray", function(d) {return get_flux_dasharray(d.rxn);});
 
-    arrowhead_scale = d3.scale.linear()
-      .domain([1.5, 6])
-      .range([6, 12]);
+      iqr
+        .attr("stroke-width", function (d) {return get_iqr_width(d.rxn);})
+        .attr("stroke", function (d) {return get_flux_stroke(d.rxn);});
+    
+      svg.selectAll("marker")
+        .attr("markerWidth", markerscale)
+        .attr("markerHeight", markerscale)
+        .select("path")
+        .attr("fill", get_flux_stroke)
+        .attr("fill-opacity", get_flux_alpha);
+
+      svg.selectAll(".metabolite")
+        .attr("r", get_node_radius)
+        .attr("fill-opacity", get_flux_alpha);
+
+      node.select(".flux-iqr")
+        .attr("r", get_iqr_radius)
+        .attr("stroke", function (d) {
+          return ('color' in d.notes.map_info) ?
+            d.notes.map_info.color : '#1f77b4';
+        });
+    }
 
-    function get_flux_width (rxn) {
-      if ('stroke' in rxn.notes.map_info) {
-	return rxn.notes.map_info.stroke;
-      } else try {
-        var flux = flux_scale(Math.abs(rxn.notes.map_info.flux));
-        if (!isNaN(flux)) {
-          return flux;
-        } else{
-          return {{ default_flux_width }};
+    apply_flux_styles();
+
+    function update_fluxes(message) {
+      // Apply new flux values, sent from python by FluxMap.update, to the
+      // drawn figure without rebuilding the graph or restarting the layout.
+      apply_flux_update(message, graph, styles);
+
+      link.classed("inactive", function (d) { return is_inactive(d.rxn); })
+        .attr("marker-start", function(d) {
+          if (plot_reverse_arrowhead(d.rxn)) {
+            return "url(#" + config.figure_id + d.rxn.id + "_rev)";
+          }
+          return null;
+        });
+      svg.selectAll("marker").classed("inactive", is_inactive);
+      node.select("circle").classed("inactive", is_inactive);
+      text.classed("inactive", is_inactive);
+
+      apply_flux_styles();
+      link.call(updateLink);
+    }
+
+    // A settled layout is drawn once, now that the styles are defined
+    if (config.settle_iterations && (stats.settle_ms !== null)) {
+      draw(true);
+    }
+
+    // Register the figure so that python can push new fluxes to it
+    window.d3flux_figures = window.d3flux_figures || {};
+    window.d3flux_figures[config.figure_id] = update_fluxes;
+    update_fluxes.stats = stats;
+
+    d3.select("#" + config.figure_id + "_options .download")
+      .on("click", function () {
+
+        save_model_json(model, graph, force.nodes());
+      });
+  }
+
+  function svg_context(width, height) {
+    // Records the subset of the CanvasRenderingContext2D API used by
+    // draw_canvas as SVG elements, so the canvas renderer can still export
+    // vector graphics. `serialize()` returns the SVG document.
+    var elements = [],
+    path = [],
+    stack = [],
+    dash = [];
+
+    function escape(text) {
+      return String(text).replace(/&/g, '&amp;').replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;');
+    }
+
+    function opacity(attr) {
+      return (ctx.globalAlpha < 1) ?
+        ' ' + attr + '="' + ctx.globalAlpha + '"' : '';
+    }
+
+    var ctx = {
+      fillStyle: '#000',
+      strokeStyle: '#000',
+      lineWidth: 1,
+      lineCap: 'butt',
+      globalAlpha: 1,
+      font: '10px sans-serif',
+      textAlign: 'start',
+      textBaseline: 'alphabetic',
+      save: function () {
+        stack.push([ctx.fillStyle, ctx.strokeStyle, ctx.lineWidth,
+                    ctx.lineCap, ctx.globalAlpha, ctx.font, ctx.textAlign,
+                    ctx.textBaseline, dash]);
+      },
+      restore: function () {
+        var state = stack.pop();
+        ctx.fillStyle = state[0];
+        ctx.strokeStyle = state[1];
+        ctx.lineWidth = state[2];
+        ctx.lineCap = state[3];
+        ctx.globalAlpha = state[4];
+        ctx.font = state[5];
+        ctx.textAlign = state[6];
+        ctx.textBaseline = state[7];
+        dash = state[8];
+      },
+      setTransform: function () {},
+      clearRect: function () {},
+      setLineDash: function (segments) { dash = segments; },
+      beginPath: function () { path = []; },
+      moveTo: function (x, y) { path.push('M' + x + ',' + y); },
+      lineTo: function (x, y) { path.push('L' + x + ',' + y); },
+      quadraticCurveTo: function (cx, cy, x, y) {
+        path.push('Q' + cx + ',' + cy + ' ' + x + ',' + y);
+      },
+      arc: function (x, y, r) {
+        // Only full circles are drawn
+        path.push('M' + (x - r) + ',' + y + 'a' + r + ',' + r + ' 0 1,0 ' +
+                  (2 * r) + ',0a' + r + ',' + r + ' 0 1,0 ' + (-2 * r) +
+                  ',0');
+      },
+      closePath: function () { path.push('Z'); },
+      stroke: function () {
+        elements.push('<path d="' + path.join('') + '" fill="none" stroke="' +
+          ctx.strokeStyle + '" stroke-width="' + ctx.lineWidth +
+          '" stroke-linecap="' + ctx.lineCap + '"' +
+          (dash.length ? ' stroke-dasharray="' + dash.join(',') + '"' : '') +
+          opacity('stroke-opacity') + '/>');
+      },
+      fill: function () {
+        elements.push('<path d="' + path.join('') + '" fill="' +
+          ctx.fillStyle + '"' + opacity('fill-opacity') + '/>');
+      },
+      fillText: function (text, x, y) {
+        var anchor = {start: 'start', left: 'start', center: 'middle',
+                      end: 'end', right: 'end'}[ctx.textAlign];
+        elements.push('<text x="' + x + '" y="' + y + '" text-anchor="' +
+          anchor + '" style="font:' + ctx.font + '" fill="' +
+          ctx.fillStyle + '"' + opacity('fill-opacity') + '>' +
+          escape(text) + '</text>');
+      },
+      serialize: function () {
+        return '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 ' +
+          width + ' ' + height + '" width="' + width + '" height="' +
+          height + '">' + elements.join('\n') + '</svg>';
+      }
+    };
+    return ctx;
+  }
+
+  function node_label(d) {
+    // Lines of the node's label
+    if ('display_name' in d.notes.map_info) {
+      return d.notes.map_info.display_name.split('\n');
+    }
+    return ((d.name === undefined) || (d.name === null)) ? [] : [d.name];
+  }
+
+  function label_offset(d, em) {
+    // Position of the first line of the label relative to the node, and its
+    // text alignment, following the SVG renderer's tspan offsets
+    var align = d.notes.map_info.align || '',
+    vertical = (align.indexOf("upper") !== -1) || (align.indexOf("lower") !== -1),
+    offset = {x: vertical ? .6 * em : .9 * em, y: .35 * em, anchor: 'start'};
+
+    if (align.indexOf("upper") !== -1) {
+      offset.y = -.65 * em;
+    } else if (align.indexOf("lower") !== -1) {
+      offset.y = 1.35 * em;
+    }
+    if (align.indexOf("left") !== -1) {
+      offset.x = -offset.x;
+      offset.anchor = 'end';
+    } else if (align.indexOf("center") !== -1) {
+      offset.x = 0;
+      offset.anchor = 'center';
+    }
+    return offset;
+  }
+
+  function draw_arrowhead(ctx, tip_from, tip_to, size) {
+    // Triangle matching the SVG markers, drawn at the end of the segment
+    // tip_from -> tip_to: the base sits 0.1 * size behind the line end and
+    // the tip 0.9 * size beyond it
+    var dx = tip_to[0] - tip_from[0],
+    dy = tip_to[1] - tip_from[1],
+    len = Math.sqrt(dx * dx + dy * dy);
+    if (!(len > 0)) { return; }
+    dx /= len;
+    dy /= len;
+
+    var bx = tip_to[0] - .1 * size * dx,
+    by = tip_to[1] - .1 * size * dy;
+    ctx.beginPath();
+    ctx.moveTo(tip_to[0] + .9 * size * dx, tip_to[1] + .9 * size * dy);
+    ctx.lineTo(bx - .5 * size * dy, by + .5 * size * dx);
+    ctx.lineTo(bx + .5 * size * dy, by - .5 * size * dx);
+    ctx.closePath();
+    ctx.fill();
+  }
+
+  function draw_canvas(ctx, scene, view) {
+    // Draw the network onto a 2D context. `view.k` is the zoom scale (used
+    // for level of detail), `view.detail` shows labels and cofactors,
+    // `view.rxn_nodes` shows the reaction nodes and `view.hover` is a node
+    // whose label is always drawn.
+    var styles = scene.styles,
+    config = scene.config,
+    alpha = config.inactive_alpha,
+    fontsize = 4 / 3 * config.fontsize;
+
+    function shown(d) {
+      return view.detail || !('cofactor' in d);
+    }
+
+    function clamp(v, max) {
+      return Math.max(0, Math.min(max, v));
+    }
+
+    // Links, and their arrowheads
+    ctx.lineCap = 'round';
+    scene.bilinks.forEach(function (d) {
+      if (!(shown(d.source) && shown(d.target)) || !d.geometry) { return; }
+      var g = d.geometry,
+      rxn = d.rxn,
+      color = styles.get_flux_stroke(rxn),
+      dasharray = styles.get_flux_dasharray(rxn),
+      size = 4 / 3 * styles.arrowhead_scale(styles.get_flux_width(rxn)),
+      link_alpha = (is_inactive(rxn) ? alpha : 1),
+      iqr_width = styles.get_iqr_width(rxn);
+
+      function trace() {
+        ctx.beginPath();
+        ctx.moveTo(g.source[0], g.source[1]);
+        if ('cp' in g) {
+          ctx.quadraticCurveTo(g.cp[0], g.cp[1], g.rxn[0], g.rxn[1]);
+          ctx.quadraticCurveTo(g.cp_inv[0], g.cp_inv[1],
+                               g.target[0], g.target[1]);
+        } else {
+          ctx.lineTo(g.rxn[0], g.rxn[1]);
+          ctx.lineTo(g.target[0], g.target[1]);
         }
       }
-      catch(err) {
-        return {{ default_flux_width }}; // Default linewidth
+
+      ctx.strokeStyle = color;
+      ctx.fillStyle = color;
+
+      // Interquartile range of sampled fluxes, under the link
+      if (iqr_width !== null) {
+        ctx.globalAlpha = .25 * link_alpha;
+        ctx.lineWidth = iqr_width;
+        ctx.setLineDash([]);
+        trace();
+        ctx.stroke();
+      }
+
+      ctx.globalAlpha = link_alpha * styles.get_flux_alpha(rxn);
+      ctx.lineWidth = styles.get_flux_width(rxn);
+      ctx.setLineDash(dasharray ? String(dasharray).split(/[\s,]+/)
+        .filter(function (v) { return v !== ''; }).map(Number) : []);
+      trace();
+      ctx.stroke();
+
+      ctx.setLineDash([]);
+      draw_arrowhead(ctx, ('cp' in g) ? g.cp_inv : g.rxn, g.target, size);
+      if (styles.plot_reverse_arrowhead(rxn)) {
+        draw_arrowhead(ctx, ('cp' in g) ? g.cp : g.rxn, g.source, size);
+      }
+    });
+
+    // Nodes
+    scene.nodes.forEach(function (d) {
+      if (!shown(d)) { return; }
+      if (d.type == 'rxn') {
+        if (!view.rxn_nodes) { return; }
+        ctx.fillStyle = '#FFA319';
+      } else {
+        ctx.fillStyle = ('color' in d.notes.map_info) ?
+          d.notes.map_info.color : '#1f77b4';
+      }
+      var node_alpha = is_inactive(d) ? alpha : 1,
+      iqr_radius = (d.type == 'rxn') ? null : styles.get_iqr_radius(d);
+      ctx.globalAlpha = node_alpha * styles.get_flux_alpha(d);
+      ctx.beginPath();
+      ctx.arc(clamp(d.x, config.width), clamp(d.y, config.height),
+              (d.type == 'rxn') ? 5 : styles.get_node_radius(d),
+              0, 2 * Math.PI);
+      ctx.fill();
+
+      // Interquartile range of sampled throughput, as a ring
+      if (iqr_radius !== null) {
+        ctx.globalAlpha = .5 * node_alpha;
+        ctx.strokeStyle = ctx.fillStyle;
+        ctx.lineWidth = 1;
+        ctx.beginPath();
+        ctx.arc(clamp(d.x, config.width), clamp(d.y, config.height),
+                iqr_radius, 0, 2 * Math.PI);
+        ctx.stroke();
+      }
+    });
+
+    // Labels
+    ctx.textBaseline = 'alphabetic';
+    scene.nodes.forEach(function (d) {
+      if (!((view.detail && shown(d)) || (d === view.hover))) { return; }
+      var em = (('cofactor' in d) || (d.type == 'rxn')) ? .8 * fontsize : fontsize,
+      offset = label_offset(d, em),
+      x = clamp(d.x, config.width) + offset.x,
+      y = clamp(d.y, config.height) + offset.y;
+
+      ctx.globalAlpha = is_inactive(d) ? alpha : 1;
+      if (d.type == 'rxn') {
+        ctx.fillStyle = '#A9A9A9';
+        ctx.font = 'italic ' + em + 'px Arial';
+      } else {
+        ctx.fillStyle = ('cofactor' in d) ? '#778899' : '#555';
+        ctx.font = em + 'px Arial';
       }
+      ctx.textAlign = offset.anchor;
+      node_label(d).forEach(function (line, i) {
+        ctx.fillText(line, x, y + 1.2 * em * i);
+      });
+    });
+    ctx.globalAlpha = 1;
+  }
+
+  function main_canvas(model, config, profiler) {
+    // Render the network on a <canvas> instead of as SVG elements, for
+    // genome-scale maps where the number of DOM nodes makes the SVG renderer
+    // slow. The view pans and zooms; below the `config.lod_zoom` scale only
+    // the primary metabolites and the links between them are drawn. Nodes
+    // under the pointer are found with a quadtree for dragging and hover
+    // labels. Uses the same graph, styles and layout as `main`.
+    profiler = profiler || figure_profiler(config.figure_id);
+    profiler.start('first_paint');
+    var stats = profiler.stats;
+
+    var width = config.width,
+    height = config.height,
+    ratio = window.devicePixelRatio || 1;
+
+    var use_worker = config.layout_worker;
+    if ((use_worker === null) || (use_worker === undefined)) {
+      use_worker = ((typeof Worker !== 'undefined') &&
+        (model.metabolites.length + model.reactions.length >= 500));
     }
 
-    function get_flux_dasharray (d) {
-      if ('dasharray' in d.notes.map_info) {
-	return d.notes.map_info.dasharray;
-      } else try {
-	  if (d.notes.map_info.group == 'ko') {
-	    return "5, 5, 1, 5";
-	  }
-	  else if (Math.abs(d.notes.map_info.flux) < 1E-6) {
-	    return "5,5";
-	  }
-	}
-	catch(err) {
-	  return;
+    var force = (use_worker ? worker_layout() : cola.d3adaptor())
+      .linkDistance(30)
+      .size([width, height]);
+
+    if (config.flowLayout) {
+      force.flowLayout('y', 15);
+    }
+
+    // The canvas is laid over the background SVG if one was given, which
+    // then follows the zoom through its viewBox
+    var container = d3.select("#" + config.figure_id),
+    background = null,
+    background_box = null,
+    canvas = container.append("canvas")
+      .attr("width", width * ratio)
+      .attr("height", height * ratio);
+
+    if (config.no_background) {
+      canvas.attr("style", "display:block;margin:auto;width:" +
+                  config.svg_scale + "%");
+    } else {
+      background = container.select("svg");
+      background_box = (background.attr("viewBox") ||
+                        "0 0 " + width + " " + height).split(/[\s,]+/)
+        .map(Number);
+      container.style("position", "relative");
+      canvas.attr("style",
+                  "position:absolute;left:0;top:0;width:100%;height:100%");
+    }
+    var ctx = canvas.node().getContext("2d");
+
+    profiler.start('graph');
+    var graph = build_graph(model, config);
+    profiler.end('graph');
+
+    var nodes = graph.nodes,
+    bilinks = graph.bilinks,
+    styles = flux_styles(config, graph.fluxes, graph.mfluxes),
+    scene = {config: config, styles: styles, nodes: nodes, bilinks: bilinks};
+
+    // Labels and cofactors are drawn at zoom scales of at least lod_zoom
+    var lod_zoom = config.lod_zoom;
+    if ((lod_zoom === null) || (lod_zoom === undefined)) {
+      lod_zoom = (nodes.length >= 500) ? 2 : 0;
+    }
+
+    var view = {k: 1, x: 0, y: 0, detail: lod_zoom <= 1, rxn_nodes: false,
+                hover: null};
+
+    profiler.start('layout');
+
+    force
+      .nodes(nodes)
+      .links(graph.links);
+
+    if (config.settle_iterations) {
+      force.start(config.settle_iterations, 0, config.settle_iterations, 0,
+                  false);
+      if (!force.worker) {
+        stats.settle_ms = profiler.end('layout');
       }
+    } else {
+      force.start();
     }
 
-    function get_flux_stroke (d) {
-      if ('color' in d.notes.map_info) {
-        return d.notes.map_info.color;
-      } else {
-          return rxncolor(d.notes.map_info.group);
+    // Each link's geometry is recomputed only when its reaction node or one
+    // of the reaction's metabolites moved
+    var move_threshold = 0.5,
+    frame_requested = false,
+    tree = null;
+
+    bilinks.forEach(function (d) {
+      d.dependencies = [d.rxn];
+      for (var n in d.rstoich) {
+        d.dependencies.push(nodes[n]);
+      }
+    });
+
+    function draw(all) {
+      var frame_start = performance.now();
+      nodes.forEach(function (d) {
+        d.moved = all || !((Math.abs(d.x - d.drawn_x) <= move_threshold) &&
+                           (Math.abs(d.y - d.drawn_y) <= move_threshold));
+        if (d.moved) {
+          d.drawn_x = d.x;
+          d.drawn_y = d.y;
+          tree = null;
+        }
+      });
+      bilinks.forEach(function (d) {
+        if (d.dependencies.some(function (n) { return n.moved; })) {
+          try {
+            d.geometry = styles.link_geometry(d, nodes);
+          } catch (err) {
+            d.geometry = null;
+          }
         }
+      });
+
+      ctx.setTransform(1, 0, 0, 1, 0, 0);
+      ctx.clearRect(0, 0, width * ratio, height * ratio);
+      ctx.setTransform(ratio * view.k, 0, 0, ratio * view.k,
+                       ratio * view.x, ratio * view.y);
+      draw_canvas(ctx, scene, view);
+
+      profiler.frame(performance.now() - frame_start);
+      if (stats.frames === 1) {
+        profiler.end('first_paint');
+      }
     }
 
-    function markerscale (d) {
-      return arrowhead_scale(get_flux_width(d)) + "pt";
+    function request_draw() {
+      if (!frame_requested) {
+        frame_requested = true;
+        window.requestAnimationFrame(function () {
+          frame_requested = false;
+          draw(false);
+        });
+      }
     }
 
-    function get_node_radius (d) {
-      if ('cofactor' in d) {return 4;}
-      try {
-        var nodewidth = metabolite_scale(Math.abs(d.notes.map_info.flux));
-        if (!isNaN(nodewidth)) {
-          return nodewidth;
-        } else {
-          return 5;
+    force.on("tick", function () {
+      stats.ticks += 1;
+      request_draw();
+    });
+
+    force.on("end", function () {
+      if (stats.settle_ms === null) {
+        stats.settle_ms = profiler.end('layout');
+        if (config.settle_iterations) {
+          draw(true);
         }
       }
-      catch(err){ return 5; }
+    });
+
+    function css_scale() {
+      // Layout units per CSS pixel of the displayed canvas
+      return width / canvas.node().getBoundingClientRect().width;
+    }
+
+    function pointer() {
+      // Pointer position in layout coordinates
+      var p = d3.mouse(canvas.node()),
+      c = css_scale();
+      return [(p[0] * c - view.x) / view.k, (p[1] * c - view.y) / view.k];
+    }
+
+    function find_node(p) {
+      // Closest drawn node within a few screen pixels of p
+      if (tree === null) {
+        tree = d3.geom.quadtree()
+          .x(function (d) { return d.x; })
+          .y(function (d) { return d.y; })(nodes.filter(function (d) {
+            return (view.detail || !('cofactor' in d)) &&
+              ((d.type != 'rxn') || view.rxn_nodes);
+          }));
+      }
+      var d = tree.find(p);
+      if (!d) { return null; }
+      var dx = d.x - p[0], dy = d.y - p[1],
+      reach = styles.get_node_radius(d) + 4 / view.k;
+      return (dx * dx + dy * dy <= reach * reach) ? d : null;
+    }
+
+    var dragged = null,
+    drag_moved = false,
+    drag_ns = ".d3flux" + config.figure_id;
+
+    // Registered before the zoom behaviour, so that presses on a node drag
+    // the node instead of panning the view
+    canvas
+      .on("mousedown.node", function () {
+        var d = find_node(pointer());
+        if (!d) { return; }
+        d3.event.stopImmediatePropagation();
+        d3.event.preventDefault();
+        dragged = d;
+        drag_moved = false;
+        d.fixed = true;
+        drag_node(force, d, 'start');
+
+        d3.select(window)
+          .on("mousemove" + drag_ns, function () {
+            var p = pointer();
+            drag_moved = true;
+            drag_node(force, dragged, 'drag', p[0], p[1]);
+            request_draw();
+          })
+          .on("mouseup" + drag_ns, function () {
+            drag_node(force, dragged, 'end');
+            dragged = null;
+            d3.select(window)
+              .on("mousemove" + drag_ns, null)
+              .on("mouseup" + drag_ns, null);
+          });
+      })
+      .on("click.node", function () {
+        // Clicking the node of a collapsed group draws its reactions instead
+        var d = find_node(pointer());
+        if (!d || drag_moved || !config.expand) { return; }
+        if ((d.type != 'rxn') && ('subsystem' in d.notes.map_info)) {
+          config.expand(d, force);
+        }
+      })
+      .on("dblclick.node", function () {
+        // Release a dragged node back to the layout
+        var d = find_node(pointer());
+        if (!d) { return; }
+        d3.event.stopImmediatePropagation();
+        d.fixed = false;
+        force.resume();
+      })
+      .on("mousemove.hover", function () {
+        if (dragged) { return; }
+        var d = find_node(pointer());
+        if (d !== view.hover) {
+          view.hover = d;
+          canvas.attr("title", d ? node_label(d).join(' ') : null);
+          canvas.style("cursor", d ? "pointer" : null);
+          request_draw();
+        }
+      });
+
+    canvas.call(d3.behavior.zoom()
+      .scaleExtent([.1, 20])
+      .on("zoom", function () {
+        var c = css_scale();
+        view.k = d3.event.scale;
+        view.x = d3.event.translate[0] * c;
+        view.y = d3.event.translate[1] * c;
+        if (view.detail != (view.k >= lod_zoom)) {
+          view.detail = (view.k >= lod_zoom);
+          tree = null;
+        }
+        if (background) {
+          var b = background_box;
+          background.attr("viewBox", [
+            b[0] - view.x / view.k * b[2] / width,
+            b[1] - view.y / view.k * b[3] / height,
+            b[2] / view.k, b[3] / view.k].join(" "));
+        }
+        request_draw();
+      }));
+
+    d3.select("#" + config.figure_id + "_options .reactionbutton").on("click", function() {
+      // Show/hide the reaction control node points.
+      var $this = $(this);
+      $this.toggleClass('btn-danger');
+      view.rxn_nodes = $this.hasClass('btn-danger');
+      tree = null;
+      if (view.rxn_nodes) {
+        $this.text('Hide Reaction Nodes');
+      } else {
+        $this.text('Show Reaction Nodes');
+      }
+      request_draw();
+    });
+
+    d3.select("#" + config.figure_id + "_options .svgbutton").on("click", function() {
+      // Export the full-detail network, unzoomed, as SVG
+      var svg_ctx = svg_context(width, height);
+      draw_canvas(svg_ctx, scene, {k: 1, detail: true,
+                                   rxn_nodes: view.rxn_nodes, hover: null});
+      var blob = new Blob([svg_ctx.serialize()], {type: "image/svg+xml"});
+      saveAs(blob, model.id + ".svg");
+    });
+
+    function update_fluxes(message) {
+      // Apply new flux values, sent from python by FluxMap.update
+      apply_flux_update(message, graph, styles);
+      draw(true);
     }
 
-    svg.selectAll(".link")
-      .attr("stroke-width", function (d) {return get_flux_width(d.rxn);})
-      .attr("stroke", function (d) {return get_flux_stroke(d.rxn);})
-      .attr("stroke-dasharray", function(d) {return get_flux_dasharray(d.rxn);});
-  
-    svg.selectAll("marker")
-      .attr("markerWidth", markerscale)
-      .attr("markerHeight", markerscale)
-      .select("path")
-      .attr("fill", get_flux_stroke);
+    if (config.settle_iterations && (stats.settle_ms !== null)) {
+      draw(true);
+    }
 
-    svg.selectAll(".metabolite")
-      .attr("r", get_node_radius);
+    window.d3flux_figures = window.d3flux_figures || {};
+    window.d3flux_figures[config.figure_id] = update_fluxes;
+    update_fluxes.stats = stats;
 
-    d3.select("#{{ figure_id }}_options .download")
+    d3.select("#" + config.figure_id + "_options .download")
       .on("click", function () {
+        save_model_json(model, graph, force.nodes());
+      });
+  }
 
-        // Add position data to model nodes
-        force.nodes().forEach(function (node) {
-          if (node.fixed) {
-            if (node.type == "rxn") {
-              // Reaction object
-              obj = $.grep(model.reactions, function(e){ return e.id == node.id; })[0];
-              if (!("notes" in obj)) { obj.notes = {}; }
-              if (!("map_info" in obj.notes)) { obj.notes.map_info = {}; }
-              obj.notes.map_info['x'] = node.x;
-              obj.notes.map_info['y'] = node.y;
-            } else {
-              // Look in metabolites
-              if (!('cofactor' in node)) {
-                obj = $.grep(model.metabolites, function(e){ return e.id == node.id; })[0];
-                if (!("notes" in obj)) { obj.notes = {}; }
-                if (!("map_info" in obj.notes)) { obj.notes.map_info = {}; }
-                obj.notes.map_info['x'] = node.x;
-                obj.notes.map_info['y'] = node.y;
-              } else {
-                rxn = $.grep(model.reactions, function(e){ 
-                  return e.id == node.cofactor; })[0];
-                rxn.notes.map_info.cofactors[node.notes.orig_id]['x'] = node.x
-                rxn.notes.map_info.cofactors[node.notes.orig_id]['y'] = node.y
-              }
-            }
+  function expand_model(payload) {
+    // Rebuild the model object read by main from the columnar payload
+    // generated by d3flux.core.payload.compact_payload
+    function expand(columns) {
+      return columns.id.map(function (id, i) {
+        var map_info = jQuery.extend({}, columns.map_info[i] || {});
+        ['flux', 'x', 'y'].forEach(function (key) {
+          if (columns[key][i] !== null) {
+            map_info[key] = columns[key][i];
+          }
+        });
+        return {id: id, name: columns.name[i], notes: {map_info: map_info}};
+      });
+    }
+
+    var model = {
+      id: payload.id,
+      notes: payload.notes,
+      metabolites: expand(payload.metabolites),
+      reactions: expand(payload.reactions)
+    },
+    stoich = payload.stoichiometry;
+
+    model.reactions.forEach(function (reaction) {
+      reaction.metabolites = {};
+    });
+    for (var k = 0; k < stoich.coefficient.length; k++) {
+      model.reactions[stoich.reaction[k]].metabolites[
+        model.metabolites[stoich.metabolite[k]].id] = stoich.coefficient[k];
+    }
+    return model;
+  }
+
+  function load_model(data) {
+    // Returns a promise for the model object. Accepts a full model
+    // dictionary, a compact payload, a gzipped and base64-encoded payload
+    // string, or an overlay of per-condition fluxes on a shared model.
+    if (typeof data === 'string') {
+      var bytes = Uint8Array.from(atob(data), function (c) {
+        return c.charCodeAt(0);
+      });
+      var stream = new Blob([bytes]).stream()
+        .pipeThrough(new DecompressionStream('gzip'));
+      return new Response(stream).text().then(function (text) {
+        return load_model(JSON.parse(text));
+      });
+    }
+
+    if (data.format == 'd3flux.compact.v1') {
+      return Promise.resolve(expand_model(data));
+    }
+
+    if (data.format == 'd3flux.collapsed.v1') {
+      // Coarse model of a map collapsed by subsystem, with the still
+      // compressed chunk of each group (see d3flux.core.subsystems)
+      return load_model(data.model).then(function (model) {
+        model.chunks = data.chunks;
+        return model;
+      });
+    }
+
+    if (data.format == 'd3flux.overlay.v1') {
+      return load_model(data.base).then(function (base) {
+        // Copy the shared model and set the fluxes of a single condition.
+        // Arrays are ordered as model.reactions and model.metabolites, null
+        // is undefined.
+        var model = JSON.parse(JSON.stringify(base));
+
+        function set_flux(obj, flux) {
+          if (!('notes' in obj)) { obj.notes = {}; }
+          if (!('map_info' in obj.notes)) { obj.notes.map_info = {}; }
+          if (flux === null) {
+            delete obj.notes.map_info.flux;
+          } else {
+            obj.notes.map_info.flux = flux;
           }
+        }
+
+        model.reactions.forEach(function (reaction, i) {
+          set_flux(reaction, data.reaction_flux[i]);
+        });
+        model.metabolites.forEach(function (metabolite, i) {
+          set_flux(metabolite, data.metabolite_flux[i]);
         });
+        return model;
+      });
+    }
+
+    return Promise.resolve(data);
+  }
+
+  function expand_group(model, group_id, nodes) {
+    // Returns a promise for a copy of a collapsed model in which the group
+    // node `group_id` and its links are replaced by the reactions of the
+    // group's chunk. The drawn `nodes` keep their current positions, and
+    // the new nodes are seeded around the group node.
+    return load_model(model.chunks[group_id]).then(function (detail) {
+      var positions = {},
+      seed = null;
+
+      function key(type, id) { return type + ':' + id; }
+
+      nodes.forEach(function (d) {
+        if (d.id == group_id) {
+          seed = {x: d.x, y: d.y};
+        } else if ('cofactor' in d) {
+          positions[key('cofactor', d.id)] = d;
+        } else {
+          positions[key(d.type == 'rxn' ? 'rxn' : 'met', d.id)] = d;
+        }
+      });
+
+      function place(map_info, k) {
+        if (k in positions) {
+          map_info.x = positions[k].x;
+          map_info.y = positions[k].y;
+        }
+      }
+
+      var coarse = JSON.parse(JSON.stringify({
+        metabolites: model.metabolites, reactions: model.reactions})),
+      metabolites = coarse.metabolites.filter(function (metabolite) {
+        return metabolite.id != group_id;
+      }),
+      reactions = coarse.reactions.filter(function (reaction) {
+        var map_info = reaction.notes.map_info;
+        return (map_info.subsystem_node != group_id) &&
+          ((map_info.subsystem_link || []).indexOf(group_id) < 0);
+      }),
+      present = index_by_id(metabolites),
+      present_reactions = index_by_id(reactions);
+
+      // Stubs stand for the other groups' nodes, which are either already
+      // drawn or expanded. Links to expanded groups are dropped.
+      detail.metabolites.forEach(function (metabolite) {
+        if (!(metabolite.id in present) &&
+            !metabolite.notes.map_info.subsystem_stub) {
+          metabolite.seed = seed;
+          metabolites.push(metabolite);
+        }
+      });
+      detail.reactions.forEach(function (reaction) {
+        var node = reaction.notes.map_info.subsystem_node;
+        if (!(reaction.id in present_reactions) &&
+            ((node === undefined) || (node in present))) {
+          reaction.seed = seed;
+          reactions.push(reaction);
+        }
+      });
 
-        var json = JSON.stringify(model);
-        var blob = new Blob([json], {type: "application/json"});
-        saveAs(blob, model.id + ".json");
+      metabolites.forEach(function (metabolite) {
+        place(metabolite.notes.map_info, key('met', metabolite.id));
       });
+      reactions.forEach(function (reaction) {
+        var map_info = reaction.notes.map_info;
+        place(map_info, key('rxn', reaction.id));
+        for (var cofactor in map_info.cofactors || {}) {
+          place(map_info.cofactors[cofactor],
+                key('cofactor', cofactor + '_' + reaction.id));
+        }
+      });
+
+      var chunks = jQuery.extend({}, model.chunks);
+      delete chunks[group_id];
+
+      return {id: model.id, notes: model.notes, metabolites: metabolites,
+              reactions: reactions, chunks: chunks};
+    });
+  }
+
+  function draw_figure(model, config, profiler) {
+    // Draw the model with the configured renderer. Clicking a group node of
+    // a collapsed model redraws the figure with the group expanded.
+    var figure_config = config;
+
+    if (model.chunks) {
+      var container = document.getElementById(config.figure_id),
+      background = container.innerHTML;
+
+      figure_config = jQuery.extend({}, config, {
+        expand: function (d, force) {
+          if (!(d.id in model.chunks)) { return; }
+          expand_group(model, d.id, force.nodes()).then(function (expanded) {
+            force.stop();
+            container.innerHTML = background;
+            draw_figure(expanded, config);
+          });
+        }
+      });
+    }
+
+    if (config.renderer == 'canvas') {
+      main_canvas(model, figure_config, profiler);
+    } else {
+      main(model, figure_config, profiler);
+    }
   }
 
-  main({{ figure_id }}model);
+  return {
+    render: function (config, data) {
+      // Draw the figure described by `config` once the model has loaded
+      var profiler = figure_profiler(config.figure_id);
+      profiler.start('decode');
+      return load_model(data).then(function (model) {
+        profiler.end('decode');
+        draw_figure(model, config, profiler);
+        return profiler.stats;
+      });
+    },
+    load_model: load_model,
+    expand_model: expand_model,
+    expand_group: expand_group,
+    figure_profiler: figure_profiler,
+    build_graph: build_graph,
+    worker_layout: worker_layout,
+    layout_worker: layout_worker
+  };
 });
 
 function Point(x, y) {
@@ -0,0 +1,94 @@
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+from cobra.io import load_json_model
+from d3flux.core.batch import (
+    main, output_names, plan_jobs, render_batch, render_solutions)
+
+test_dir = os.path.dirname(__file__)
+model_path = os.path.join(test_dir, 'simple_model.json')
+
+
+def write_fluxes(tmpdir, columns=('wt', 'mutant')):
+    model = load_json_model(model_path)
+    fluxes = pd.DataFrame(1., index=[r.id for r in model.reactions],
+                          columns=list(columns))
+    filename = str(tmpdir.join('simple_model_fluxes.csv'))
+    fluxes.to_csv(filename)
+    return filename
+
+
+def test_plan_jobs(tmpdir):
+    write_fluxes(tmpdir, columns=['a', 'b', 'c', 'd'])
+    pattern = str(tmpdir.join('{model}_*.csv'))
+
+    jobs = plan_jobs([model_path], [pattern], chunks=2)
+    assert [len(solutions) for _, solutions in jobs] == [2, 2]
+    assert all(job[0] == model_path for job in jobs)
+
+
+def test_render_batch(tmpdir):
+    table = write_fluxes(tmpdir)
+    output = str(tmpdir.join('maps'))
+
+    results = render_batch([model_path], [table], output,
+                           formats=('html', 'svg'), processes=1)
+    filenames = sorted(os.path.basename(r[0]) for r in results)
+    assert filenames == ['simple_model_fluxes_mutant.html',
+                         'simple_model_fluxes_mutant.svg',
+                         'simple_model_fluxes_wt.html',
+                         'simple_model_fluxes_wt.svg']
+
+    # Figure ids don't depend on a global counter
+    with open(os.path.join(output, 'simple_model',
+                           'simple_model_fluxes_wt.html')) as f:
+        first = f.read()
+    render_batch([model_path], [table], output, processes=1)
+    with open(os.path.join(output, 'simple_model',
+                           'simple_model_fluxes_wt.html')) as f:
+        assert f.read() == first
+
+
+def test_main(tmpdir, capsys):
+    output = str(tmpdir.join('maps'))
+    assert main([model_path, '-o', output, '-f', 'svg', '-p', '1']) == 0
+    assert os.path.exists(os.path.join(output, 'simple_model', 'model.svg'))
+    assert '1 files' in capsys.readouterr().out
+
+
+def test_same_model_names(tmpdir):
+    paths = []
+    for directory in ('a', 'b'):
+        tmpdir.mkdir(directory)
+        paths.append(str(tmpdir.join(directory, 'model.json')))
+        shutil.copy(model_path, paths[-1])
+
+    assert output_names(paths + [model_path]) == {
+        paths[0]: 'a_model', paths[1]: 'b_model',
+        model_path: 'simple_model'}
+
+    output = str(tmpdir.join('maps'))
+    results = render_batch(paths, output=output, processes=1)
+    assert sorted(os.path.relpath(r[0], output) for r in results) == [
+        os.path.join('a_model', 'model.html'),
+        os.path.join('b_model', 'model.html')]
+
+
+def test_same_table_names(tmpdir):
+    for directory in ('a', 'b'):
+        write_fluxes(tmpdir.mkdir(directory))
+    with pytest.raises(ValueError):
+        plan_jobs([model_path], [str(tmpdir.join('*', '*.csv'))])
+
+
+def test_unknown_layout(tmpdir, capsys):
+    with pytest.raises(SystemExit):
+        main([model_path, '--layout', 'pyhton'])
+    assert "Unknown layout 'pyhton'" in capsys.readouterr().err
+
+    with pytest.raises(ValueError):
+        render_solutions(model_path, [(None, None)], str(tmpdir),
+                         layout='missing.json')
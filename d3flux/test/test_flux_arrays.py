@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import pytest
+
+from cobra.io import load_json_model
+from d3flux.core.flux_arrays import (
+    get_flux_vector, stoichiometric_matrix, metabolite_throughput)
+
+examples = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(params=['putida/vdl_2.json', 'asuc/asuc_v1.json'])
+def solved_model(request):
+    model = load_json_model(os.path.join(examples, request.param))
+    model.optimize()
+    return model
+
+
+def test_flux_vector_matches_reactions(solved_model):
+    fluxes = get_flux_vector(solved_model)
+    expected = [reaction.flux for reaction in solved_model.reactions]
+    assert np.allclose(fluxes, expected)
+
+
+def test_flux_vector_from_dict(solved_model):
+    flux_dict = {r.id: 1. for r in solved_model.reactions[1:]}
+    fluxes = get_flux_vector(solved_model, flux_dict)
+    assert np.isnan(fluxes[0])
+    assert np.all(fluxes[1:] == 1.)
+
+
+def test_flux_vector_unsolved():
+    model = load_json_model(os.path.join(examples, 'asuc/asuc_v1.json'))
+    assert np.all(np.isnan(get_flux_vector(model)))
+
+
+def test_metabolite_throughput(solved_model):
+    fluxes = get_flux_vector(solved_model)
+    throughput = metabolite_throughput(
+        stoichiometric_matrix(solved_model), fluxes)
+
+    expected = [sum([abs(r.flux * r.metabolites[met]) for r in
+                     met.reactions]) / 2 for met in solved_model.metabolites]
+    assert np.allclose(throughput, expected)
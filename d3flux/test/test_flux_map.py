@@ -1,6 +1,9 @@
+import json
+
 import pytest
 from cobra.core import Metabolite, Reaction, Model
-from d3flux import flux_map
+from d3flux import flux_map, flux_map_grid, init_notebook_mode
+from d3flux.core.profiling import profile
 
 @pytest.fixture()
 def simple_model():
@@ -65,3 +68,120 @@ def test_flux_map_knockout(simple_model):
 
     assert svg is not None
 
+
+
+def test_flux_map_grid(simple_model):
+    solutions = {
+        'R4': {'R1': 1, 'R5': 1, 'R8': 1, 'R10': 1, 'R4': 1},
+        'R3': {'R1': 1, 'R5': 1, 'R9': 1, 'R3': 1},
+        'empty': {},
+    }
+    html = flux_map_grid(simple_model, solutions, ncols=3,
+                         figsize=(300, 250)).data
+
+    # The model is embedded once, each panel only carries flux arrays
+    assert html.count('"reactions":') == 1
+    assert html.count('"base": d3fluxgrid') == len(solutions)
+    for label in solutions:
+        assert '>{}</h4>'.format(label) in html
+
+
+def test_flux_map_grid_options(simple_model):
+    solutions = [('R4', {'R1': 1, 'R5': 1, 'R8': 1, 'R10': 1, 'R4': 1})]
+    shared = {rxn.id: 0. for rxn in simple_model.reactions}
+    shared['R5'] = 7.5
+
+    grid = flux_map_grid(simple_model, solutions, flux_dict=shared,
+                         payload='compact', profile=True)
+    assert '7.5' in grid.data
+    assert 'model_dict' in [s['stage'] for s in grid.stats.stages]
+
+    with pytest.raises(ValueError) as error:
+        flux_map_grid(simple_model, solutions, cache=True)
+    assert 'cache' in str(error.value)
+
+
+def test_flux_map_update(simple_model):
+    fluxes = {rxn.id: 1. for rxn in simple_model.reactions}
+    fig = flux_map(simple_model, figsize=(300,250), flux_dict=fluxes)
+
+    messages = []
+    fig.send = messages.append
+
+    # Nothing has changed, so nothing is sent
+    fig.update(fluxes)
+    assert not messages
+
+    fluxes.update({'R8': 0., 'R9': -2.})
+    message = fig.update(fluxes)
+
+    assert messages == [message]
+    assert message['reactions'] == {'R8': 0., 'R9': -2.}
+    assert set(message['metabolites']) == {'C', 'P'}
+
+
+def test_init_notebook_mode(simple_model):
+    from d3flux.core.flux_layouts import render_model
+
+    library = init_notebook_mode().data
+    try:
+        assert 'define("d3flux"' in library
+        html = flux_map(simple_model, figsize=(300,250)).data
+        assert 'define("d3flux"' not in html
+        assert 'd3flux.render(' in html
+    finally:
+        render_model._library_loaded = False
+
+    # Without the notebook mode, figures are self-contained
+    html = flux_map(simple_model, figsize=(300,250)).data
+    assert 'define("d3flux"' in html
+
+
+def test_flux_map_leaves_model_unchanged(simple_model):
+    import copy
+
+    simple_model.reactions.R8.knock_out()
+    notes = copy.deepcopy([obj.notes for obj in simple_model.metabolites] +
+                          [obj.notes for obj in simple_model.reactions])
+
+    fig = flux_map(simple_model, figsize=(300,250), layout='python',
+                   excluded_metabolites=['A'],
+                   flux_dict={rxn.id: 1. for rxn in simple_model.reactions})
+
+    assert '"hidden": true' in fig.data
+    assert '"group": "ko"' in fig.data
+    assert notes == ([obj.notes for obj in simple_model.metabolites] +
+                     [obj.notes for obj in simple_model.reactions])
+
+
+def test_flux_map_settle_iterations(simple_model):
+    html = flux_map(simple_model, figsize=(300,250),
+                    settle_iterations=50).data
+    assert '"settle_iterations": 50' in html
+
+
+def test_flux_map_canvas_renderer(simple_model):
+    html = flux_map(simple_model, renderer='canvas', lod_zoom=1.5).data
+    assert '"renderer": "canvas"' in html
+    assert '"lod_zoom": 1.5' in html
+
+    with pytest.raises(ValueError):
+        flux_map(simple_model, renderer='webgl')
+
+
+def test_flux_map_profile(simple_model):
+    simple_model.optimize()
+    assert flux_map(simple_model).stats is None
+
+    figure = flux_map(simple_model, profile=True)
+    stages = [s['stage'] for s in figure.stats.stages]
+    assert stages[:3] == ['overlay', 'fluxes', 'model_to_dict']
+    assert stages[-3:] == ['model_dict', 'encode', 'template']
+    assert figure.stats.sizes['html'] == len(figure.data)
+    assert all(s['peak_memory'] >= 0 for s in figure.stats.stages)
+    json.dumps(figure.stats.as_dict())
+
+    with profile(trace_memory=False) as stats:
+        flux_map(simple_model, payload='compact')
+        flux_map(simple_model, payload='compact')
+    assert [s['stage'] for s in stats.stages].count('template') == 2
@@ -0,0 +1,136 @@
+import os
+import shutil
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from cobra.core import Metabolite, Reaction
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict, map_info_overlay
+from d3flux.core.graph import build_graph
+from d3flux.core.layout import (
+    graph_layout, stress_layout, layout_model, layout_diff, node_positions)
+
+test_dir = os.path.dirname(__file__)
+
+
+def load_graph(filename):
+    model = load_json_model(os.path.join(test_dir, filename))
+    overlay = map_info_overlay(model)
+    return model, build_graph(create_model_dict(model, overlay=overlay))
+
+
+def test_build_graph():
+    model, graph = load_graph('simple_model.json')
+
+    # R1-R4 are boundary reactions and are not drawn
+    rxn_nodes = [node['id'] for node in graph.nodes if node['type'] == 'rxn']
+    assert sorted(rxn_nodes) == ['R10', 'R5', 'R6', 'R7', 'R8', 'R9']
+    assert len(graph.links) == 2 * len(graph.bilinks)
+
+
+def test_fixed_positions_respected():
+    model, graph = load_graph('simple_model.json')
+    fixed = np.array(graph.fixed())
+    before = np.array([(n['map_info'].get('x', 0), n['map_info'].get('y', 0))
+                       for n in graph.nodes])
+
+    positions = graph_layout(graph)
+    assert np.allclose(positions[fixed], before[fixed])
+    assert np.all(np.isfinite(positions))
+
+
+def test_flow_layout_constraint():
+    positions = stress_layout(4, [(0, 1), (1, 2), (2, 3)], flow_gap=15)
+    assert np.all(np.diff(positions[:, 1]) >= 15 - 1E-6)
+
+
+def test_disconnected_components_packed():
+    links = [(0, 1), (1, 2), (2, 0), (3, 4), (4, 5), (5, 3)]
+    positions = stress_layout(6, links)
+    assert np.all(np.isfinite(positions))
+
+    # Each triangle keeps its shape, and the two don't overlap
+    for nodes in ([0, 1, 2], [3, 4, 5]):
+        sides = np.hypot(*(positions[nodes] -
+                           positions[np.roll(nodes, 1)]).T)
+        assert np.allclose(sides, 30, rtol=0.1)
+    lower, upper = positions[:3].min(0), positions[:3].max(0)
+    assert np.any((positions[3:] < lower) | (positions[3:] > upper))
+
+
+def test_stress_layout_memory():
+    # A long cycle with chords, of roughly genome-scale size. A dense
+    # distance matrix alone would take n_nodes ** 2 * 8 = 288 MB.
+    n_nodes = 6000
+    rng = np.random.RandomState(0)
+    ring = np.arange(n_nodes)
+    links = np.vstack([np.column_stack([ring, np.roll(ring, 1)]),
+                       rng.randint(n_nodes, size=(n_nodes // 10, 2))])
+
+    tracemalloc.start()
+    try:
+        positions = stress_layout(n_nodes, links, n_pivots=20, max_iter=5)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert np.all(np.isfinite(positions))
+    assert peak < 30E6
+
+
+def test_flux_map_python_layout():
+    model = load_json_model(os.path.join(test_dir,
+                                         'simple_model_no_layout.json'))
+    html = flux_map(model, layout='python', figsize=(300, 250))
+
+    # Positions are embedded in the figure, not written to the model
+    assert html is not None
+    assert not any('x' in met.notes['map_info'] for met in model.metabolites)
+
+    model_data = create_model_dict(model, overlay=map_info_overlay(model))
+    layout_model(model_data, figsize=(300, 250))
+    for met in model_data['metabolites']:
+        assert 0 <= met['notes']['map_info']['x'] <= 300
+        assert 0 <= met['notes']['map_info']['y'] <= 250
+
+
+def test_incremental_layout():
+    model, graph = load_graph('simple_model.json')
+    stored = node_positions(graph)
+    # Reaction nodes of the test model don't have stored positions
+    unplaced = {node['id'] for node in graph.nodes} - set(stored)
+
+    new = Metabolite('F')
+    reaction = Reaction('R11')
+    reaction.add_metabolites({model.metabolites.E: -1, new: 1})
+    model.add_reactions([reaction])
+
+    figure = flux_map(model, layout='incremental')
+    assert set(figure.layout_diff['placed']) == unplaced | {'F', 'R11'}
+    assert figure.layout_diff['moved'] == {}
+
+    model_data = create_model_dict(model, overlay=map_info_overlay(model))
+    graph = layout_model(model_data, incremental=True, relax_placed=True)
+    positions = node_positions(graph)
+    assert np.hypot(*np.subtract(positions['F'], stored['E'])) < 100
+
+    diff = layout_diff(stored, positions)
+    assert set(diff['placed']) == unplaced | {'F', 'R11'}
+    assert diff['removed'] == []
+    assert all(shift < 30 for shift in diff['moved'].values())
+
+
+@pytest.mark.skipif(shutil.which('node') is None,
+                    reason='node is not installed')
+def test_worker_protocol():
+    script = os.path.join(test_dir, '..', '..', 'benchmarks',
+                          'test_worker_js.js')
+    if not os.path.exists(script):
+        pytest.skip('benchmarks are not installed')
+    result = subprocess.run(['node', script], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    assert result.returncode == 0, result.stdout.decode()
@@ -0,0 +1,74 @@
+import os
+import time
+
+import numpy as np
+
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict
+from d3flux.core.layout import layout_model
+from d3flux.core.layout_cache import LayoutCache
+
+test_dir = os.path.dirname(__file__)
+
+
+def load_model():
+    return load_json_model(os.path.join(test_dir,
+                                        'simple_model_no_layout.json'))
+
+
+def test_layout_cache_eviction(tmpdir):
+    cache = LayoutCache(str(tmpdir), max_entries=2)
+    for i, key in enumerate(['a', 'b', 'c']):
+        cache.set(key, ['A', 'B'], np.ones((2, 2)) * i)
+        os.utime(cache._filename(key), (time.time() + i, time.time() + i))
+
+    assert len(cache) == 2
+    assert 'a' not in cache
+    assert cache.get('c') == {'A': (2., 2.), 'B': (2., 2.)}
+
+
+
+def test_layout_cache_shared_directory(tmpdir, monkeypatch):
+    # Another process's temporary file is neither counted nor evicted
+    cache = LayoutCache(str(tmpdir), max_entries=1)
+    tmp = tmpdir.join('writing.tmp')
+    tmp.write('')
+    cache.set('a', ['A'], np.zeros((1, 2)))
+    assert len(cache) == 1
+    assert tmp.check()
+
+    # Entries removed by another process while evicting are skipped
+    entries = cache._entries
+    monkeypatch.setattr(cache, '_entries', lambda: entries() + [
+        str(tmpdir.join('removed.npz'))])
+    cache.set('b', ['A'], np.zeros((1, 2)))
+    assert len(entries()) == 1 and 'b' in cache
+    assert cache.get('b') is not None
+
+    # Even when fewer entries than max_entries remain
+    cache.max_entries = 3
+    monkeypatch.setattr(cache, '_entries', lambda: entries() + [
+        str(tmpdir.join('removed.npz')), str(tmpdir.join('gone.npz'))])
+    cache.set('c', ['A'], np.zeros((1, 2)))
+    assert 'b' in cache and 'c' in cache
+
+def test_flux_map_layout_cache(tmpdir):
+    cache = LayoutCache(str(tmpdir))
+
+    model = load_model()
+    flux_map(model, layout='python', layout_cache=cache)
+    assert len(cache) == 1
+
+    # A variant with a knocked-out reaction draws the same graph, and picks
+    # up the stored positions without computing a new layout
+    variant = load_model()
+    variant.reactions.R8.knock_out()
+
+    def positions(cobra_model):
+        model_data = create_model_dict(cobra_model)
+        layout_model(model_data, layout_cache=cache, compute=False)
+        return [met['notes']['map_info']['x']
+                for met in model_data['metabolites']]
+
+    assert positions(variant) == positions(model)
@@ -0,0 +1,130 @@
+import os
+
+from cobra.io import load_json_model
+from d3flux import common_cofactors, update_cofactors
+from d3flux.core.flux_layouts import create_model_dict, map_info_overlay
+from d3flux.core.model_index import clear_index, incidence_index
+
+test_dir = os.path.dirname(__file__)
+
+
+def load_model():
+    return load_json_model(os.path.join(test_dir, 'simple_model.json'))
+
+
+def hidden(overlay, key):
+    return {i for i, map_info in enumerate(overlay[key])
+            if map_info.get('hidden')}
+
+
+def test_index_cached_until_model_changes():
+    model = load_model()
+    index = incidence_index(model)
+    assert incidence_index(model) is index
+
+    model.reactions.R10.add_metabolites({model.metabolites.A: -1})
+    assert incidence_index(model) is not index
+    assert incidence_index(model).reactants[
+        model.reactions.index('R10'), model.metabolites.index('A')] == 1
+
+
+def test_index_rebuilt_on_renames():
+    model = load_model()
+    index = incidence_index(model)
+
+    model.metabolites.A.id = 'A2'
+    assert incidence_index(model).metabolite_ids[
+        model.metabolites.index('A2')] == 'A2'
+
+    index = incidence_index(model)
+    model.metabolites.A2.compartment = 'e'
+    assert incidence_index(model) is not index
+    assert incidence_index(model).compartment_mask(['e'])[
+        model.metabolites.index('A2')]
+
+    index = incidence_index(model)
+    model.reactions.R10.id = 'R10b'
+    assert 'R10b' in incidence_index(model).reaction_index
+
+
+def test_index_rebuilt_on_coefficient_changes():
+    model = load_model()
+    fluxes = {r.id: 0. for r in model.reactions}
+    fluxes.update(R1=3., R5=1.)
+    A, B, P = (model.metabolites.get_by_id(m) for m in 'ABP')
+    incidence_index(model)
+
+    with model:
+        # Coefficients changed in place are drawn: (|3| + |-3 * 1|) / 2
+        model.reactions.R5.add_metabolites({A: -2})
+        model_data = create_model_dict(model, flux_dict=fluxes)
+        met_A = model_data['metabolites'][model.metabolites.index('A')]
+        assert met_A['notes']['map_info']['flux'] == 3.
+
+        # R9: B --> P becomes P --> B
+        model.reactions.R9.add_metabolites({B: 2, P: -2})
+        index = incidence_index(model)
+        R9 = model.reactions.index('R9')
+        assert index.reactants[R9, model.metabolites.index('B')] == 0
+        assert index.products[R9, model.metabolites.index('B')] == 1
+
+    # Leaving the context restores the original stoichiometry
+    index = incidence_index(model)
+    assert index.stoichiometry[model.metabolites.index('A'),
+                               model.reactions.index('R5')] == -1
+    assert index.reactants[R9, model.metabolites.index('B')] == 1
+
+
+def test_clear_index():
+    model = load_model()
+    index = incidence_index(model)
+    clear_index(model)
+    assert incidence_index(model) is not index
+
+
+def test_excluded_reactions_hidden():
+    # Excluded reactions are hidden; before the incidence index they were
+    # looked up and then ignored
+    model = load_model()
+    R7 = model.reactions.index('R7')
+    plain = map_info_overlay(model)
+    assert R7 not in hidden(plain, 'reactions')
+
+    overlay = map_info_overlay(model, excluded_reactions=['R7'])
+    assert hidden(overlay, 'reactions') == hidden(plain, 'reactions') | {R7}
+
+
+def test_collapse_hidden():
+    model = load_model()
+    D, R7 = model.metabolites.index('D'), model.reactions.index('R7')
+
+    # Excluding E and P hides R10, leaving D as a dead end that is produced
+    # by R7 but no longer consumed
+    plain = map_info_overlay(model, excluded_metabolites=['E', 'P'])
+    assert D not in hidden(plain, 'metabolites')
+
+    collapsed = map_info_overlay(model, excluded_metabolites=['E', 'P'],
+                                 collapse_hidden=True)
+    assert hidden(collapsed, 'metabolites') == (
+        hidden(plain, 'metabolites') | {D})
+    assert hidden(collapsed, 'reactions') == (
+        hidden(plain, 'reactions') | {R7})
+
+
+def test_update_cofactors_base_ids():
+    model = load_json_model(os.path.join(
+        test_dir, '..', 'examples', 'asuc', 'asuc_v1.json'))
+    index = incidence_index(model)
+    atp = {met.id for met in model.metabolites
+           if met.id.rsplit('_', 1)[0] == 'atp'}
+    assert {index.metabolite_ids[i] for i in
+            index.resolve_metabolites(['atp'])} == atp
+
+    for rxn in model.reactions:
+        rxn.notes.get('map_info', {}).pop('cofactors', None)
+    update_cofactors(model, ['atp', 'nadh_c'], settings={'x': 1})
+    for met_id in atp | {'nadh_c'}:
+        for rxn in model.metabolites.get_by_id(met_id).reactions:
+            assert rxn.notes['map_info']['cofactors'][met_id] == {'x': 1}
+
+    update_cofactors(model, common_cofactors + ['not_a_metabolite'])
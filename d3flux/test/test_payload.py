@@ -0,0 +1,56 @@
+import json
+import os
+
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict
+from d3flux.core.payload import (
+    compact_payload, encode_payload, decode_payload, load_map_info)
+
+test_dir = os.path.dirname(__file__)
+
+
+def load_model():
+    model = load_json_model(os.path.join(test_dir, 'simple_model.json'))
+    flux_map(model, flux_dict={r.id: 1. for r in model.reactions})
+    return model
+
+
+def test_compact_payload():
+    model = load_model()
+    payload = compact_payload(create_model_dict(model, full=False))
+
+    assert payload['reactions']['id'] == [r.id for r in model.reactions]
+    assert payload['metabolites']['x'] == [
+        m.notes['map_info'].get('x') for m in model.metabolites]
+    assert len(payload['stoichiometry']['coefficient']) == sum(
+        len(r.metabolites) for r in model.reactions)
+
+    # Fluxes and positions are stored as columns, not in map_info
+    for map_info in payload['reactions']['map_info'].values():
+        assert not {'flux', 'x', 'y'}.intersection(map_info)
+
+
+def test_payload_smaller_than_full():
+    model = load_model()
+    full = json.dumps(create_model_dict(model))
+    compact = encode_payload(compact_payload(create_model_dict(model)))
+    assert len(compact) < len(full)
+
+
+def test_encode_payload_gzip():
+    payload = compact_payload(create_model_dict(load_model(), full=False))
+    assert decode_payload(encode_payload(payload, compress=True)) == payload
+
+
+def test_load_map_info(tmpdir):
+    saved = create_model_dict(load_model(), full=False)
+    saved['metabolites'][0]['notes']['map_info']['x'] = 1234.
+
+    filename = str(tmpdir.join('saved.json'))
+    with open(filename, 'w') as f:
+        json.dump(saved, f)
+
+    model = load_json_model(os.path.join(test_dir, 'simple_model.json'))
+    load_map_info(model, filename)
+    assert model.metabolites[0].notes['map_info']['x'] == 1234.
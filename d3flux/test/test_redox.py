@@ -0,0 +1,68 @@
+import os
+
+import pandas as pd
+import pytest
+
+import d3flux
+from cobra.io import load_json_model
+from d3flux import color_redox_rxns, flux_map, redox_summary
+from d3flux.core.flux_layouts import create_model_dict, map_info_overlay
+from d3flux.core.redox import redox_groups
+
+asuc = os.path.join(os.path.dirname(d3flux.__file__), 'examples', 'asuc',
+                    'asuc_v1.json')
+
+
+def test_redox_groups_match_redox_summary():
+    model = load_json_model(asuc)
+    solution = model.optimize()
+    oxidizing, reducing = redox_summary(model)
+
+    fluxes = pd.DataFrame({'opt': solution.fluxes,
+                           'reverse': -solution.fluxes})
+    groups = redox_groups(model, fluxes)
+
+    assert set(groups.index[groups['opt'] == 1]) == set(oxidizing.index)
+    assert set(groups.index[groups['opt'] == 2]) == set(reducing.index)
+    assert set(groups.index[groups['reverse'] == 2]) == set(oxidizing.index)
+
+
+def test_flux_map_groups():
+    model = load_json_model(asuc)
+    solution = model.optimize()
+    groups = redox_groups(model, solution, starting_group=3)['flux']
+    oxidizing = groups.index[groups == 3][0]
+
+    overlay = map_info_overlay(model, groups=groups)
+    model_data = create_model_dict(model, solution, overlay=overlay)
+    rxn_data = {r['id']: r for r in model_data['reactions']}
+    assert rxn_data[oxidizing]['notes']['map_info']['group'] == 3
+
+    flux_map(model, flux_dict=solution, groups=groups)
+    assert 'group' not in model.reactions.get_by_id(oxidizing).notes.get(
+        'map_info', {})
+
+
+def test_color_redox_rxns_column():
+    model = load_json_model(asuc)
+    solution = model.optimize()
+    oxidizing = redox_summary(model)[0].index[0]
+    fluxes = pd.DataFrame({'opt': solution.fluxes,
+                           'reverse': -solution.fluxes})
+
+    def group(rxn_id):
+        return model.reactions.get_by_id(rxn_id).notes['map_info'].get(
+            'group')
+
+    with pytest.raises(ValueError):
+        color_redox_rxns(model, fluxes=fluxes)
+
+    color_redox_rxns(model, fluxes=fluxes, column='reverse')
+    assert group(oxidizing) == 2
+
+    # Solution.to_frame() has 'fluxes' and 'reduced_costs' columns
+    color_redox_rxns(model, fluxes=solution.to_frame())
+    assert group(oxidizing) == 1
+
+    color_redox_rxns(model, fluxes=fluxes[['reverse']])
+    assert group(oxidizing) == 2
@@ -0,0 +1,95 @@
+import os
+
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict, map_info_overlay
+from d3flux.core.render_cache import (
+    RenderCache, fingerprint, overlay_digest)
+
+test_dir = os.path.dirname(__file__)
+
+
+def load_model():
+    model = load_json_model(os.path.join(test_dir, 'simple_model.json'))
+    model.optimize()
+    return model
+
+
+def test_render_cache_hits(tmpdir):
+    model = load_model()
+    cache = RenderCache(maxsize=2, path=str(tmpdir))
+
+    first = flux_map(model, cache=cache, figure_id='first')
+    second = flux_map(model, cache=cache, figure_id='second')
+    uncached = flux_map(model, figure_id='second')
+    assert second.cache_key == first.cache_key
+    assert second.data == uncached.data
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    # Changes below the 1E-8 flux threshold render the same figure
+    fluxes = model.optimize().fluxes
+    fluxes.iloc[0] += 1E-10
+    assert flux_map(model, flux_dict=fluxes, cache=cache).cache_key == (
+        first.cache_key)
+
+    fluxes.iloc[0] += 1.
+    assert flux_map(model, flux_dict=fluxes, cache=cache).cache_key != (
+        first.cache_key)
+    assert flux_map(model, cache=cache, hide_unused=True).cache_key != (
+        first.cache_key)
+
+    # A new session reads the entries from disk
+    disk = RenderCache(path=str(tmpdir))
+    figure = flux_map(model, cache=disk, figure_id='second')
+    assert figure.data == uncached.data
+    assert figure.reaction_fluxes == uncached.reaction_fluxes
+    assert disk.stats()['disk_hits'] == 1
+    assert disk.payload(figure.cache_key) is not None
+
+    disk.clear()
+    assert disk.stats()['disk_entries'] == 0
+
+
+def test_fingerprint_digests():
+    model = load_model()
+    overlay = map_info_overlay(model, digest=True)
+    assert overlay['digest'] == overlay_digest(map_info_overlay(model))
+    key = fingerprint(model, overlay)
+
+    # The digest taken when the overlay was built stands for its map_info
+    overlay['digest'] = overlay_digest(map_info_overlay(model, groups={
+        'R5': 2}))
+    assert fingerprint(model, overlay) != key
+    del overlay['digest']
+    assert fingerprint(model, overlay) == key
+
+    # Any bound change, not only knockouts, changes the fingerprint
+    model.reactions.R5.upper_bound = 500.
+    assert fingerprint(model, overlay) != key
+
+    # Adding the fluxes drops the digest
+    overlay = map_info_overlay(model, digest=True)
+    create_model_dict(model, overlay=overlay, full=False)
+    assert 'digest' not in overlay
+
+
+def test_cached_figures_update_separately():
+    model = load_model()
+    cache = RenderCache()
+    fluxes = {r.id: 0. for r in model.reactions}
+    new_fluxes = dict(fluxes, R1=2.)
+    fluxes['R1'] = 1.
+
+    first = flux_map(model, flux_dict=fluxes, cache=cache)
+    first.send = lambda message: None
+    assert first.update(new_fluxes)['reactions'] == {'R1': 2.}
+
+    # Updating the first figure leaves the cached fluxes as drawn
+    second = flux_map(model, flux_dict=fluxes, cache=cache)
+    assert cache.stats()['hits'] == 1
+    assert second.reaction_fluxes['R1'] == 1.
+    sent = []
+    second.send = sent.append
+    assert second.update(new_fluxes)['reactions'] == {'R1': 2.}
+    assert len(sent) == 1
+    assert first.reaction_fluxes['R1'] == 2.
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import d3flux
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict
+from d3flux.core.samples import StreamingQuantiles, summarize_samples
+
+asuc = os.path.join(os.path.dirname(d3flux.__file__), 'examples', 'asuc',
+                    'asuc_v1.json')
+
+
+def random_samples(model, n_samples=2000, seed=0):
+    """Lognormal fluxes with random signs, zero in 30% of the samples"""
+    rng = np.random.RandomState(seed)
+    shape = (n_samples, len(model.reactions))
+    samples = rng.lognormal(0, 1.5, size=shape) * rng.choice([-1, 1], shape)
+    samples[rng.rand(*shape) < 0.3] = 0.
+    return pd.DataFrame(samples, columns=[r.id for r in model.reactions])
+
+
+def test_streaming_quantiles():
+    rng = np.random.RandomState(1)
+    values = rng.lognormal(0, 2, size=(5000, 3)) * rng.choice([-1, 1],
+                                                               (5000, 3))
+    values[:, 1] = np.abs(values[:, 1])
+    values[:3000, 2] = 0.
+
+    stats = StreamingQuantiles(3, limit=1E4)
+    for block in np.array_split(values, 7):
+        stats.update(block)
+
+    for q in (.25, .5, .75):
+        expected = np.percentile(values, 100 * q, axis=0)
+        assert np.allclose(stats.quantile(q), expected, rtol=0.03,
+                           atol=1E-3)
+
+    # More than half of the last column is zero
+    assert stats.quantile(.5)[2] == 0.
+    assert np.allclose(stats.nonzero(), [1., 1., .4])
+    assert np.allclose(stats.mean(), values.mean(0))
+
+
+def test_summarize_samples_npy(tmpdir):
+    model = load_json_model(asuc)
+    samples = random_samples(model)
+    filename = str(tmpdir.join('samples.npy'))
+    np.save(filename, samples.values)
+
+    from_file = summarize_samples(model, filename, block_rows=300)
+    from_frame = summarize_samples(model, samples)
+    from_blocks = summarize_samples(
+        model, (samples.iloc[i:i + 500] for i in range(0, 2000, 500)))
+
+    for summary in (from_frame, from_blocks):
+        for key in ('reactions', 'metabolites'):
+            pd.testing.assert_frame_equal(summary[key], from_file[key])
+
+    reactions = from_file['reactions']
+    assert (reactions['count'] == 2000).all()
+    assert np.allclose(reactions['nonzero'], (samples != 0).mean())
+
+    # Metabolite throughput, |S|.|v| / 2, in each sample
+    met = model.metabolites[0]
+    throughput = sum(abs(coeff) * samples[r.id].abs() for r, coeff in
+                     ((r, r.metabolites[met]) for r in met.reactions)) / 2
+    assert np.isclose(from_file['metabolites'].loc[met.id, 'median'],
+                      throughput.median(), rtol=0.03)
+
+
+def test_flux_map_samples():
+    model = load_json_model(asuc)
+    samples = random_samples(model, n_samples=500)
+    summary = summarize_samples(model, samples)
+
+    model_data = create_model_dict(model, summary['reactions']['median'],
+                                   summary['metabolites']['median'],
+                                   full=False, samples=summary)
+    rxn = model.reactions[0]
+    map_info = model_data['reactions'][0]['notes']['map_info']
+    assert map_info['flux'] == summary['reactions'].loc[rxn.id, 'median']
+    assert map_info['flux_q1'] <= map_info['flux'] <= map_info['flux_q3']
+    assert map_info['nonzero'] == summary['reactions'].loc[rxn.id, 'nonzero']
+
+    # Raw samples and their summary draw the same figure
+    html = flux_map(model, samples=samples, figure_id='d3flux_samples').data
+    assert html == flux_map(model, samples=summary,
+                            figure_id='d3flux_samples').data
+    assert '"flux_q3"' in html
+    assert 'flux_q1' not in rxn.notes.get('map_info', {})
@@ -0,0 +1,103 @@
+import json
+import os
+
+import d3flux
+from cobra.io import load_json_model
+from d3flux import flux_map
+from d3flux.core.flux_layouts import create_model_dict, map_info_overlay
+from d3flux.core.payload import decode_payload
+from d3flux.core.render_cache import RenderCache
+from d3flux.core.subsystems import (
+    collapse_model, reaction_groups, UNASSIGNED)
+
+asuc = os.path.join(os.path.dirname(d3flux.__file__), 'examples', 'asuc',
+                    'asuc_v1.json')
+
+
+def compartment_group(reaction):
+    compartments = sorted(reaction.compartments)
+    return '/'.join(compartments) if len(compartments) == 1 else None
+
+
+def visible_reactions(model):
+    overlay = map_info_overlay(model)
+    return sorted(r.id for r, map_info in zip(model.reactions,
+                                               overlay['reactions'])
+                  if not map_info.get('hidden'))
+
+
+def test_collapse_model():
+    model = load_json_model(asuc)
+    fluxes = model.optimize().fluxes
+    groups = reaction_groups(model, compartment_group)
+    assert UNASSIGNED in groups
+
+    model_data = create_model_dict(model, fluxes, full=False,
+                                   overlay=map_info_overlay(model))
+    coarse, chunks = collapse_model(model_data, groups)
+
+    def group_reactions(node_id):
+        return [r for r in chunks[node_id]['reactions']
+                if 'subsystem_node' not in r['notes']['map_info']]
+
+    # Every visible reaction is drawn in exactly one chunk
+    chunk_ids = [r['id'] for node_id in chunks
+                 for r in group_reactions(node_id)]
+    assert sorted(chunk_ids) == visible_reactions(model)
+
+    # The coarse model only has group nodes, linked by group pairs
+    nodes = {m['id']: m['notes']['map_info'] for m in coarse['metabolites']}
+    assert sorted(nodes) == sorted(chunks)
+    for node_id, map_info in nodes.items():
+        reactions = group_reactions(node_id)
+        assert map_info['reactions'] == len(reactions)
+        assert abs(map_info['flux'] - sum(
+            abs(fluxes[r['id']]) for r in reactions)) < 1E-8
+
+    for link in coarse['reactions']:
+        source, target = link['notes']['map_info']['subsystem_link']
+        assert link['metabolites'] == {source: -1, target: 1}
+        assert link['notes']['map_info']['flux'] > 0
+
+    # Links drawn on expansion carry the other group's net production of
+    # the shared metabolite
+    for node_id in chunks:
+        for link in chunks[node_id]['reactions']:
+            other = link['notes']['map_info'].get('subsystem_node')
+            if other is None:
+                continue
+            met_id, = [m for m in link['metabolites'] if m != other]
+            net = sum(r['metabolites'].get(met_id, 0) * fluxes[r['id']]
+                      for r in group_reactions(other))
+            assert abs(link['metabolites'][met_id] *
+                       link['notes']['map_info']['flux'] - net) < 1E-8
+
+
+def test_flux_map_collapse():
+    model = load_json_model(asuc)
+    fluxes = model.optimize().fluxes
+    cache = RenderCache()
+    full = flux_map(model, flux_dict=fluxes, payload='compact', cache=cache)
+    collapsed = flux_map(model, flux_dict=fluxes, collapse=compartment_group,
+                         cache=cache)
+    assert collapsed.cache_key != full.cache_key
+
+    # Python still tracks the fluxes of every reaction
+    assert collapsed.reaction_fluxes == full.reaction_fluxes
+
+    payload = decode_payload(cache.payload(collapsed.cache_key))
+    assert payload['format'] == 'd3flux.collapsed.v1'
+    assert len(payload['model']['reactions']['id']) < len(model.reactions)
+    assert (len(cache.payload(collapsed.cache_key)) <
+            len(cache.payload(full.cache_key)))
+
+    # Chunks are gzipped compact payloads of each group's reactions
+    chunk_ids = []
+    for chunk in payload['chunks'].values():
+        chunk = decode_payload(json.dumps(chunk))
+        assert chunk['format'] == 'd3flux.compact.v1'
+        chunk_ids.extend(
+            rxn_id for i, rxn_id in enumerate(chunk['reactions']['id'])
+            if 'subsystem_node' not in chunk['reactions']['map_info'].get(
+                str(i), {}))
+    assert sorted(chunk_ids) == visible_reactions(model)
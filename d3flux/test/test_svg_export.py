@@ -0,0 +1,84 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+
+from cobra.io import load_json_model
+from d3flux import flux_svg
+
+test_dir = os.path.dirname(__file__)
+SVG = '{http://www.w3.org/2000/svg}'
+
+
+def load_model(filename='simple_model.json'):
+    return load_json_model(os.path.join(test_dir, filename))
+
+
+def test_flux_svg(tmpdir):
+    model = load_model()
+    model.reactions.R7.knock_out()
+    flux_dict = {r.id: 1. for r in model.reactions}
+    flux_dict['R6'] = 0.
+
+    filename = str(tmpdir.join('map.svg'))
+    svg = flux_svg(model, filename=filename, flux_dict=flux_dict)
+    with open(filename) as f:
+        assert f.read() == svg
+
+    root = ET.fromstring(svg)
+    links = {path.get('class').split()[1]: path
+             for path in root.iter(SVG + 'path')
+             if path.get('class', '').startswith('link')}
+
+    # R1-R4 are boundary reactions and are not drawn
+    assert sorted(links) == ['d3flux' + r for r in
+                             ('R10', 'R5', 'R6', 'R7', 'R8', 'R9')]
+    assert links['d3fluxR7'].get('stroke-dasharray') == '5, 5, 1, 5'
+    assert links['d3fluxR7'].get('stroke') == '#d62728'
+    assert links['d3fluxR6'].get('stroke-dasharray') == '5,5'
+    assert 'inactive' in links['d3fluxR6'].get('class')
+    assert links['d3fluxR5'].get('stroke-dasharray') is None
+
+    assert list(root.iter(SVG + 'text'))
+
+
+def test_flux_svg_computes_layout():
+    # Nodes without stored positions are placed by the python layout
+    model = load_model('simple_model_no_layout.json')
+    root = ET.fromstring(flux_svg(model, figsize=(400, 300)))
+    assert root.get('viewBox') == '0 0 400 300'
+    assert len(list(root.iter(SVG + 'circle'))) > 0
+
+
+def test_flux_svg_samples():
+    model = load_model()
+    rng = np.random.RandomState(0)
+    samples = pd.DataFrame(rng.lognormal(0, 1, (200, len(model.reactions))),
+                           columns=[r.id for r in model.reactions])
+    samples['R5'] = 0.
+    samples.loc[:49, 'R6'] = 0.
+
+    root = ET.fromstring(flux_svg(model, samples=samples))
+    paths = list(root.iter(SVG + 'path'))
+    bands = [path for path in paths if path.get('class') == 'flux-iqr']
+    links = {path.get('class').split()[1]: path for path in paths
+             if path.get('class', '').startswith('link')}
+
+    # One band under each link
+    assert len(bands) == len([path for path in paths if path.get(
+        'class', '').startswith('link')])
+    assert all(float(band.get('stroke-width')) > 0 for band in bands)
+
+    # The fraction of samples carrying flux sets the opacity
+    assert float(links['d3fluxR6'].get('stroke-opacity')) == .75
+    assert float(links['d3fluxR5'].get('stroke-opacity')) == .1
+    assert float(links['d3fluxR7'].get('stroke-opacity')) == 1.
+
+    rings = [circle for circle in root.iter(SVG + 'circle')
+             if circle.get('class') == 'flux-iqr']
+    assert rings and all(float(ring.get('r')) > 0 for ring in rings)
+
+    # Maps without samples are unchanged
+    plain = flux_svg(model, flux_dict={r.id: 1. for r in model.reactions})
+    assert 'flux-iqr' not in plain and 'opacity=' not in plain
@@ -0,0 +1,57 @@
+import os
+import threading
+
+from d3flux.core import template_cache
+from d3flux.core.cache import LRUCache
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache.get('a')
+    cache['c'] = 3
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
+
+
+def test_lru_cache_threads():
+    cache = LRUCache(maxsize=50)
+
+    def worker(offset):
+        for i in range(2000):
+            key = (offset + i) % 200
+            if cache.get(key) is None:
+                cache[key] = key
+
+    threads = [threading.Thread(target=worker, args=(10 * i,))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == 50
+    assert cache.hits + cache.misses == 8 * 2000
+    assert all(cache[key] == key for key in list(cache._data))
+
+
+def test_render_css_memoized():
+    template_cache.clear_caches()
+    css = template_cache.render_css(0.5, 12, '.node {fill: red;}')
+    assert template_cache.render_css(0.5, 12, '.node {fill: red;}') is css
+    assert template_cache._css_cache.hits == 1
+    assert '.node{fill:red}' in css
+
+
+def test_background_svg_invalidated(tmpdir):
+    svg_file = tmpdir.join('background.svg')
+    svg_file.write('<svg><rect width="1"/></svg>')
+    assert 'width="1"' in template_cache.load_background_svg(str(svg_file))
+
+    svg_file.write('<svg><rect width="2"/></svg>')
+    mtime = os.path.getmtime(str(svg_file))
+    os.utime(str(svg_file), (mtime + 10, mtime + 10))
+    assert 'width="2"' in template_cache.load_background_svg(str(svg_file))
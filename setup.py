@@ -9,6 +9,11 @@ setup(name='d3flux',
       author_email='peter.stjohn@nrel.gov',
       license='MIT',
       packages=find_packages(),
-      install_requires=['pandas', 'cobra', 'jinja2', 'ipython', 'csscompressor'],
+      python_requires='>=3.9',
+      install_requires=['numpy', 'scipy', 'pandas', 'cobra', 'jinja2',
+                        'ipython', 'csscompressor'],
       package_data={'d3flux': ['templates/*']},
+      entry_points={
+          'console_scripts': ['d3flux = d3flux.core.batch:main'],
+      },
       )